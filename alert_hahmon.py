@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Send alerts for the home automation host monitor through `sa.sh` (see
+README.md), which mails its standard input with the subject given as its
+argument.
+
+Alerts are sent from a thread of their own so that the thread recording
+activity only appends an event to a list. Events arriving within
+'window' seconds of the first are sent together as one digest, so when a
+switch dies and 60 hosts go late at once that is one mail rather than
+60. Each host is alerted at most once every 'host_interval' seconds,
+later events for it being counted as suppressed. A digest that cannot be
+sent is retried with a doubling delay. Memory is bounded: repeated
+events (e.g. every message from an unknown host) are kept once, at most
+max_events distinct events wait for the next digest, further ones being
+dropped, and at most max_retries digests wait to be retried, the oldest
+being dropped beyond that.
+
+Events come from edit_hahmon.ActivityWriter, handed an AlertDispatcher as
+'alerts': hosts going late (from the overdue scanner) and messages from
+hosts that are not in the database (status 1 from resolve_activity).
+"""
+
+import atexit
+import collections
+import logging
+import shlex
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def run_command(command, subject, body, timeout=60):
+    """ Run 'command' with 'subject' as its last argument and 'body' as
+    standard input. Return True if it succeeded.
+    """
+    try:
+        result = subprocess.run(command + [subject], input=body.encode(),
+                                timeout=timeout)
+    except (OSError, subprocess.SubprocessError) as msg:
+        logger.error("alert command=%s error=%s", command[0], msg)
+        return False
+    if result.returncode != 0:
+        logger.error("alert command=%s rc=%d", command[0], result.returncode)
+        return False
+    return True
+
+
+class AlertDispatcher(threading.Thread):
+
+    def __init__(self, command=("sa.sh",), window=30, host_interval=3600,
+                 max_events=1000, max_retries=10, retry_delay=60, send=None,
+                 clock=time.time):
+        super().__init__(name="alerts", daemon=True)
+        self.command = list(command)
+        self.window = window
+        self.host_interval = host_interval
+        self.retry_delay = retry_delay
+        self.send = send if send is not None else self.run_command
+        self.clock = clock
+        self.max_events = max_events
+        self.events = {}        # (kind, host, topic) -> time, in arrival order
+        self.retries = collections.deque(maxlen=max_retries)  # [due, delay, subject, body]
+        self.alerted = {}       # host -> time of last alert
+        self.ready = threading.Condition()
+        self.running = True
+        self.sent = 0
+        self.suppressed = 0
+        self.dropped = 0
+
+    def run_command(self, subject, body):
+        return run_command(self.command, subject, body)
+
+    def late(self, host, topic):
+        self.event("late", host, topic)
+
+    def unknown(self, host, topic):
+        self.event("unknown", host, topic)
+
+    def event(self, kind, host, topic):
+        """ Queue an event for the next digest. Never blocks for long. """
+        now = self.clock()
+        last = self.alerted.get(host)
+        if last is not None and now - last < self.host_interval:
+            self.suppressed += 1    # unlocked, may rarely miss a count
+            return
+        key = (kind, host, topic)
+        if key in self.events:
+            return
+        with self.ready:
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+            self.events.setdefault(key, now)
+            self.ready.notify()
+
+    def take_digest(self, now):
+        """ Return (subject, body) for the waiting events, or None if none
+        are for hosts that may be alerted. Called with the lock held.
+        """
+        counts = collections.Counter()
+        lines = []
+        hosts = set()       # hosts in this digest
+        for ((kind, host, topic), when) in self.events.items():
+            if host not in hosts:
+                last = self.alerted.get(host)
+                if last is not None and now - last < self.host_interval:
+                    self.suppressed += 1
+                    continue
+                hosts.add(host)
+                self.alerted[host] = now
+            counts[kind] += 1
+            lines.append("{} {} {} {}".format(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)),
+                kind, host, topic if topic is not None else ""))
+        self.events.clear()
+        for host in [host for (host, last) in self.alerted.items()
+                     if now - last >= self.host_interval]:
+            del self.alerted[host]      # bounded by hosts alerted recently
+        if not lines:
+            return None
+        subject = "hahmon: " + ", ".join("{} {}".format(count, kind)
+                                         for (kind, count) in sorted(counts.items()))
+        return (subject, "\n".join(lines) + "\n")
+
+    def dispatch(self, subject, body):
+        if self.send(subject, body):
+            self.sent += 1
+        else:
+            if len(self.retries) == self.retries.maxlen:
+                logger.error("alert dropped subject=%r", self.retries[0][2])
+            self.retries.append([self.clock() + self.retry_delay,
+                                 self.retry_delay, subject, body])
+
+    def retry(self, now):
+        for _ in range(len(self.retries)):
+            entry = self.retries.popleft()
+            (due, delay, subject, body) = entry
+            if due > now:
+                self.retries.append(entry)
+            elif self.send(subject, body):
+                self.sent += 1
+            else:
+                delay *= 2
+                self.retries.append([now + delay, delay, subject, body])
+
+    def run(self):
+        running = True
+        while running:
+            with self.ready:
+                if self.running and not self.events:
+                    self.ready.wait(self.retry_delay if self.retries else None)
+                if self.events:     # collect events for the window
+                    deadline = next(iter(self.events.values())) + self.window
+                    while self.running and self.clock() < deadline:
+                        self.ready.wait(deadline - self.clock())
+                digest = self.take_digest(self.clock()) if self.events else None
+                running = self.running
+            if digest is not None:
+                self.dispatch(*digest)
+            self.retry(self.clock())
+
+    def stop(self):
+        """ Send what is waiting and wait for the thread to finish. """
+        with self.ready:
+            self.running = False
+            self.ready.notify()
+        if self.is_alive():
+            self.join()
+
+
+def start_alert_dispatcher(command, window=30, host_interval=3600):
+    """ Start an AlertDispatcher running 'command' (a shell style string)
+    and stop it at exit.
+    """
+    dispatcher = AlertDispatcher(shlex.split(command), window, host_interval)
+    dispatcher.start()
+    atexit.register(dispatcher.stop)
+    return dispatcher
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Home Automation Host Monitor.
+
+Usage:
+    bench_hahmon.py [activity|parse|ingest|memory|shards] [-n <messages>]
+                    [--hosts <count>] [--topics <count>] [--sizes <count>...]
+                    [--shards <count>] [-o <results.json>]
+
+activity - Compare the throughput of recording activity through
+    edit_hahmon.update_host_activity() (one connection per message) with a
+    single long lived edit_hahmon.ActivityWriter, first committing every
+    message and then writing behind in batches.
+parse - Compare the per message cost of the parsers (edit_hahmon
+    split_activity() and split_many(), hahmon.parse_MQTT_msg()) with the
+    regular expression parsers they replaced.
+ingest - Simulate <hosts> x <topics> publishers and feed their messages
+    to update_host_activity() and, in buffers as read from mosquitto_sub,
+    to an ActivityWriter in process. Report
+    throughput, p50/p99 per message latency, commits per second and
+    database growth, and write them as JSON to <results.json> so that
+    regressions can be tracked.
+memory - Measure the memory held by scan_hahmon.OverdueScanner for each
+    of <sizes> host/topic records (default 10k, 100k and 1M, <topics> per
+    host) against the dict of per record lists it used to keep, using
+    tracemalloc. Results are written to <results.json> as for ingest.
+shards - Feed the ingest load through shard_hahmon.ShardPool with 1 to
+    <shards> processes and report the throughput of each, its speedup over
+    one shard and the commits made (from the metrics the shards report),
+    to show how ingest scales with cores. Results are written to
+    <results.json> as for ingest.
+
+Databases are created in a temporary directory and removed afterward.
+"""
+
+import edit_hahmon
+import hahmon
+import metrics_hahmon
+import mosquitto_hahmon
+import scan_hahmon
+import shard_hahmon
+import heapq
+import itertools
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+
+def make_messages(count, hosts):
+    """ Return a list of 'count' message lines spread across 'hosts' hosts
+    in the form published by the home automation sensors.
+    """
+    now = int(time.time())
+    return ["home_automation/host{}/room/temp_humidity {}, 72.50, 30.98"
+            .format(i % hosts, now + i) for i in range(count)]
+
+
+def populate(db_name, hosts):
+    """ Create a database with one registration per host. """
+    edit_hahmon.create_database(db_name)
+    for i in range(hosts):
+        edit_hahmon.insert_host(db_name, "host{}".format(i), 300)
+
+
+def time_per_call(db_name, messages):
+    start = time.perf_counter()
+    for line in messages:
+        edit_hahmon.update_host_activity(db_name, line)
+    return time.perf_counter() - start
+
+
+def time_writer(db_name, messages, flush_interval=0, flush_size=1):
+    start = time.perf_counter()
+    writer = edit_hahmon.ActivityWriter(db_name, flush_interval, flush_size)
+    for line in messages:
+        writer.update(line)
+    writer.close()
+    return (time.perf_counter() - start, writer.commits)
+
+
+def report(label, count, elapsed, commits=None):
+    print("{:<24} {:>8} msgs {:>8.3f} s {:>10.0f} msgs/s".format(
+        label, count, elapsed, count / elapsed), end="")
+    if commits is not None:
+        print(" {:>8} commits".format(commits), end="")
+    print()
+
+
+def compare_activity(count, hosts):
+    messages = make_messages(count, hosts)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, "per_call.db")
+        populate(db_name, hosts)
+        report("update_host_activity()", count,
+               time_per_call(db_name, messages))
+
+        db_name = os.path.join(tmp, "writer.db")
+        populate(db_name, hosts)
+        report("ActivityWriter.update()", count,
+               *time_writer(db_name, messages))
+
+        db_name = os.path.join(tmp, "batched.db")
+        populate(db_name, hosts)
+        report("ActivityWriter batched", count,
+               *time_writer(db_name, messages, 5, 1000))
+
+
+def regex_parse_line(line):
+    # parse_MQTT_msg() as it was in hahmon.py and mosquitto_hahmon.py
+    fields = re.split('\\W+', line)
+    if len(fields) < 6:
+        return None
+    host = fields[1]
+    topic = '/' + fields[2] + '/' + fields[3]
+    timestamp = int(fields[4])
+    return (host, topic, timestamp,)
+
+
+def regex_parse_topic(topic, payload):
+    # parse_MQTT_msg() as it was in paho_hahmon.py, including the decode
+    payload = payload.decode("utf-8")
+    topic = re.split('\\W+', topic)
+    host = topic[1]
+    topic = '/' + topic[2] + '/' + topic[3]
+    payload = re.split('\\W+', payload)
+    timestamp = int(payload[0])
+    return (host, topic, timestamp)
+
+
+def time_calls(function, args):
+    start = time.perf_counter()
+    for arg in args:
+        function(*arg)
+    return time.perf_counter() - start
+
+
+def report_per_message(label, count, elapsed):
+    print("{:<28} {:>8} msgs {:>8.3f} us/msg".format(
+        label, count, elapsed / count * 1e6))
+
+
+def compare_parse(count, hosts):
+    lines = make_messages(count, hosts)
+    str_lines = [(line,) for line in lines]
+    byte_lines = [(line.encode(),) for line in lines]
+    pairs = [(topic, payload.encode()) for (topic, sep, payload) in
+             (line.partition(' ') for line in lines)]
+    report_per_message("regex line (str)", count,
+                       time_calls(regex_parse_line, str_lines))
+    report_per_message("parse_MQTT_msg (str)", count,
+                       time_calls(hahmon.parse_MQTT_msg, str_lines))
+    report_per_message("parse_MQTT_msg (bytes)", count,
+                       time_calls(hahmon.parse_MQTT_msg, byte_lines))
+    report_per_message("regex topic/payload", count,
+                       time_calls(regex_parse_topic, pairs))
+    report_per_message("split_activity (str)", count,
+                       time_calls(edit_hahmon.split_activity, str_lines))
+    report_per_message("split_activity (bytes)", count,
+                       time_calls(edit_hahmon.split_activity, byte_lines))
+    buffer = "\n".join(lines).encode()
+    report_per_message("split_many", count,
+                       time_calls(edit_hahmon.split_many, [(buffer,)]))
+
+
+def generate_load(hosts, topics, count, start=None):
+    """ Yield 'count' message lines (bytes) as published by 'hosts' hosts
+    each with 'topics' topics, one message per host/topic in turn and one
+    second apart per round.
+    """
+    if start is None:
+        start = int(time.time())
+    pairs = hosts * topics
+    for i in range(count):
+        (host, topic) = divmod(i % pairs, topics)
+        yield ("home_automation/host{}/loc{}/desc{} {}, 72.50, 30.98"
+               .format(host, topic, topic, start + i // pairs)).encode()
+
+
+def populate_topics(db_name, hosts, topics):
+    """ Create a database registering each host with no topic and its
+    first topic explicitly, so both lookups are exercised.
+    """
+    edit_hahmon.create_database(db_name)
+    conn = sqlite3.connect(db_name)
+    now = int(time.time())
+    rows = []
+    for host in range(hosts):
+        rows.append(("host{}".format(host), None, now, 300, "unknown", now + 300))
+        rows.append(("host{}".format(host),
+                     "home_automation/host{}/loc0/desc0".format(host),
+                     now, 300, "unknown", now + 300))
+    conn.executemany('''insert into host_activity
+            (host, topic, timestamp, timeout, status, deadline)
+            values (?,?,?,?,?,?)''', rows)
+    conn.commit()
+    conn.close()
+
+
+def db_size(db_name):
+    return sum(os.path.getsize(name) for name in (db_name, db_name + "-wal")
+               if os.path.isfile(name))
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def read_buffers(lines, size=mosquitto_hahmon.READ_SIZE):
+    """ Yield the lines joined into buffers of complete lines of up to
+    'size' bytes, as mosquitto_hahmon.read_batches() yields them.
+    """
+    buffer = []
+    length = 0
+    for line in lines:
+        if buffer and length + len(line) + 1 > size:
+            yield b'\n'.join(buffer) + b'\n'
+            (buffer, length) = ([], 0)
+        buffer.append(line)
+        length += len(line) + 1
+    if buffer:
+        yield b'\n'.join(buffer) + b'\n'
+
+
+def run_ingest(db_name, lines, mode, flush_interval, flush_size):
+    """ Feed each line to update_host_activity() ('per_call'), or feed
+    buffers of lines to an ActivityWriter ('writer') as
+    mosquitto_hahmon.ingest() does: split_many(), record() and poll() per
+    buffer. A message's latency is the time from the start of its call, or
+    of its buffer, until it has been recorded. Return a dict of results.
+    """
+    latencies = []
+    size_before = db_size(db_name)
+    clock = time.perf_counter
+    if mode == "per_call":
+        start = clock()
+        for line in lines:
+            t0 = clock()
+            edit_hahmon.update_host_activity(db_name, line.decode())
+            latencies.append(clock() - t0)
+        elapsed = clock() - start
+        # every call commits, except those answered by the UnknownCache
+        cache = edit_hahmon.unknown_activity.get(db_name)
+        commits = len(lines) - (cache.hits if cache is not None else 0)
+    else:
+        buffers = list(read_buffers(lines))
+        writer = edit_hahmon.ActivityWriter(db_name, flush_interval, flush_size)
+        start = clock()
+        for buffer in buffers:
+            t0 = clock()
+            for (host, topic) in edit_hahmon.split_many(buffer):
+                writer.record(host, topic)
+                latencies.append(clock() - t0)
+            writer.poll()
+        writer.close()
+        elapsed = clock() - start
+        commits = writer.commits
+    latencies.sort()
+    return {"mode": mode,
+            "messages": len(lines),
+            "seconds": elapsed,
+            "messages_per_second": len(lines) / elapsed,
+            "p50_us": percentile(latencies, 0.50) * 1e6,
+            "p99_us": percentile(latencies, 0.99) * 1e6,
+            "commits": commits,
+            "commits_per_second": commits / elapsed,
+            "db_growth_bytes": db_size(db_name) - size_before}
+
+
+def bench_ingest(args):
+    lines = list(generate_load(args.hosts, args.topics, args.messages))
+    results = {"benchmark": "ingest",
+               "time": int(time.time()),
+               "hosts": args.hosts,
+               "topics": args.topics,
+               "flush_interval": args.flush_interval,
+               "flush_size": args.flush_size,
+               "runs": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("per_call", "writer"):
+            db_name = os.path.join(tmp, mode + ".db")
+            populate_topics(db_name, args.hosts, args.topics)
+            run = run_ingest(db_name, lines, mode,
+                             args.flush_interval, args.flush_size)
+            results["runs"].append(run)
+            print("{mode:<10} {messages:>8} msgs {messages_per_second:>10.0f} msgs/s "
+                  "p50 {p50_us:>7.1f} us p99 {p99_us:>7.1f} us "
+                  "{commits_per_second:>9.1f} commits/s "
+                  "{db_growth_bytes:>8} bytes growth".format(**run))
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+def run_shards(db_name, activity, shards, flush_interval, flush_size):
+    """ Send each (host, topic) in 'activity' through a ShardPool of
+    'shards' processes, timed from the first message until every shard
+    has written and exited. Return a dict of results.
+    """
+    commits = sum(metrics_hahmon.COMMIT_SECONDS.counts)
+    pool = shard_hahmon.ShardPool(db_name, shards, flush_interval, flush_size)
+    start = time.perf_counter()
+    for (host, topic) in activity:
+        pool.put(host, topic)
+    pool.stop()
+    elapsed = time.perf_counter() - start
+    return {"shards": shards,
+            "messages": len(activity),
+            "seconds": elapsed,
+            "messages_per_second": len(activity) / elapsed,
+            "commits": sum(metrics_hahmon.COMMIT_SECONDS.counts) - commits,
+            "coalesced": pool.coalesced,
+            "shed": pool.shed}
+
+
+def bench_shards(args):
+    lines = list(generate_load(args.hosts, args.topics, args.messages))
+    activity = edit_hahmon.split_many(b"\n".join(lines))
+    results = {"benchmark": "shards",
+               "time": int(time.time()),
+               "hosts": args.hosts,
+               "topics": args.topics,
+               "flush_interval": args.flush_interval,
+               "flush_size": args.flush_size,
+               "cpus": os.cpu_count(),
+               "runs": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for shards in range(1, args.shards + 1):
+            db_name = os.path.join(tmp, "shards{}.db".format(shards))
+            populate_topics(db_name, args.hosts, args.topics)
+            run = run_shards(db_name, activity, shards, args.flush_interval,
+                             args.flush_size)
+            run["speedup"] = (run["messages_per_second"] /
+                              results["runs"][0]["messages_per_second"]
+                              if results["runs"] else 1.0)
+            results["runs"].append(run)
+            print("{shards:>2} shards {messages:>8} msgs "
+                  "{messages_per_second:>10.0f} msgs/s x{speedup:>5.2f} "
+                  "{commits:>6} commits {coalesced:>6} coalesced "
+                  "{shed:>6} shed".format(**run))
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+def scanner_rows(size, topics, start):
+    """ Yield 'size' (host, topic, timestamp, timeout, status) rows as read
+    from host_activity, each string a new object as sqlite3 returns them.
+    """
+    for i in range(size):
+        (host, topic) = divmod(i, topics)
+        yield ("host{}".format(host),
+               "home_automation/host{}/loc{}/desc{}".format(host, topic, topic),
+               start + i % 300, 300, "alive")
+
+
+class ListScanner:
+    """ The records and heap of OverdueScanner before it kept them in
+    arrays: a list per record keyed by (host, topic) and a
+    (deadline, sequence, key) tuple per heap entry.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.records = {}
+        self.sequence = itertools.count()
+
+    def add(self, host, topic, timestamp, timeout, status="unknown"):
+        key = (host, topic)
+        self.records[key] = [int(timestamp), int(timeout), status,
+                             int(timestamp) + int(timeout)]
+        heapq.heappush(self.heap, (int(timestamp) + int(timeout),
+                                   next(self.sequence), key))
+
+
+def measure_scanner(factory, size, topics, start):
+    """ Return (bytes held, seconds to load) for a scanner made by
+    'factory' and loaded with 'size' records.
+    """
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    scanner = factory()
+    for row in scanner_rows(size, topics, start):
+        scanner.add(*row)
+    elapsed = time.perf_counter() - t0
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del scanner
+    return (current, elapsed)
+
+
+def bench_memory(args):
+    start = int(time.time())
+    results = {"benchmark": "memory",
+               "time": start,
+               "topics": args.topics,
+               "runs": []}
+    for size in args.sizes:
+        for (layout, factory) in (("lists", ListScanner),
+                                  ("arrays", scan_hahmon.OverdueScanner)):
+            (held, elapsed) = measure_scanner(factory, size, args.topics, start)
+            run = {"layout": layout, "records": size, "bytes": held,
+                   "bytes_per_record": held / size, "load_seconds": elapsed}
+            results["runs"].append(run)
+            print("{layout:<7} {records:>8} records {bytes:>12} bytes "
+                  "{bytes_per_record:>7.1f} bytes/record "
+                  "{load_seconds:>7.2f} s".format(**run))
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+def parse_args(args):
+    parser = ArgumentParser()
+    parser.add_argument("benchmark", nargs='?', default="activity",
+                        choices=["activity", "parse", "ingest", "memory",
+                                 "shards"],
+                        help="benchmark to run")
+    parser.add_argument("-n", "--messages", dest="messages", type=int,
+                        default=2000, help="number of messages to process")
+    parser.add_argument("--hosts", dest="hosts", type=int,
+                        default=50, help="number of registered hosts")
+    parser.add_argument("--topics", dest="topics", type=int,
+                        default=4, help="topics published per host (ingest)")
+    parser.add_argument("--flush_interval", dest="flush_interval", type=int,
+                        default=5, help="ActivityWriter flush interval (ingest)")
+    parser.add_argument("--flush_size", dest="flush_size", type=int,
+                        default=1000, help="ActivityWriter flush size (ingest)")
+    parser.add_argument("--sizes", dest="sizes", type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help="host/topic records to hold (memory)")
+    parser.add_argument("--shards", dest="shards", type=int,
+                        default=4, help="most shard processes (shards)")
+    parser.add_argument("-o", "--output", dest="output",
+                        help="write results as JSON to this file (ingest, "
+                        "memory, shards)")
+    return parser.parse_args(args)
+
+
+def bench_hahmon_main():
+    from sys import argv
+    args = parse_args(argv[1:])
+    if args.benchmark == "parse":
+        compare_parse(args.messages, args.hosts)
+    elif args.benchmark == "ingest":
+        bench_ingest(args)
+    elif args.benchmark == "memory":
+        bench_memory(args)
+    elif args.benchmark == "shards":
+        bench_shards(args)
+    else:
+        compare_activity(args.messages, args.hosts)
+
+
+if __name__ == "__main__":
+    bench_hahmon_main()
@@ -10,6 +10,13 @@ Usage:
     edit_hahmon.py -d <hostname> [<topic>]              # remove host from database
     edit_hahmon.py -l [<hostname>]                      # report status of listed host
                                                         python3 # or all hosts in database
+                   [--topic <topic>] [--status <status>] [--overdue <seconds>]
+                   [--after <hostname> [<topic>]] [--limit <count>]
+                   [--output text|tsv|jsonl]            # filter, page and format list
+    edit_hahmon.py -i <file> [--format csv|jsonl]       # add/update hosts from file
+    edit_hahmon.py -e <file> [--format csv|jsonl]       # write hosts to file
+                   [--log_level DEBUG|INFO|WARNING|ERROR]  # with any option,
+                                                        # logged to stderr
 
     (see parse_args() for expanded argument names.)
     For all options except -c must provide an environment variable DB_NAME_ENV to
@@ -17,21 +24,56 @@ Usage:
 
 To destroy the database simply delete the database file.
 
-Database schema - one table:
+Database schema - records are read and written through the view
+host_activity:
     host        Hostname of publisher.
-    topic       MQTT topic if one is specified.
+    topic       MQTT topic or topic filter ('+' and '#' wildcards, see
+                topic_hahmon.py) if one is specified.
     timeout     Time at which the publisher is presumed to be unresponsive.
     timestamp   Time host last published (or when added to database.)
     status      Status of this host (and perhaps topic) [unknown|alive|late]
+    deadline    timestamp + timeout, indexed so that overdue records can be
+                found with a range query 'where deadline < <now>'. A
+                monitor with adaptive timeouts writes its earlier deadline.
+    gap_mean, gap_variance, gap_max, gap_count
+                Statistics of the interval between messages (seconds),
+                maintained by the monitor (see scan_hahmon.py) and written
+                with the timestamp. NULL until known.
 
     (All fields text except for timeout and since which are integers.)
 
+    Each host and topic name is stored once, in the tables hosts and
+    topics, and the records in the table activity are keyed by the integer
+    ids of their host and topic, one record per host/topic and one per
+    host with no topic (topic id 0.) Triggers on the view insert, update
+    and delete records in the tables so that host_activity can be used as
+    a table, e.g. from the sqlite3 command line. Triggers on activity
+    count the records added, deleted or given a new timeout in the table
+    registration (see registration_version().) Existing databases are
+    upgraded when opened (see upgrade_database().)
+
+    Connections come from connect(). The database uses WAL journaling so
+    listing (which opens the database read only) and the monitor do not
+    block each other. Pragmas can be tuned with the environment variable
+    HAHMON_PRAGMAS (see DB_PRAGMAS.)
+
 """
 import sqlite3
+import collections
+import csv
+import json
+import logging
+import metrics_hahmon
 import os
+import re
 import sys
 import time
+import topic_hahmon
+import weakref
 from argparse import ArgumentParser
+from urllib.request import pathname2url
+
+logger = logging.getLogger(__name__)
 
 
 def close_connection(some_con):
@@ -39,48 +81,299 @@ def close_connection(some_con):
     some_con.close()
 
 
-def open_database(db_name):
+# Connection settings applied by connect(). Override with the environment
+# variable HAHMON_PRAGMAS, e.g. 'synchronous=FULL,cache_size=-32000'.
+# WAL lets readers (edit_hahmon.py -l) and the writer work at the same time
+# and synchronous=NORMAL is durable across application crashes in WAL mode.
+# busy_timeout (ms) is how long to wait for another writer, cache_size is
+# in pages or, if negative, KiB and mmap_size in bytes.
+DB_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": "5000",
+    "cache_size": "-8000",
+    "mmap_size": "67108864",
+}
+PRAGMAS_ENV = 'HAHMON_PRAGMAS'
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+
+def database_pragmas(environ=os.environ):
+    """ Return DB_PRAGMAS updated from the HAHMON_PRAGMAS environment
+    variable. Raises ValueError for an unknown pragma or a bad value.
+    """
+    pragmas = dict(DB_PRAGMAS)
+    for setting in filter(None, environ.get(PRAGMAS_ENV, '').split(',')):
+        (name, _, value) = setting.partition('=')
+        name = name.strip().lower()
+        value = value.strip()
+        if name not in DB_PRAGMAS or not PRAGMA_VALUE.match(value):
+            raise ValueError("bad {} setting: {}".format(PRAGMAS_ENV, setting))
+        pragmas[name] = value
+    return pragmas
+
+
+def connect(db_name, read_only=False, check_same_thread=True):
+    """ Open a connection to db_name with the configured pragmas. A read
+    only connection is opened with a 'mode=ro' URI, cannot take the write
+    lock and so never holds up the monitor. The journal mode is a
+    property of the database file and is only set by writers.
+    Raises sqlite3.Error or ValueError on failure.
+    """
+    pragmas = database_pragmas()
+    if read_only:
+        uri = "file:{}?mode=ro".format(pathname2url(os.path.abspath(db_name)))
+        conn = sqlite3.connect(uri, uri=True,
+                               check_same_thread=check_same_thread)
+        del pragmas["journal_mode"]
+    else:
+        conn = sqlite3.connect(db_name, check_same_thread=check_same_thread)
+    for (name, value) in pragmas.items():
+        conn.execute("pragma {}={}".format(name, value)).fetchall()
+    return conn
+
+
+SCHEMA_VERSION = 6     # stored in 'pragma user_version'
+
+# Records are keyed by integer ids for the host and topic names. Topic id
+# 0 stands for 'no topic'. host_activity is a view over the tables with
+# triggers so that it can be read and written as the table it replaced.
+# The single row of registration counts the records added and deleted and
+# the timeouts changed, but not the activity recorded, so that a process
+# can cheaply tell when to reload what it knows of the registered records
+# (see registration_version().)
+REGISTRATION = [
+    '''create table registration (version INTEGER NOT NULL)''',
+    '''insert into registration (version) values (0)''',
+    '''create trigger registration_insert after insert on activity
+        begin
+        update registration set version=version + 1;
+        end''',
+    '''create trigger registration_delete after delete on activity
+        begin
+        update registration set version=version + 1;
+        end''',
+    '''create trigger registration_timeout after update of timeout on activity
+        when new.timeout is not old.timeout
+        begin
+        update registration set version=version + 1;
+        end''',
+]
+# --status (and --overdue with it) are range searches on this index.
+STATUS_INDEX = '''create index activity_status on activity(status, deadline)'''
+RECORD_KEY = '''host_id=(select id from hosts where name={})
+    and topic_id=(select id from topics where name is {})'''
+SCHEMA = [
+    '''create table hosts (id INTEGER PRIMARY KEY, name TEXT NOT NULL)''',
+    '''create unique index host_name on hosts(name)''',
+    '''create table topics (id INTEGER PRIMARY KEY, name TEXT)''',
+    '''create unique index topic_name on topics(name)''',
+    '''insert into topics (id, name) values (0, NULL)''',
+    '''create table activity
+        (
+        host_id     INTEGER NOT NULL,
+        topic_id    INTEGER NOT NULL,
+        timestamp   INTEGER,
+        timeout     INTEGER,
+        status      TEXT,
+        deadline    INTEGER,
+        gap_mean    REAL,
+        gap_variance REAL,
+        gap_max     INTEGER,
+        gap_count   INTEGER,
+        PRIMARY KEY (host_id, topic_id)
+        ) WITHOUT ROWID''',
+    '''create index activity_deadline on activity(deadline)''',
+    STATUS_INDEX,
+    # names no longer used by any record are dropped
+    '''create trigger activity_delete after delete on activity
+        begin
+        delete from hosts where id=old.host_id and
+            not exists (select 1 from activity where host_id=old.host_id);
+        delete from topics where id=old.topic_id and old.topic_id != 0 and
+            not exists (select 1 from activity where topic_id=old.topic_id);
+        end''',
+] + REGISTRATION
+VIEW = [
+    '''create view host_activity as select hosts.name as host,
+        topics.name as topic, activity.timestamp as timestamp,
+        activity.timeout as timeout, activity.status as status,
+        activity.deadline as deadline, activity.gap_mean as gap_mean,
+        activity.gap_variance as gap_variance, activity.gap_max as gap_max,
+        activity.gap_count as gap_count
+        from activity join hosts on hosts.id=activity.host_id
+        join topics on topics.id=activity.topic_id''',
+    '''create trigger host_activity_insert instead of insert on host_activity
+        begin
+        insert into hosts (name) select new.host
+            where not exists (select 1 from hosts where name=new.host);
+        insert into topics (name) select new.topic
+            where new.topic is not NULL and
+            not exists (select 1 from topics where name=new.topic);
+        insert into activity
+            (host_id, topic_id, timestamp, timeout, status, deadline,
+            gap_mean, gap_variance, gap_max, gap_count)
+            values ((select id from hosts where name=new.host),
+            (select id from topics where name is new.topic), new.timestamp,
+            new.timeout, new.status,
+            ifnull(new.deadline, new.timestamp + new.timeout), new.gap_mean,
+            new.gap_variance, new.gap_max, new.gap_count);
+        end''',
+    '''create trigger host_activity_update instead of update on host_activity
+        begin
+        select raise(abort, 'host and topic cannot be changed')
+            where new.host is not old.host or new.topic is not old.topic;
+        update activity set timestamp=new.timestamp, timeout=new.timeout,
+            status=new.status, deadline=new.deadline, gap_mean=new.gap_mean,
+            gap_variance=new.gap_variance, gap_max=new.gap_max,
+            gap_count=new.gap_count
+            where {};
+        end'''.format(RECORD_KEY.format("old.host", "old.topic")),
+    '''create trigger host_activity_delete instead of delete on host_activity
+        begin
+        delete from activity where {};
+        end'''.format(RECORD_KEY.format("old.host", "old.topic")),
+]
+
+
+def create_schema(conn):
+    """ Create the SCHEMA_VERSION tables, view and triggers. """
+    for statement in SCHEMA + VIEW:
+        conn.execute(statement)
+    conn.execute('pragma user_version = {}'.format(SCHEMA_VERSION))
+
+
+def upgrade_database(conn):
+    """ Bring a database created by an earlier create_database() up to
+    SCHEMA_VERSION. A database without the host_activity table is left
+    alone. Raises sqlite3.Error on failure.
+
+    Version 1 - unique indexes on host/topic and on host for records
+                without a topic. Duplicate records are dropped, keeping the
+                last one added.
+    Version 2 - deadline column and index.
+    Version 3 - host and topic names moved to their own tables, records
+                keyed by integer ids and host_activity replaced by a view.
+                The database is vacuumed to release the space.
+    Version 4 - columns for the statistics of the interval between
+                messages.
+    Version 5 - registration counter.
+    Version 6 - index on status and deadline.
+    """
+    version = conn.execute('pragma user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    if conn.execute('''select count(*) from sqlite_master
+            where name='host_activity' ''').fetchone()[0] == 0:
+        return
+
+    if version < 1:
+        conn.execute('''delete from host_activity where rowid not in
+                (select max(rowid) from host_activity group by host, topic)''')
+        conn.execute('''create unique index if not exists host_topic
+                on host_activity(host, topic)''')
+        conn.execute('''create unique index if not exists host_only
+                on host_activity(host) where topic is NULL''')
+    if version < 2:
+        conn.execute('''alter table host_activity add column deadline INTEGER''')
+        conn.execute('''update host_activity set deadline=timestamp + timeout''')
+        conn.execute('''create index if not exists host_deadline
+                on host_activity(deadline)''')
+    if version < 3:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.execute('''insert into hosts (name) select distinct host
+                from host_activity where host is not NULL''')
+        conn.execute('''insert into topics (name) select distinct topic
+                from host_activity where topic is not NULL''')
+        conn.execute('''insert or ignore into activity
+                (host_id, topic_id, timestamp, timeout, status, deadline)
+                select hosts.id, topics.id, timestamp, timeout, status, deadline
+                from host_activity join hosts on hosts.name=host_activity.host
+                join topics on topics.name is host_activity.topic''')
+        conn.execute('''drop table host_activity''')
+        for statement in VIEW:
+            conn.execute(statement)
+    else:       # version 3 tables are created with the later changes
+        if version < 4:
+            conn.execute('''drop view host_activity''')  # and its triggers
+            for column in ("gap_mean REAL", "gap_variance REAL",
+                           "gap_max INTEGER", "gap_count INTEGER"):
+                conn.execute("alter table activity add column " + column)
+            for statement in VIEW:
+                conn.execute(statement)
+        if version < 5:
+            for statement in REGISTRATION:
+                conn.execute(statement)
+        if version < 6:
+            conn.execute(STATUS_INDEX)
+
+    conn.execute('pragma user_version = {}'.format(SCHEMA_VERSION))
+    conn.commit()
+    if version < 3:
+        conn.execute('vacuum')
+
+
+def open_database(db_name, check_same_thread=True, read_only=False):
+    """ Return a connection from connect(), upgrading the schema if
+    needed, or None on error. A read only database that needs upgrading
+    is upgraded through a writable connection first.
+    """
     try:
-        conn = sqlite3.connect(db_name)
+        conn = connect(db_name, read_only, check_same_thread)
+        if read_only:
+            if (conn.execute('pragma user_version').fetchone()[0] <
+                    SCHEMA_VERSION):
+                conn.close()
+                close_connection(open_database(db_name))
+                conn = connect(db_name, read_only, check_same_thread)
+        else:
+            upgrade_database(conn)
         return conn
-    except:
+    except Exception as msg:
+        logger.error("cannot open database=%s error=%s", db_name, msg)
         return None
 
 
 # Create table
 def create_database(db_name):
+    """ Create the database. Return an appropriate status:
+    0 - Created
+    1 - Already exists. (The schema is upgraded if needed.)
+    2 - some other error
+    """
     if os.path.isfile(db_name):
+        conn = open_database(db_name)
+        if conn is not None:
+            conn.close()
         return 1
     try:
         conn = open_database(db_name)
-        c = conn.cursor()
-
-        st = c.execute('''CREATE TABLE host_activity
-                (
-                host        TEXT,
-                topic       TEXT,
-                timestamp   INTEGER,
-                timeout     INTEGER,
-                status      TEXT
-                )''')
+        create_schema(conn)
+        close_connection(conn)
     except:
         return 2
 
     return 0
 
 
+def registration_version(cursor):
+    """ Return the registration counter, which changes when a record is
+    added or deleted or its timeout changed, unlike pragma data_version
+    which changes with every commit of recorded activity.
+    Raises sqlite3.Error on failure.
+    """
+    return cursor.execute('''select version from registration''').fetchone()[0]
+
+
 def host_match(cursor, name, topic=None):
     """ Check for matches with supplied values
     0 - no matches
     -1 - error
     n - number of matching rows (should be only 1)"""
     try:
-        if topic is None:
-            records = cursor.execute('''select count(*) from host_activity
-                where host=? and topic is NULL''', (name,))
-        else:
-            records = cursor.execute('''select count(*) from host_activity
-                where host=? and topic=?''', (name, topic,))
+        records = cursor.execute('''select count(*) from activity
+                where ''' + RECORD_KEY.format("?", "?"), (name, topic,))
         return records.fetchone()[0]
     except:
         return -1
@@ -90,28 +383,45 @@ def insert_host(db_name, name, timeout, topic=None):
     """ Add a host to the database. Return an appropriate status:
     0 - Added
     1 - duplicate - host/topic already exists.
-    2 - some other error
+    2 - some other error (including a malformed topic filter)
     """
+    if topic is not None and not topic_hahmon.valid_filter(topic):
+        logger.error("invalid topic filter=%s", topic)
+        return 2
+    try:
+        timeout = int(timeout)
+    except (TypeError, ValueError):
+        logger.error("invalid timeout=%s", timeout)
+        return 2
+
     conn = open_database(db_name)
     if conn == None:
         return 2
 
     try:
         c = conn.cursor()
-        match_result = host_match(c, name, topic)
-        if match_result == 0:
-            c.execute('''insert into host_activity values(?,?,?,?,?)''', (
-                name, topic, int(time.time()), timeout, "unknown", ))
-            # conn.commit()
+        c.execute('''insert or ignore into hosts (name) values (?)''', (name,))
+        if topic is not None:
+            c.execute('''insert or ignore into topics (name) values (?)''',
+                      (topic,))
+        # the primary key on host/topic rejects the duplicate
+        now = int(time.time())
+        c.execute('''insert or ignore into activity
+                (host_id, topic_id, timestamp, timeout, status, deadline)
+                values((select id from hosts where name=?),
+                (select id from topics where name is ?),?,?,?,?)''', (
+            name, topic, now, timeout, "unknown", now + timeout, ))
+        if c.rowcount == 1:
             rc = 0
-        elif match_result == -1:
-            rc = 2
         else:
             rc = 1
-    except:
+    except Exception as msg:
+        logger.error("insert_host error=%s", msg)
+        conn.rollback()     # no names without a record
         rc = 2
 
     close_connection(conn)
+    invalidate_unknown(name)
     return rc
 
 
@@ -127,25 +437,15 @@ def delete_host(db_name, name, topic=None):
 
     try:
         c = conn.cursor()
-        match_result = host_match(c, name, topic)
-        if match_result == 1:
-            if topic is not None:
-                rc = c.execute(
-                    '''delete from host_activity where host=? and topic=?''',
-                    (name, topic))
-            else:
-                rc = c.execute(
-                    '''delete from host_activity where host=? and topic is NULL''',
-                    (name,))
-
-            conn.commit()
+        c.execute('''delete from activity where ''' + RECORD_KEY.format("?", "?"),
+                  (name, topic))
+        conn.commit()
+        if c.rowcount == 1:
             rc = 0
-        elif match_result == -1:
-            rc = 2
         else:
             rc = 1
     except sqlite3.OperationalError as msg:
-        print("delete_host:except", msg)
+        logger.error("delete_host error=%s", msg)
         rc = 2
 
     finally:
@@ -169,28 +469,477 @@ def update_host_timeout(db_name, name, timeout, topic=None):
 
     try:
         c = conn.cursor()
-        match_result = host_match(c, name, topic)
-        if match_result == 1:
-            if topic == None:
-                c.execute('''update host_activity set timeout=?
-                        where host=? and topic is NULL''', (timeout, name, ))
-            else:
-                c.execute('''update host_activity set timeout=?
-                        where host=? and topic=?''', (timeout, name, topic,))
-            conn.commit()
+        c.execute('''update activity set timeout=?, deadline=timestamp + ?
+                where ''' + RECORD_KEY.format("?", "?"),
+                  (timeout, timeout, name, topic,))
+        conn.commit()
+        if c.rowcount == 1:
             rc = 0
-        elif match_result == -1:
-            rc = 2
         else:
             rc = 1
     except:
         rc = 2
     finally:
-        c.close()
+        close_connection(conn)
+
+    return rc
+
+
+class UnknownCache:
+    """ Bounded cache of (host, topic) pairs that activity was received for
+    but that match no record, so that repeated messages from unregistered
+    publishers are answered without a query. Entries expire 'ttl' seconds
+    after being added and the least recently used entry is dropped when
+    'maxsize' are held.
+
+    Entries for a host are dropped by insert_host() and import_hosts() in
+    this process (see invalidate_unknown()). Registrations made by another
+    process are picked up when the entry expires or, for ActivityWriter,
+    when poll() sees the registration counter change (see
+    registration_version()).
+    """
+
+    instances = weakref.WeakSet()   # for invalidate_unknown()
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()   # (host, topic) -> expiry
+        self.hits = 0
+        UnknownCache.instances.add(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        expiry = self.entries.get(key)
+        if expiry is None:
+            return False
+        if expiry <= time.monotonic():
+            self.entries.pop(key, None)
+            return False
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True
+
+    def add(self, key):
+        self.entries[key] = time.monotonic() + self.ttl
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def discard_host(self, host):
+        for key in [key for key in list(self.entries) if key[0] == host]:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def invalidate_unknown(host):
+    """ Drop cached unknown entries for 'host' now that it is registered. """
+    for cache in list(UnknownCache.instances):
+        cache.discard_host(host)
+
+
+def line_topic(line):
+    """ Return the topic (str) of an incoming message line, bytes or str:
+    everything up to the first space. Only the topic is decoded.
+    """
+    if isinstance(line, bytes):
+        return line.partition(b' ')[0].rstrip().decode('utf-8', 'replace')
+    return line.partition(' ')[0].rstrip()
+
+
+def topic_host(topic):
+    """ Return the host, the second level of an MQTT topic (str), with
+    plain partition rather than a regular expression. None if there is
+    none. The one rule for finding the host, used by split_topic(),
+    split_activity() and split_many().
+    """
+    (_, slash, rest) = topic.partition('/')
+    if not slash:
+        return None
+    return rest.partition('/')[0]
+
+
+def split_topic(topic):
+    """ Return (host, topic) as str for an MQTT topic, bytes or str.
+    Raises IndexError if there is no host.
+    """
+    if isinstance(topic, bytes):
+        topic = topic.decode('utf-8', 'replace')
+    host = topic_host(topic)
+    if host is None:
+        raise IndexError("no host in topic")
+    return (host, topic)
+
+
+def split_activity(line):
+    """ Split an incoming message line, bytes or str, into (host, topic).
+    The topic is the full MQTT topic (line_topic()) and the host is the
+    second level of that topic (topic_host()).
+    Raises IndexError if the line does not contain a usable topic.
+    Every message passes through here or split_many() once, so this is
+    where messages and parse failures are counted.
+    """
+    metrics_hahmon.MESSAGES.inc()
+    topic = line_topic(line)
+    host = topic_host(topic)
+    if host is None:
+        metrics_hahmon.PARSE_FAILURES.inc()
+        raise IndexError("no host in topic")
+    return (host, topic)
+
+
+def split_many(buffer):
+    """ Split a buffer (bytes) of newline separated lines, e.g. as read
+    from `mosquitto_sub -v`, in one call. Return a list of (host, topic)
+    as for split_activity(), skipping empty lines and lines without a
+    usable topic.
+    """
+    activity = []
+    append = activity.append
+    lines = 0
+    for line in buffer.split(b'\n'):
+        if line:
+            lines += 1
+            topic = line_topic(line)
+            host = topic_host(topic)
+            if host is not None:
+                append((host, topic))
+    metrics_hahmon.MESSAGES.inc(lines)
+    metrics_hahmon.PARSE_FAILURES.inc(lines - len(activity))
+    return activity
+
+
+# The record for host with the exact topic, else the topic filter, else no
+# topic. Parameters are host, topic, topic filter, topic.
+MATCHING_RECORD = '''host_id=(select id from hosts where name=?)
+    and topic_id in (0, (select id from topics where name=?),
+        (select id from topics where name=?))
+    order by topic_id=0, topic_id=(select id from topics where name=?) desc
+    limit 1'''
+
+
+def resolve_activity(cursor, host, topic, filters=None):
+    """ Find the record that activity on host/topic should update: the
+    exact topic, else the most specific topic filter in 'filters'
+    (topic_hahmon.TopicFilters) if given, else the host with no topic.
+    Return (status, topic, timeout) where
+    topic is the topic of the matching record (None for the host only
+    record) and timeout is its timeout. Status is
+    0 - Found
+    1 - Host/topic not found.
+    2 - some other error
+    """
+    topic_filter = filters.match(host, topic) if filters is not None else None
+    try:
+        records = cursor.execute('''select topics.name, activity.timeout
+                from activity join topics on topics.id=activity.topic_id
+                where ''' + MATCHING_RECORD,
+                                 (host, topic, topic_filter, topic,))
+        row = records.fetchone()
+    except sqlite3.Error as msg:
+        logger.error("resolve_activity error=%s", msg)
+        return (2, None, None)
+    if row is None:
+        logger.debug("no match host=%s topic=%s", host, topic)
+        metrics_hahmon.UNKNOWN.inc()
+        return (1, None, None)
+    return (0, row[0], row[1])
+
+
+def record_activity(cursor, host, topic, timestamp, filters=None):
+    """ Set the timestamp for host/topic, falling back to a matching
+    topic filter and then the host with no topic as resolve_activity().
+    Return status as for resolve_activity().
+    The caller is responsible for committing.
+    """
+    topic_filter = filters.match(host, topic) if filters is not None else None
+    try:
+        cursor.execute('''update activity set timestamp=?, deadline=? + timeout
+                where host_id=(select id from hosts where name=?)
+                and topic_id=(select topic_id from activity where ''' +
+                       MATCHING_RECORD + ")",
+                       (timestamp, timestamp, host, host, topic, topic_filter,
+                        topic,))
+    except sqlite3.Error as msg:
+        logger.error("record_activity error=%s", msg)
+        return 2
+    if cursor.rowcount == 0:
+        logger.debug("no match host=%s topic=%s", host, topic)
+        metrics_hahmon.UNKNOWN.inc()
+        return 1
+    return 0
+
+
+unknown_activity = {}   # db_name -> UnknownCache for update_host_activity()
+
+
+def update_host_activity(db_name, line):
+    ''' Update the host timestamp value for the given activity. Input string
+    looks like
+    "home_automation/brandywine/roamer/outside_temp_humidity 1536080280, 92.36, 58.06"
+    where the host name is embedded in the 'topic' In this case the topic is
+    taken to be "home_automation/brandywine/roamer/outside_temp_humidity" and
+    the host is "brandywine". The timestamp is included in these messages by
+    convention but is taken form the system monitoring the feed.
+    Return an appropriate status:
+    0 - Updated
+    1 - Host/topic not found.
+    2 - some other error
+
+    Host/topic pairs found to be unknown are remembered (UnknownCache) and
+    answered without opening the database. The topic filters registered for
+    the host are read on each call.
+
+    NB: This opens a connection for every call. A process that handles a
+    stream of messages should use ActivityWriter instead.
+    '''
+    try:
+        (host, topic) = split_activity(line)
+    except IndexError:
+        logger.warning("cannot parse line=%r", line)
+        return 2
+    unknown = unknown_activity.get(db_name)
+    if unknown is None:
+        unknown = unknown_activity[db_name] = UnknownCache()
+    if (host, topic) in unknown:
+        metrics_hahmon.UNKNOWN.inc()
+        return 1
+
+    conn = open_database(db_name)
+    if conn == None:
+        return 2
+
+    try:
+        start = time.perf_counter()
+        cursor = conn.cursor()
+        filters = topic_hahmon.TopicFilters()
+        filters.load(cursor, host)
+        rc = record_activity(cursor, host, topic, int(time.time()), filters)
+        conn.commit()
+        metrics_hahmon.COMMIT_SECONDS.observe(time.perf_counter() - start)
+        if rc == 1:
+            unknown.add((host, topic))
+    except:
+        logger.exception("DB Exception")
+        rc = 2
+    finally:
+        close_connection(conn)
 
     return rc
 
 
+class ActivityWriter:
+    """ Long lived handle for recording host activity from a stream of
+    messages. One connection is opened and held for the life of the
+    writer. The SQL text never varies so sqlite3 reuses the prepared
+    statements from the connection's statement cache on every message.
+
+    Timestamps are written behind. Each message only looks up the record
+    it applies to and notes the time in memory, coalescing repeated
+    messages for the same host/topic. The pending timestamps are written
+    in a single transaction when flush_size records are pending, when
+    flush_interval seconds have passed since the last flush (checked by
+    record() and poll()) and on commit() or close(). The defaults of 1
+    and 0 write every message immediately.
+
+    The connection may be used from a thread other than the one that
+    created the writer, but only one thread at a time may use the writer.
+
+    An optional scanner (scan_hahmon.OverdueScanner) is loaded from the
+    database, told of every activity, reconciled with the database when
+    the registrations change and checked by poll(). Status
+    changes it reports are written with the pending timestamps, as are
+    its statistics of the interval between messages and its deadline.
+
+    An optional 'alerts' (alert_hahmon.AlertDispatcher) is told of records
+    going late and of activity for hosts not in the database.
+
+    An optional 'snapshot' (snapshot_hahmon.Snapshot) restores the scanner
+    on a warm start in place of loading it from the database alone, is
+    saved by poll() and on close(). State in the snapshot newer than the
+    database is written with the first flush.
+
+    Topic filters (topic_hahmon.TopicFilters) are loaded when the writer
+    is created. Host/topic pairs that match no record are remembered in an
+    UnknownCache and answered without a query until the entry expires or
+    the host is registered in this process. Both are reloaded when poll()
+    sees that records have been added, deleted or had their timeout
+    changed (registration_version()), whether by this process or another.
+
+    'clock' replaces time.time() as the source of the current time, e.g.
+    with the simulated clock used by replay_hahmon.
+
+    update() returns the same status codes as update_host_activity().
+    commit() and close() allow the writer to be handed to
+    hahmon.close_db_connection() like a connection.
+    """
+
+    def __init__(self, db_name, flush_interval=0, flush_size=1, scanner=None,
+                 clock=None, alerts=None, snapshot=None):
+        if clock is None:
+            clock = lambda: time.time()     # looked up when called, may be patched
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.scanner = scanner
+        self.alerts = alerts
+        self.snapshot = snapshot
+        self.unknown = UnknownCache()
+        self.filters = topic_hahmon.TopicFilters()
+        self.registration = None
+        self.pending = {}       # (host, topic) -> timestamp
+        self.pending_status = {}    # (host, topic) -> status
+        self.commits = 0
+        self.last_flush = clock()
+        self.conn = open_database(db_name, check_same_thread=False)
+        if self.conn is not None:
+            self.cursor = self.conn.cursor()
+            self.registration = registration_version(self.cursor)
+            self.filters.load(self.cursor)
+            if scanner is not None and snapshot is not None:
+                for (key, (timestamp, status)) in snapshot.restore(
+                        scanner, self.cursor, clock()).items():
+                    self.pending[key] = timestamp
+                    self.pending_status[key] = status
+            elif scanner is not None:
+                scanner.load(self.cursor)
+
+    def update(self, line):
+        try:
+            (host, topic) = split_activity(line)
+        except IndexError:
+            logger.debug("cannot parse line=%r", line)
+            return 2
+        return self.record(host, topic)
+
+    def record(self, host, topic, timestamp=None):
+        """ Note activity for host and the full MQTT topic, received at
+        'timestamp' (now if None.)
+        """
+        if self.conn is None:
+            return 2
+        try:
+            now = self.clock()
+            if timestamp is None:
+                timestamp = now
+            if (host, topic) in self.unknown:
+                rc = 1
+                metrics_hahmon.UNKNOWN.inc()
+            else:
+                (rc, record_topic, timeout) = resolve_activity(
+                    self.cursor, host, topic, self.filters)
+                if rc == 1:
+                    self.unknown.add((host, topic))
+            if rc == 1 and self.alerts is not None:
+                self.alerts.unknown(host, topic)
+            if rc == 0:
+                topic = record_topic
+                key = (host, topic)
+                self.pending[key] = int(timestamp)
+                if (self.scanner is not None and
+                        self.scanner.activity(host, topic, int(timestamp), timeout)):
+                    self.pending_status[key] = "alive"
+                if (len(self.pending) >= self.flush_size or
+                        now - self.last_flush >= self.flush_interval):
+                    self.flush()
+        except:
+            logger.exception("DB Exception")
+            rc = 2
+        return rc
+
+    def poll(self):
+        """ Check the scanner for overdue records and flush if
+        flush_interval has passed. Call periodically so that pending
+        timestamps are written when messages stop arriving. The scanner
+        is first reconciled with the database if records have been added,
+        deleted or had their timeout changed.
+        Return the list of (host, topic) that became late. Alerts are sent
+        for them once the late status has been written, so not for a
+        record found to have been deleted.
+        """
+        late = []
+        now = self.clock()
+        if self.conn is not None:
+            version = registration_version(self.cursor)
+            if version != self.registration:
+                self.unknown.clear()
+                self.filters.load(self.cursor)
+                if self.scanner is not None:
+                    logger.debug("reconciled added=%d removed=%d changed=%d",
+                                 *self.scanner.reconcile(self.cursor))
+                self.registration = version
+        if self.scanner is not None:
+            late = self.scanner.check(now)
+            for key in late:
+                self.pending_status[key] = "late"
+        if late or (self.pending and
+                    now - self.last_flush >= self.flush_interval):
+            self.flush()
+        if late:    # the flush drops records deleted from the database
+            late = [key for key in late if key in self.scanner]
+            if self.alerts is not None:
+                for key in late:
+                    self.alerts.late(*key)
+        if self.snapshot is not None and self.scanner is not None:
+            self.snapshot.poll(self.scanner, now)
+        return late
+
+    def flush(self):
+        """ Write all pending timestamps and status changes in one
+        transaction.
+        """
+        self.last_flush = self.clock()
+        if self.conn is None or not (self.pending or self.pending_status):
+            return
+        start = time.perf_counter()
+        timestamps = []
+        watched = []    # with the scanner's deadline and statistics
+        for ((host, topic), timestamp) in self.pending.items():
+            stats = None
+            if self.scanner is not None:
+                stats = self.scanner.stats(host, topic)
+            if stats is None:
+                timestamps.append((timestamp, timestamp, host, topic))
+            else:
+                watched.append((timestamp, timestamp,
+                                self.scanner.effective_timeout(host, topic)) +
+                               stats + (host, topic))
+        self.cursor.executemany('''update activity
+                set timestamp=?, deadline=? + timeout
+                where ''' + RECORD_KEY.format("?", "?"), timestamps)
+        self.cursor.executemany('''update activity
+                set timestamp=?, deadline=? + min(timeout, ?), gap_mean=?,
+                gap_variance=?, gap_max=?, gap_count=?
+                where ''' + RECORD_KEY.format("?", "?"), watched)
+        for ((host, topic), status) in self.pending_status.items():
+            self.cursor.execute('''update activity set status=?
+                    where ''' + RECORD_KEY.format("?", "?"),
+                                (status, host, topic,))
+            if self.cursor.rowcount == 0:   # deleted from the database
+                self.scanner.remove(host, topic)
+        self.conn.commit()
+        metrics_hahmon.COMMIT_SECONDS.observe(time.perf_counter() - start)
+        self.commits += 1
+        self.pending.clear()
+        self.pending_status.clear()
+
+    def commit(self):
+        self.flush()
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            if self.snapshot is not None and self.scanner is not None:
+                self.snapshot.save(self.scanner, self.clock())
+            self.cursor.close()     # else the close waits for the cursor
+            self.conn.close()
+            self.conn = None
+
+
 def list_db(db_name, name=None, topic=None):
     """ Create a text list of '\n' seperated records representing
     hosts and their respective records.
@@ -200,9 +949,12 @@ def list_db(db_name, name=None, topic=None):
 
     NB: Not possible to search for records with NULL topics
         as 'topic=None' interprets as 'any'
+
+    iter_hosts() streams records with exact matching and is what
+    edit_hahmon.py -l uses.
     """
 
-    conn = open_database(db_name)
+    conn = open_database(db_name, read_only=True)
 
     if conn == None:
         return (2, "")
@@ -235,6 +987,277 @@ def list_db(db_name, name=None, topic=None):
     return rc
 
 
+LIST_COLUMNS = ("host", "topic", "timestamp", "timeout", "status", "deadline",
+                "gap_mean", "gap_variance", "gap_max", "gap_count")
+
+
+def hosts_query(host=None, topic=None, status=None, overdue=None, now=None,
+                after=None, limit=None):
+    """ Return (sql, parameters) selecting LIST_COLUMNS for iter_hosts().
+    All matches are exact. The tables are read rather than the
+    host_activity view so that the order in which they are visited can be
+    chosen. Hosts are visited in name order, so that the host_name index
+    serves the host filter, the ordering and the page boundary, unless
+    only records with a given status or overdue ones are wanted without a
+    host. Then activity is visited first, as a range search on
+    activity_status or activity_deadline, and only the matching records
+    are sorted.
+    """
+    where = []
+    parameters = []
+    if host is not None:
+        where.append("hosts.name=?")
+        parameters.append(host)
+    if topic is not None:
+        where.append("topics.name=?")
+        parameters.append(topic)
+    if status is not None:
+        where.append("activity.status=?")
+        parameters.append(status)
+    if overdue is not None:
+        if now is None:
+            now = int(time.time())
+        where.append("activity.deadline < ?")
+        parameters.append(now - overdue)
+    if after is not None:
+        (after_host, after_topic) = after
+        if after_topic is None:     # NULL sorts first
+            where.append("hosts.name >= ? and (hosts.name > ? or "
+                         "topics.name is not NULL)")
+            parameters.extend((after_host, after_host))
+        else:
+            where.append("hosts.name >= ? and (hosts.name > ? or "
+                         "topics.name > ?)")
+            parameters.extend((after_host, after_host, after_topic))
+    if host is None and (status is not None or overdue is not None):
+        tables = "activity cross join hosts"
+    else:
+        tables = "hosts cross join activity"
+    sql = ("select hosts.name, topics.name, timestamp, timeout, status, "
+           "deadline, gap_mean, gap_variance, gap_max, gap_count "
+           "from " + tables + " on activity.host_id=hosts.id "
+           "join topics on topics.id=activity.topic_id")
+    if where:
+        sql += " where " + " and ".join(where)
+    sql += " order by hosts.name, topics.name"
+    if limit is not None:
+        sql += " limit ?"
+        parameters.append(limit)
+    return (sql, parameters)
+
+
+def iter_hosts(db_name, host=None, topic=None, status=None, overdue=None,
+               now=None, after=None, limit=None):
+    """ Yield records as tuples of LIST_COLUMNS in host, topic order,
+    reading them from the database as they are consumed so that memory
+    use does not grow with the number of records.
+    host, topic, status - exact matches if not None
+    overdue - only records more than this many seconds past their
+              deadline at 'now' (default the current time)
+    after   - (host, topic) of the last record of the previous page, for
+              keyset pagination with 'limit'
+    Raises sqlite3.Error if the database cannot be read.
+    """
+    conn = open_database(db_name, read_only=True)
+    if conn == None:
+        raise sqlite3.OperationalError("cannot open " + db_name)
+    try:
+        yield from conn.execute(*hosts_query(host, topic, status, overdue,
+                                             now, after, limit))
+    finally:
+        conn.close()
+
+
+def format_hosts(records, format="text"):
+    """ Yield one line (without newline) per record from iter_hosts():
+    text  - as list_db(), followed by the mean and standard deviation of
+            the interval between messages and the longest interval once
+            one has been seen
+    tsv   - tab separated with a header line, NULL as an empty field
+    jsonl - a JSON object per record
+    """
+    if format == "tsv":
+        yield "\t".join(LIST_COLUMNS)
+    for record in records:
+        if format == "jsonl":
+            yield json.dumps(dict(zip(LIST_COLUMNS, record)))
+        elif format == "tsv":
+            yield "\t".join("" if field is None else str(field)
+                            for field in record)
+        else:
+            line = "{} {} {} {} {}".format(*record)
+            if record[6] is not None:
+                line += " interval {:.1f} sd {:.1f} max {}".format(
+                    record[6], record[7] ** 0.5, record[8])
+            yield line
+
+
+def list_overdue(db_name, now=None):
+    """ Return (status, list) of records whose deadline has passed, most
+    overdue first, formatted as for list_db(). This is a range search on
+    the deadline index and only touches the overdue records.
+    """
+    conn = open_database(db_name, read_only=True)
+
+    if conn == None:
+        return (2, "")
+
+    if now is None:
+        now = int(time.time())
+
+    try:
+        records = conn.execute('''select host, topic, timestamp, timeout, status
+            from host_activity where deadline < ? order by deadline''', (now,))
+        result_format = "{} {} {} {} {}"
+        rc = (0, [result_format.format(*rows) for rows in records])
+    except:
+        rc = (-1, "")
+    finally:
+        close_connection(conn)
+
+    return rc
+
+
+def registration_format(path, format=None):
+    """ Return 'format' or, if None, 'jsonl' or 'csv' from the extension of
+    path.
+    """
+    if format is not None:
+        return format
+    if path.endswith((".jsonl", ".json")):
+        return "jsonl"
+    return "csv"
+
+
+def read_registrations(f, format="csv"):
+    """ Read (host, topic, timeout) registrations from file object 'f',
+    either CSV rows 'host,topic,timeout' (an optional first row
+    'host,topic,timeout' is skipped) or JSON Lines objects
+    {"host": ..., "topic": ..., "timeout": ...}. An empty or missing
+    topic is None and an empty or missing timeout is 300.
+    Raises ValueError, giving the line number, for a malformed entry.
+    """
+    registrations = []
+    if format == "jsonl":
+        rows = enumerate((line for line in f if line.strip()), 1)
+    else:
+        rows = enumerate(csv.reader(f), 1)
+    for (line_no, row) in rows:
+        if not row:
+            continue
+        try:
+            if format == "jsonl":
+                row = json.loads(row)
+                (host, topic, timeout) = (row.get("host"), row.get("topic"),
+                                          row.get("timeout"))
+            else:
+                (host, topic, timeout) = (row + [None, None])[:3]
+                if line_no == 1 and row == ["host", "topic", "timeout"]:
+                    continue
+            if not host:
+                raise ValueError("no host")
+            if topic and not topic_hahmon.valid_filter(topic):
+                raise ValueError("invalid topic filter {}".format(topic))
+            timeout = int(timeout) if timeout not in (None, "") else 300
+        except (AttributeError, ValueError) as msg:
+            raise ValueError("line {}: {}".format(line_no, msg))
+        registrations.append((host, topic or None, timeout))
+    return registrations
+
+
+def import_hosts(db_name, registrations):
+    """ Add or update (host, topic, timeout) registrations in a single
+    transaction. Later duplicates of a host/topic in 'registrations' and
+    records already registered with the same timeout are skipped. Return
+    (status, counts) where counts is a dict of 'inserted', 'updated' and
+    'skipped' and status is
+    0 - Imported
+    2 - some error, nothing imported
+    """
+    counts = {"inserted": 0, "updated": 0, "skipped": 0}
+    wanted = {}
+    for (host, topic, timeout) in registrations:
+        if (host, topic) in wanted:
+            logger.warning("duplicate host=%s topic=%s skipped", host, topic)
+            counts["skipped"] += 1
+        else:
+            wanted[(host, topic)] = timeout
+
+    conn = open_database(db_name)
+    if conn == None:
+        return (2, counts)
+
+    try:
+        existing = {(host, topic): timeout for (host, topic, timeout) in
+                    conn.execute('''select host, topic, timeout
+                        from host_activity''')}
+        inserts = []
+        updates = []
+        for ((host, topic), timeout) in wanted.items():
+            if (host, topic) not in existing:
+                inserts.append((host, topic, timeout))
+            elif existing[(host, topic)] != timeout:
+                updates.append((timeout, timeout, host, topic))
+            else:
+                counts["skipped"] += 1
+        now = int(time.time())
+        conn.executemany('''insert into host_activity
+                (host, topic, timestamp, timeout, status, deadline)
+                values (?,?,?,?,'unknown',? + ?)''',
+                         [(host, topic, now, timeout, now, timeout)
+                          for (host, topic, timeout) in inserts])
+        conn.executemany('''update activity
+                set timeout=?, deadline=timestamp + ?
+                where ''' + RECORD_KEY.format("?", "?"), updates)
+        conn.commit()
+        for host in {host for (host, topic, timeout) in inserts}:
+            invalidate_unknown(host)
+        counts["inserted"] = len(inserts)
+        counts["updated"] = len(updates)
+        rc = (0, counts)
+    except sqlite3.Error as msg:
+        logger.error("import_hosts error=%s", msg)
+        conn.rollback()
+        rc = (2, counts)
+    finally:
+        conn.close()
+
+    return rc
+
+
+def export_hosts(db_name, f, format="csv"):
+    """ Write the (host, topic, timeout) registrations to file object 'f'
+    in a form read_registrations() reads back. Return (status, count).
+    """
+    conn = open_database(db_name, read_only=True)
+    if conn == None:
+        return (2, 0)
+
+    count = 0
+    try:
+        records = conn.execute('''select host, topic, timeout
+                from host_activity order by host, topic''')
+        if format == "jsonl":
+            for (host, topic, timeout) in records:
+                f.write(json.dumps({"host": host, "topic": topic,
+                                    "timeout": timeout}) + "\n")
+                count += 1
+        else:
+            out = csv.writer(f, lineterminator="\n")
+            out.writerow(("host", "topic", "timeout"))
+            for (host, topic, timeout) in records:
+                out.writerow((host, topic or "", timeout))
+                count += 1
+        rc = (0, count)
+    except sqlite3.Error as msg:
+        logger.error("export_hosts error=%s", msg)
+        rc = (2, count)
+    finally:
+        conn.close()
+
+    return rc
+
+
 test_DB_name = "hahmon.db"
 
 
@@ -245,6 +1268,13 @@ def usage_msg(name=None):
                                                     specifying topic)
     [-d | --delete <hostname> [<topic>] - delete matching host and topic
     [-l | --list [<hostname>] - list database for all hosts or selected host
+        [--topic <topic>] [--status unknown|alive|late] [--overdue <seconds>]
+        [--after <hostname> [<topic>]] [--limit <count>]
+        [--output text|tsv|jsonl]
+    [-i | --import <file>] - add or update host, topic, timeout from CSV or JSONL
+    [-e | --export <file>] - write host, topic, timeout as CSV or JSONL
+    [--format csv|jsonl] - file format for import/export (default from extension)
+    [--log_level DEBUG|INFO|WARNING|ERROR] - messages logged to stderr
     '''
 
 
@@ -270,6 +1300,38 @@ def parse_args(args):
     group.add_argument("-u", "--update_timeout",        # 3 arguments
                        dest="listhost", nargs=3, default="",
                        help="list [<hostname>]")
+    group.add_argument("-i", "--import",
+                       dest="importfile",
+                       help="import <file> of host, topic, timeout ('-' for stdin)")
+    group.add_argument("-e", "--export",
+                       dest="exportfile",
+                       help="export <file> of host, topic, timeout")
+    parser.add_argument("--topic",
+                        dest="topic",
+                        help="list only this topic")
+    parser.add_argument("--status",
+                        dest="status", choices=["unknown", "alive", "late"],
+                        help="list only records with this status")
+    parser.add_argument("--overdue",
+                        dest="overdue", type=int,
+                        help="list only records more than <seconds> overdue")
+    parser.add_argument("--after",
+                        dest="after", nargs='+',
+                        help="list from after <hostname> [<topic>] (next page)")
+    parser.add_argument("--limit",
+                        dest="limit", type=int,
+                        help="list at most <count> records")
+    parser.add_argument("--output",
+                        dest="output", choices=["text", "tsv", "jsonl"],
+                        default="text",
+                        help="list output format")
+    parser.add_argument("--format",
+                        dest="format", choices=["csv", "jsonl"],
+                        help="import/export format, default from the file name")
+    parser.add_argument("--log_level",
+                        dest="log_level", default="WARNING",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="level of messages to log (to stderr)")
 
     parsed_args = parser.parse_args(args)
 
@@ -278,6 +1340,11 @@ def parse_args(args):
         parser.error(
             '[-a|--addhost] accepts 1 to 3 arguments, not {}.'.format(len(parsed_args.addhost)))
 
+    # manual validation of arg count for --after
+    if (parsed_args.after is not None) and (len(parsed_args.after) > 2):
+        parser.error(
+            '--after accepts 1 or 2 arguments, not {}.'.format(len(parsed_args.after)))
+
     # manual validation of arg count for --delete
     if (parsed_args.delhost is not None) and (len(parsed_args.delhost) > 2):
         parser.error(
@@ -288,9 +1355,10 @@ def parse_args(args):
 
 def edit_hahmon_main():
     from sys import argv
+    import hahmon       # which imports this module
     args = parse_args(argv[1:])
-    print("args", args)
-    print(os.environ.get('HAMON_DB'))
+    hahmon.setup_logging(args.log_level)
+    logger.debug("args %s", args)   # stdout is kept for the output
 
     DB_NAME_ENV = 'DB_NAME_ENV'
 
@@ -313,7 +1381,7 @@ def edit_hahmon_main():
             print('e.g. \'export  DB_NAME_ENV=path/to/database\'')
             exit(1)
 
-        print("DB is ", hamon_db)
+        logger.debug("DB is %s", hamon_db)
         if args.addhost is not None:  # Add a host/timeout/topic
                                         # oops - no way to add timeout
             topic = None
@@ -344,10 +1412,40 @@ def edit_hahmon_main():
                 print("could not delete host:", args.delhost[
                       0], "topic:", topic, "from", hamon_db, "rc:", rc)
             exit(1)
+        elif args.importfile is not None:
+            format = registration_format(args.importfile, args.format)
+            try:
+                if args.importfile == '-':
+                    registrations = read_registrations(sys.stdin, format)
+                else:
+                    with open(args.importfile, newline='') as f:
+                        registrations = read_registrations(f, format)
+            except (OSError, ValueError) as msg:
+                print("could not read", args.importfile, msg)
+                exit(2)
+            (rc, counts) = import_hosts(hamon_db, registrations)
+            print("inserted {inserted} updated {updated} skipped {skipped}"
+                  .format(**counts))
+            exit(rc)
+        elif args.exportfile is not None:
+            format = registration_format(args.exportfile, args.format)
+            with open(args.exportfile, "w", newline='') as f:
+                (rc, count) = export_hosts(hamon_db, f, format)
+            print("exported", count, "to", args.exportfile)
+            exit(rc)
         elif args.listhost != '':
-            print("args.listhost", args.listhost)
-            entries = list_db(hamon_db, args.listhost)
-            print(entries)
+            after = None
+            if args.after is not None:
+                after = (args.after + [None])[:2]
+            try:
+                for line in format_hosts(iter_hosts(
+                        hamon_db, args.listhost, args.topic, args.status,
+                        args.overdue, after=after, limit=args.limit),
+                        args.output):
+                    print(line)
+            except sqlite3.Error as msg:
+                print("could not list", hamon_db, msg, file=sys.stderr)
+                exit(2)
 
 
 if __name__ == "__main__":
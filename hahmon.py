@@ -12,11 +12,49 @@ module paho-mqtt and the other will use an external program `mosquitto_sub`
 to receive messages from the broker.
 '''
 
-import re
 import sqlite3
 import atexit
+import collections
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+import edit_hahmon
+import replay_hahmon
+import snapshot_hahmon
+import topic_hahmon
 from argparse import ArgumentParser
 
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = "time=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s"
+
+''' setup_logging()
+Send log records from all modules through a queue to 'handler' (stderr
+by default) written by a listener thread, so logging never blocks the
+thread receiving messages on a slow stdout or journald. Messages are
+written as key=value pairs. Per message records are logged at DEBUG
+with lazy % arguments so they cost only a level check when DEBUG is off.
+Return the listener, which is stopped at exit.
+'''
+
+
+def setup_logging(level=logging.INFO, handler=None):
+    if handler is None:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, handler,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 
 def close_db_connection(some_con):
     some_con.commit()
@@ -27,32 +65,285 @@ def close_db_connection(some_con):
 
 
 def open_db_connection(db_name):
-    conn = sqlite3.connect(db_name)
+    conn = edit_hahmon.connect(db_name)
     atexit.register(close_db_connection, conn)
     c = conn.cursor()
     return (conn, c)
 
+''' open an edit_hahmon.ActivityWriter that batches timestamp updates and
+flush it at exit. 'snapshot' is (path, interval) for a
+snapshot_hahmon.Snapshot or None.
+'''
+
+
+def open_activity_writer(db_name, flush_interval=5, flush_size=1000,
+                         scanner=None, alerts=None, snapshot=None):
+    if snapshot is not None:
+        snapshot = snapshot_hahmon.Snapshot(*snapshot)
+    writer = edit_hahmon.ActivityWriter(db_name, flush_interval, flush_size,
+                                        scanner, alerts=alerts,
+                                        snapshot=snapshot)
+    atexit.register(close_db_connection, writer)
+    return writer
+
+''' open a replay_hahmon.Recorder appending to 'path' and close it at exit
+'''
+
+
+def open_recorder(path):
+    recorder = replay_hahmon.Recorder(path)
+    atexit.register(recorder.close)
+    return recorder
+
+
+''' CoalescingQueue
+Bounded queue of (host, topic, receive time) between the thread receiving
+messages and the database writer. Messages are kept in order until
+maxsize are queued. When full, the queue coalesces: queued messages are
+folded into one entry per (host, topic) holding the newest receive time,
+and later messages for a queued host/topic only update that entry. Only a
+message for a new host/topic when maxsize distinct pairs are already
+queued is shed. put() never blocks the receiving thread. The queue
+returns to keeping every message once drained.
+The counters 'coalesced' and 'shed' report the messages folded into
+another entry and the messages dropped.
+'''
+
+
+class CoalescingQueue:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.deque()   # (host, topic, timestamp)
+        self.newest = {}        # (host, topic) -> timestamp when coalescing
+        self.ready = threading.Condition()
+        self.coalesced = 0
+        self.shed = 0
+
+    def qsize(self):
+        return len(self.items) + len(self.newest)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def put(self, host, topic, timestamp):
+        with self.ready:
+            if not self.newest and len(self.items) < self.maxsize:
+                self.items.append((host, topic, timestamp))
+            else:
+                if self.items:
+                    self.coalesce()
+                key = (host, topic)
+                if key in self.newest:
+                    if timestamp > self.newest[key]:
+                        self.newest[key] = timestamp
+                    self.coalesced += 1
+                elif len(self.newest) < self.maxsize:
+                    self.newest[key] = timestamp
+                else:
+                    self.shed += 1
+                    return
+            self.ready.notify()
+
+    def coalesce(self):
+        newest = self.newest
+        for (host, topic, timestamp) in self.items:
+            key = (host, topic)
+            if key in newest:
+                self.coalesced += 1
+                if timestamp <= newest[key]:
+                    continue
+            newest[key] = timestamp
+        self.items.clear()
+
+    def get_batch(self, size, timeout):
+        """ Return up to 'size' queued messages, waiting up to 'timeout'
+        seconds for the first. An empty list means none arrived.
+        """
+        with self.ready:
+            if not self.items and not self.newest:
+                self.ready.wait(timeout)
+            batch = []
+            while self.items and len(batch) < size:
+                batch.append(self.items.popleft())
+            while self.newest and len(batch) < size:
+                key = next(iter(self.newest))
+                batch.append(key + (self.newest.pop(key),))
+            return batch
+
+
+''' IngestWorker
+Thread that writes received messages to the database so that the thread
+receiving them (e.g. the paho network thread) never waits on SQLite.
+put() only adds (host, topic, receive time) to a CoalescingQueue. The
+worker takes up to batch_size messages
+at a time, hands them to the writer (edit_hahmon.ActivityWriter) and
+polls the writer at least every poll_interval seconds.
+stats() reports queue depth, messages coalesced and shed by the queue,
+messages processed and lag, the seconds between receiving and writing
+the most recent message.
+'''
+
+
+class IngestWorker(threading.Thread):
+
+    def __init__(self, writer, queue_size=10000, batch_size=500,
+                 poll_interval=1):
+        super().__init__(name="ingest", daemon=True)
+        self.writer = writer
+        self.queue = CoalescingQueue(queue_size)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.processed = 0
+        self.lag = 0.0
+        self.running = True
+
+    def put(self, host, topic):
+        self.queue.put(host, topic, time.time())
+
+    def run(self):
+        while self.running or not self.queue.empty():
+            batch = self.queue.get_batch(self.batch_size, self.poll_interval)
+            for (host, topic, received) in batch:
+                self.writer.record(host, topic, received)
+            if batch:
+                self.processed += len(batch)
+                self.lag = time.time() - batch[-1][2]
+            for (host, topic) in self.writer.poll():
+                logger.warning("late host=%s topic=%s", host, topic)
+
+    def flush(self):
+        """ Nothing to do, messages are queued as they are put. Allows a
+        shard_hahmon.ShardPool to be used in place of a worker.
+        """
+
+    def stop(self):
+        """ Write what is queued and wait for the thread to finish. """
+        self.running = False
+        if self.is_alive():
+            self.join()
+
+    def stats(self):
+        return {"depth": self.queue.qsize(), "coalesced": self.queue.coalesced,
+                "shed": self.queue.shed, "processed": self.processed,
+                "lag": self.lag}
+
+
+''' start an IngestWorker for 'writer' and stop it at exit, before the
+writer is closed
+'''
+
+
+def start_ingest_worker(writer, queue_size=10000):
+    worker = IngestWorker(writer, queue_size)
+    worker.start()
+    atexit.register(worker.stop)
+    return worker
+
+
+''' Subscriptions
+Keep an MQTT client subscribed to only the topics registered in
+host_activity (topic_hahmon.subscriptions()) rather than to '#', so that
+messages from hosts that are not monitored are never sent to us.
+update() checks whether the registrations have changed (the counter
+from edit_hahmon.registration_version(), one cheap query that recorded
+activity does not change) and, if so, sends SUBSCRIBE for filters now wanted and
+UNSUBSCRIBE for those no longer wanted. reset() forgets what was
+subscribed so that the next update() subscribes to everything again, for
+a new connection which starts with no subscriptions. If the database
+cannot be read '#' is subscribed instead. Messages from unregistered
+hosts are then no longer received so they are not reported as unknown.
+update() and reset() may be called from different threads.
+'''
+
+
+class Subscriptions:
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.conn = None
+        self.registration = None
+        self.subscribed = set()
+        self.lock = threading.Lock()
+
+    def wanted(self):
+        """ Return the filters wanted, None if the database is unchanged. """
+        try:
+            if self.conn is None:
+                self.conn = edit_hahmon.open_database(
+                    self.db_name, check_same_thread=False, read_only=True)
+                if self.conn is None:
+                    raise sqlite3.OperationalError("cannot open " + self.db_name)
+            version = edit_hahmon.registration_version(self.conn.cursor())
+            if version == self.registration:
+                return None
+            self.registration = version
+            return topic_hahmon.subscriptions(self.conn.cursor())
+        except sqlite3.Error as msg:
+            logger.error("cannot read subscriptions error=%s", msg)
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            self.registration = None
+            return {topic_hahmon.MULTI}
+
+    def update(self, client):
+        """ Send the changes to 'client' (paho.mqtt.client.Client) and
+        return (subscribed, unsubscribed).
+        """
+        with self.lock:
+            wanted = self.wanted()
+            if wanted is None:
+                return ([], [])
+            subscribe = sorted(wanted - self.subscribed)
+            unsubscribe = sorted(self.subscribed - wanted)
+            if subscribe:
+                client.subscribe([(topic, 0) for topic in subscribe])
+            if unsubscribe:
+                client.unsubscribe(unsubscribe)
+            self.subscribed = wanted
+        if subscribe or unsubscribe:
+            logger.info("subscriptions=%d subscribed=%d unsubscribed=%d",
+                        len(wanted), len(subscribe), len(unsubscribe))
+        return (subscribe, unsubscribe)
+
+    def reset(self):
+        with self.lock:
+            self.subscribed = set()
+            self.registration = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
 
 def parse_MQTT_msg(line):
+    # Parse a line as it comes from `mosquitto_sub -v`, as bytes or str.
     # typical is
     # 'home_automation/sodus/master_bedroom/temp_humidity 1553831160, 72.50, 30.98'
-    # We ignore up to and including the first slash ('home_automation/sodus/')
-    # (which may some day be shortened to '/ha')
-    # We grab up to the next slash to ID the host ('sodus')
-    # We gab the rest of the topic ('/master_bedroom/temp_humidity')
-    # We grab the timestamp and convert to an integer. ('1553831160')
-    # Return a tuple consisting of (host, topic, timestamp,)
-    # Return None if the line cannot be parsed.
-    # Note: Whereas ...
-    fields = re.split('\W+', line)  # now split on space, comma
-    if len(fields) < 6:     # 4 portions of topic, timestamp and rest of payload
+    # The topic is separated from the payload by the first space and split
+    # by edit_hahmon.split_topic(), the parser used by the monitor.
+    # Return a tuple consisting of (host, topic, timestamp,) where topic is
+    # the rest of the topic after the host ('/master_bedroom/temp_humidity')
+    # and timestamp the first field of the payload as an integer.
+    # Return None if the topic has fewer than four levels or the timestamp
+    # is not an integer.
+    (topic, sep, payload) = line.partition(b' ' if isinstance(line, bytes)
+                                           else ' ')
+    try:
+        (host, topic) = edit_hahmon.split_topic(topic)
+    except IndexError:
+        return None
+    levels = topic.split('/', 2)
+    if len(levels) < 3 or '/' not in levels[2]:
         return None
-    host = fields[1]
-    topic = '/' + fields[2] + '/' + fields[3]
-    if len(fields) < 4:
+    try:
+        timestamp = int(payload.partition(b',' if isinstance(payload, bytes)
+                                          else ',')[0])
+    except ValueError:
         return None
-    timestamp = int(fields[4])
-    return (host, topic, timestamp,)
+    return (host, '/' + levels[2], timestamp,)
 
 ''' parse_args()
 Parse command line arguments in a testable fashion
@@ -70,6 +361,53 @@ def parse_args(args):
                         dest="broker", nargs=1,       # 1 argument
                         required=True,
                         help="MQTT broker host name")
+    parser.add_argument("-f", "--flush_interval",
+                        dest="flush_interval", type=int, default=5,
+                        help="seconds between database writes")
+    parser.add_argument("--flush_size",
+                        dest="flush_size", type=int, default=1000,
+                        help="pending host/topic updates that force a write")
+    parser.add_argument("--log_level",
+                        dest="log_level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="level of messages to log")
+    parser.add_argument("-t", "--threaded",
+                        dest="threaded", action="store_true",
+                        help="write to the database from a separate thread")
+    parser.add_argument("--queue_size",
+                        dest="queue_size", type=int, default=10000,
+                        help="messages queued for the database thread")
+    parser.add_argument("-s", "--shards",
+                        dest="shards", type=int, default=1,
+                        help="database writer processes, hosts partitioned by hash")
+    parser.add_argument("-m", "--metrics",
+                        dest="metrics", default=None,
+                        help="export metrics to this file or to unix:<socket>")
+    parser.add_argument("--alert_command",
+                        dest="alert_command", default=None,
+                        help="command to send alerts, e.g. sa.sh (no alerts if not given)")
+    parser.add_argument("--alert_window",
+                        dest="alert_window", type=int, default=30,
+                        help="seconds to collect alerts into one message")
+    parser.add_argument("--alert_interval",
+                        dest="alert_interval", type=int, default=3600,
+                        help="minimum seconds between alerts for a host")
+    parser.add_argument("--subscribe_all",
+                        dest="subscribe_all", action="store_true",
+                        help="subscribe to '#' rather than to the registered hosts/topics")
+    parser.add_argument("--snapshot",
+                        dest="snapshot", default=None,
+                        help="save host state to this file for a warm restart")
+    parser.add_argument("--snapshot_interval",
+                        dest="snapshot_interval", type=int, default=60,
+                        help="seconds between snapshots")
+    parser.add_argument("--record",
+                        dest="record", default=None,
+                        help="append received messages to this file for replay_hahmon.py")
+    parser.add_argument("--adaptive",
+                        dest="adaptive", type=float, default=None,
+                        help="deadlines from the usual interval between messages, "
+                        "allowing this many standard deviations (timeout is the limit)")
 
     parsed_args = parser.parse_args(args)
 
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Metrics for the home automation host monitor.
+
+Counters and histograms are kept in a registry in the process and
+exported in the Prometheus text format, either written to a file (for
+the node exporter textfile collector) or served to anyone connecting to
+a Unix socket, e.g.
+    socat - UNIX-CONNECT:/run/hahmon.sock
+
+Recording is on the per message path so it is kept cheap: a counter is
+an integer attribute and a histogram has fixed buckets found with
+bisect. Updates are not locked. Under the GIL an increment racing with
+another thread can be lost, which is acceptable for monitoring.
+
+The metrics recorded by the monitor are created here so that every
+module shares them. A process that records for another, such as a shard
+(shard_hahmon), sends the changes since it last reported (changes())
+for the other process to merge() into the registry it exports.
+"""
+
+import atexit
+import bisect
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a quick commit on an SSD to an SD card having a bad day
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def state(self):
+        return self.value
+
+    def change(self, state):
+        """ Return the increase since 'state', None if none. """
+        return (self.value - state) or None
+
+    def merge(self, change):
+        self.value += change
+
+    def render(self):
+        return ["# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} counter".format(self.name),
+                "{} {}".format(self.name, self.value)]
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)     # last is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def state(self):
+        return (tuple(self.counts), self.sum)
+
+    def change(self, state):
+        """ Return the observations since 'state' as (counts, sum), None if
+        none.
+        """
+        counts = [now - then for (now, then) in zip(self.counts, state[0])]
+        if not any(counts):
+            return None
+        return (counts, self.sum - state[1])
+
+    def merge(self, change):
+        for (i, count) in enumerate(change[0]):
+            self.counts[i] += count
+        self.sum += change[1]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} histogram".format(self.name)]
+        total = 0
+        for (bound, count) in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound,
+                                                          total))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, total))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}   # name -> Counter or Histogram, in creation order
+
+    def add(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def state(self):
+        """ Return the value of every metric, for changes(). """
+        return {name: metric.state()
+                for (name, metric) in list(self.metrics.items())}
+
+    def changes(self, state):
+        """ Return ({name: change}, state) with the metrics that changed
+        since 'state' (from state() or the last call) and the state to pass
+        next time. The changes can be sent to another process to merge().
+        """
+        current = {}
+        changes = {}
+        for (name, metric) in list(self.metrics.items()):
+            current[name] = metric.state()
+            if name in state:
+                change = metric.change(state[name])
+                if change is not None:
+                    changes[name] = change
+        return (changes, current)
+
+    def merge(self, changes):
+        """ Add changes() from another process. """
+        for (name, change) in changes.items():
+            metric = self.metrics.get(name)
+            if metric is not None:
+                metric.merge(change)
+
+    def render(self):
+        """ Return all metrics in the Prometheus text format. """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+MESSAGES = registry.counter("hahmon_messages_received_total",
+                            "MQTT messages received.")
+PARSE_FAILURES = registry.counter("hahmon_parse_failures_total",
+                                  "Messages without a usable topic.")
+UNKNOWN = registry.counter("hahmon_unknown_total",
+                           "Messages for a host/topic not in the database.")
+COMMIT_SECONDS = registry.histogram("hahmon_commit_seconds",
+                                    "Time to write and commit activity.")
+CONNECTS = registry.counter("hahmon_mqtt_connects_total",
+                            "Connections to the MQTT broker.")
+RECONNECTS = registry.counter("hahmon_mqtt_reconnects_total",
+                              "Reconnects after inactivity or an error.")
+
+
+def write_file(path, registry=registry):
+    """ Write the metrics to 'path', replacing it atomically so that a
+    reader never sees a partial file.
+    """
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp, "w") as f:
+        f.write(registry.render())
+    os.replace(temp, path)
+
+
+class FileExporter(threading.Thread):
+    """ Write the metrics to a file every 'interval' seconds. """
+
+    def __init__(self, path, interval=15, registry=registry):
+        super().__init__(name="metrics", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_file(self.path, self.registry)
+        except OSError as msg:
+            logger.error("cannot write metrics path=%s error=%s",
+                         self.path, msg)
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
+
+
+class SocketExporter(threading.Thread):
+    """ Send the metrics to each client that connects to the Unix socket
+    at 'path' and close the connection.
+    """
+
+    def __init__(self, path, registry=registry):
+        super().__init__(name="metrics", daemon=True)
+        self.path = path
+        self.registry = registry
+        if os.path.exists(path):
+            os.unlink(path)     # left by a previous run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+
+    def run(self):
+        while True:
+            try:
+                (conn, _) = self.sock.accept()
+            except OSError:
+                return      # closed by stop()
+            with conn:
+                try:
+                    conn.sendall(self.registry.render().encode())
+                except OSError as msg:
+                    logger.debug("metrics client error=%s", msg)
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)    # wakes accept()
+        except OSError:
+            pass
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def start_exporter(target, interval=15):
+    """ Export the metrics to 'target', either 'unix:<path>' for a Unix
+    socket or the path of a file rewritten every 'interval' seconds.
+    Return the exporter thread, which is stopped at exit.
+    """
+    if target.startswith("unix:"):
+        exporter = SocketExporter(target[len("unix:"):])
+    else:
+        exporter = FileExporter(target, interval)
+    exporter.start()
+    atexit.register(exporter.stop)
+    return exporter
@@ -1,28 +1,164 @@
-import re
-
-
-'''
-Parse a line as it comes from mosquitto_sub program
-'''
-
-
-def parse_MQTT_msg(line):
-    # typical is
-    # 'home_automation/sodus/master_bedroom/temp_humidity 1553831160, 72.50, 30.98'
-    # We ignore up to and including the first slash ('home_automation/sodus/')
-    # (which may some day be shortened to '/ha')
-    # We grab up to the next slash to ID the host ('sodus')
-    # We gab the rest of the topic ('/master_bedroom/temp_humidity')
-    # We grab the timestamp and convert to an integer. ('1553831160')
-    # Return a tuple consisting of (host, topic, timestamp,)
-    # Return None if the line cannot be parsed.
-    # Note: Whereas ...
-    fields = re.split('\W+', line)  # now split on space, comma
-    if len(fields) < 6:     # 4 portions of topic, timestamp and rest of payload
-        return None
-    host = fields[1]
-    topic = '/' + fields[2] + '/' + fields[3]
-    if len(fields) < 4:
-        return None
-    timestamp = int(fields[4])
-    return (host, topic, timestamp,)
+#!/usr/bin/env python3
+"""
+Receive MQTT messages by reading the output of the Mosquitto client
+`mosquitto_sub -v` and update the host monitor database.
+
+mosquitto_sub handles the broker connection and reconnects on its own.
+Should it exit it is started again. The database writer and overdue
+scanner live in this process and are kept across restarts.
+
+With --shards N, lines are sent to N processes that each write the
+database for a share of the hosts (see shard_hahmon.)
+
+With --threaded, lines are queued for a hahmon.IngestWorker thread that
+writes the database, so reading from mosquitto_sub never waits on SQLite
+and a burst of messages is coalesced rather than backing up the pipe.
+
+Output is read in large blocks and each block of complete lines is split
+in one call (edit_hahmon.split_many()). Lines look like
+    'home_automation/sodus/master_bedroom/temp_humidity 1553831160, 72.50, 30.98'
+"""
+
+import hahmon
+import alert_hahmon
+import edit_hahmon
+import metrics_hahmon
+import scan_hahmon
+import shard_hahmon
+import logging
+import os
+import select
+import subprocess
+import time
+from sys import argv
+
+logger = logging.getLogger(__name__)
+
+
+READ_SIZE = 64 * 1024   # bytes per read from mosquitto_sub
+MAX_LINE = 1024 * 1024  # longest line kept, longer lines are discarded
+
+
+def read_batches(fd, timeout=1, size=READ_SIZE, max_line=MAX_LINE):
+    """ Read from file descriptor 'fd' and yield the complete lines
+    received by each read as one newline separated buffer (bytes), for
+    edit_hahmon.split_many(). An empty buffer is yielded when nothing
+    arrives within 'timeout' seconds so that the caller can do periodic
+    work. A line without a newline at end of file is yielded before
+    returning. A line longer than 'max_line' bytes is discarded with a
+    warning rather than held in memory until its newline arrives.
+    """
+    partial = b''
+    discarding = False      # within a line that is too long
+    while True:
+        (ready, _, _) = select.select([fd], [], [], timeout)
+        if not ready:
+            yield b''
+            continue
+        block = os.read(fd, size)
+        if not block:
+            if partial:
+                yield partial
+            return
+        data = partial + block
+        if discarding:
+            (_, newline, data) = data.partition(b'\n')
+            if not newline:
+                continue
+            discarding = False
+        (complete, newline, partial) = data.rpartition(b'\n')
+        if len(partial) > max_line:
+            logger.warning("discarding line longer than %d bytes", max_line)
+            (partial, discarding) = (b'', True)
+        if newline:
+            yield complete
+
+
+def ingest(fd, writer, worker=None, recorder=None):
+    """ Feed lines read from 'fd' to 'writer' (edit_hahmon.ActivityWriter)
+    until end of file, polling the writer between batches. If 'worker'
+    (hahmon.IngestWorker or shard_hahmon.ShardPool) is given lines are
+    queued for it instead. Lines are also appended to 'recorder' (replay_hahmon.Recorder) if given.
+    """
+    for buffer in read_batches(fd):
+        if recorder is not None and buffer:
+            received = time.time()
+            for line in buffer.split(b'\n'):
+                if line:
+                    recorder.record_line(line, received)
+        activity = edit_hahmon.split_many(buffer)
+        if worker is not None:
+            for (host, topic) in activity:
+                worker.put(host, topic)
+            worker.flush()
+            continue
+        for (host, topic) in activity:
+            writer.record(host, topic)
+        for (host, topic) in writer.poll():
+            logger.warning("late host=%s topic=%s", host, topic)
+
+
+def mosquitto_sub_command(broker):
+    return ['mosquitto_sub', '-v', '-h', broker, '-t', '#']
+
+
+def run_mosquitto_sub(command, writer, worker=None, restart_delay=5,
+                      recorder=None):
+    """ Run 'command' and ingest its output, starting it again whenever it
+    exits. Does not return.
+    """
+    while True:
+        try:
+            proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+            ingest(proc.stdout.fileno(), writer, worker, recorder)
+            proc.stdout.close()
+            logger.warning("mosquitto_sub exited rc=%s", proc.wait())
+        except OSError as msg:
+            logger.error("cannot run command=%s error=%s", command[0], msg)
+        if worker is None:
+            writer.poll()
+        time.sleep(restart_delay)
+
+
+def mosquitto_hahmon_main():
+    args = hahmon.parse_args(argv[1:])
+    hahmon.setup_logging(args.log_level)
+    logger.info("args %s", args)
+    if args.metrics is not None:
+        metrics_hahmon.start_exporter(args.metrics)
+    recorder = None
+    if args.record is not None:
+        recorder = hahmon.open_recorder(args.record)
+
+    alerts = None
+    dispatcher = None
+    if args.alert_command is not None:
+        alerts = (args.alert_command, args.alert_window, args.alert_interval)
+        if args.shards <= 1:
+            dispatcher = alert_hahmon.start_alert_dispatcher(*alerts)
+    snapshot = None
+    if args.snapshot is not None:
+        snapshot = (args.snapshot, args.snapshot_interval)
+
+    writer = None
+    worker = None
+    if args.shards > 1:
+        worker = shard_hahmon.start_shard_pool(args.db_name[0], args.shards,
+                                               args.flush_interval,
+                                               args.flush_size, args.log_level,
+                                               alerts, snapshot, args.adaptive)
+    else:
+        writer = hahmon.open_activity_writer(args.db_name[0],
+                                             args.flush_interval,
+                                             args.flush_size,
+                                             scan_hahmon.OverdueScanner(
+                                                 adaptive=args.adaptive),
+                                             dispatcher, snapshot)
+    if args.threaded and worker is None:
+        worker = hahmon.start_ingest_worker(writer, args.queue_size)
+    run_mosquitto_sub(mosquitto_sub_command(args.broker[0]), writer, worker,
+                      recorder=recorder)
+
+
+if __name__ == "__main__":
+    mosquitto_hahmon_main()
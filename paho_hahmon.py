@@ -20,47 +20,49 @@ The topic includes the host name as the second field. For example:
 
 """
 import hahmon
-import re
+import alert_hahmon
+import edit_hahmon
+import metrics_hahmon
+import scan_hahmon
+import shard_hahmon
+import logging
 import os
 import time
 from sys import argv
 
-# db_name = 'home_automation-MQTT.db'
-
-
-'''
-Parse the topic and payload to extract host, rest of topic and timestamp.
-e g for
-    topic 'home_automation/sodus/master_bedroom/temp_humidity'
-    payload '1553884981, 70.95, 29.16'
-return ('sodus', '/master_bedroom/temp_humidity', 1553884981)
-'''
+logger = logging.getLogger(__name__)
 
+# db_name = 'home_automation-MQTT.db'
 
-def parse_MQTT_msg(topic, payload):
-    topic = re.split('\W+', topic)  # now split on space, comma
-    host = topic[1]
-    topic = '/' + topic[2] + '/' + topic[3]
-    payload = re.split('\W+', payload)  # now split on space, comma
-    timestamp = int(payload[0])
-    return (host, topic, timestamp)
 
 # copied from https://www.eclipse.org/paho/clients/python/
 import paho.mqtt.client as mqtt
 
 
 last_activity_sec = 0
+writer = None   # hahmon.open_activity_writer() in paho_hahmon_main()
+worker = None   # hahmon.start_ingest_worker() when --threaded
+recorder = None     # replay_hahmon.Recorder when --record
+subscriptions = None    # hahmon.Subscriptions unless --subscribe_all
+STATS_INTERVAL = 60     # seconds between logging worker stats
+SUBSCRIPTIONS_INTERVAL = 1  # seconds between checks for new registrations
 
 # The callback for when the client receives a CONNACK response from the server.
 
 
 def on_connect(client, userdata, flags, rc):
-    print("Connected with result code " + str(rc))
+    logger.info("connected rc=%s", rc)
+    metrics_hahmon.CONNECTS.inc()
     global last_activity_sec
     last_activity_sec = int(time.time())
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
     # client.subscribe("$SYS/#")
+    if subscriptions is None:
+        client.subscribe("#")   # subscribe to everything
+    else:
+        subscriptions.reset()   # a new session has no subscriptions
+        subscriptions.update(client)
 
 # The callback for when a PUBLISH message is received from the server.
 
@@ -68,12 +70,17 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     global last_activity_sec
     last_activity_sec = int(time.time())
-    # payload=str(msg.payload)
-    payload = msg.payload.decode("utf-8")
-    print("payload \'" + payload + '\'')
-    print("topic \'" + msg.topic + '\'')
-    print(parse_MQTT_msg(msg.topic, payload))
-    print()
+    if recorder is not None:
+        recorder.record(msg.topic, msg.payload)
+    logger.debug("message topic=%r payload=%r", msg.topic, msg.payload)
+    try:
+        (host, topic) = edit_hahmon.split_activity(msg.topic)
+        if worker is not None:
+            worker.put(host, topic)     # written by the worker thread
+        else:
+            writer.record(host, topic)
+    except IndexError:
+        logger.debug("no host topic=%r", msg.topic)
     # print(msg.topic+" "+payload)
     #(root, host, location, description) = msg.topic.split('/')
     # print("topic fields", root, host, location, description)
@@ -103,11 +110,11 @@ def on_message(client, userdata, msg):
 
 
 def on_publish(client, userdata, mid):
-    print("on_publish(", client, userdata, mid, ")")
+    logger.debug("on_publish mid=%s", mid)
 
 
 def on_subscribe(client, userdata, mid, granted_qos):
-    print("on_subscribe()")
+    logger.debug("on_subscribe mid=%s granted_qos=%s", mid, granted_qos)
 
 '''
 def insert_data(timestamp, host, location, description, payload):
@@ -118,41 +125,122 @@ def insert_data(timestamp, host, location, description, payload):
 '''
 
 
+def paho_hahmon_threaded(client, args):
+    ''' Let paho's network thread (loop_start()) receive messages and
+    queue them for an ingest worker thread that writes the database, so a
+    slow write never holds up the socket. With --shards the worker is a
+    shard_hahmon.ShardPool started by the caller. This thread watches for
+    inactivity, flushes the worker and logs its stats. Does not return.
+    '''
+    global worker
+    global last_activity_sec
+    if worker is None:
+        worker = hahmon.start_ingest_worker(writer, args.queue_size)
+
+    client.connect_async(args.broker[0], 1883, keepalive=60)
+    client.loop_start()     # reconnects on its own
+    last_stats = time.time()
+    while(1):
+        time.sleep(1)
+        worker.flush()
+        if subscriptions is not None:
+            subscriptions.update(client)
+        now = time.time()
+        if last_activity_sec != 0 and (int(now) - last_activity_sec) > 90:
+            last_activity_sec = 0
+            logger.warning("no activity, reconnecting")
+            metrics_hahmon.RECONNECTS.inc()
+            try:
+                client.reconnect()
+            except Exception as Argument:
+                logger.error("exception=%s", Argument)
+        if now - last_stats >= STATS_INTERVAL:
+            last_stats = now
+            logger.info("ingest depth=%(depth)d coalesced=%(coalesced)d "
+                        "shed=%(shed)d processed=%(processed)d lag=%(lag).3f",
+                        worker.stats())
+
+
 def paho_hahmon_main():
     args = hahmon.parse_args(argv[1:])
-    print("args", args)
+    hahmon.setup_logging(args.log_level)
+    logger.info("args %s", args)
+    if args.metrics is not None:
+        metrics_hahmon.start_exporter(args.metrics)
+    if args.record is not None:
+        global recorder
+        recorder = hahmon.open_recorder(args.record)
+
+    alerts = None
+    dispatcher = None
+    if args.alert_command is not None:
+        alerts = (args.alert_command, args.alert_window, args.alert_interval)
+        if args.shards <= 1:
+            dispatcher = alert_hahmon.start_alert_dispatcher(*alerts)
+    snapshot = None
+    if args.snapshot is not None:
+        snapshot = (args.snapshot, args.snapshot_interval)
+
+    if not args.subscribe_all:
+        global subscriptions
+        subscriptions = hahmon.Subscriptions(args.db_name[0])
 
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
 
-    (conn, cursor) = hahmon.open_db_connection(args.db_name[0])
+    if args.shards > 1:
+        global worker
+        worker = shard_hahmon.start_shard_pool(args.db_name[0], args.shards,
+                                               args.flush_interval,
+                                               args.flush_size, args.log_level,
+                                               alerts, snapshot, args.adaptive)
+        paho_hahmon_threaded(client, args)
+
+    global writer
+    writer = hahmon.open_activity_writer(args.db_name[0],
+                                         args.flush_interval, args.flush_size,
+                                         scan_hahmon.OverdueScanner(
+                                             adaptive=args.adaptive),
+                                         dispatcher, snapshot)
+
+    if args.threaded:
+        paho_hahmon_threaded(client, args)
 
     global last_activity_sec
+    last_subscriptions = time.time()
 
     while(1):
         try:
             client.connect(args.broker[0], 1883, keepalive=60)
                            # connect to my MQTT server
 
-            client.subscribe("#")   # subscribe to everything for now
             # Blocking call that processes network traffic, dispatches callbacks and
             # handles reconnecting.
             # Other loop*() functions are available that give a threaded interface and a
             # manual interface. (changed to non-blocking call)
             while(1):
                 client.loop()
+                # write pending timestamps when traffic stops
+                for (host, topic) in writer.poll():
+                    logger.warning("late host=%s topic=%s", host, topic)
+                if (subscriptions is not None and
+                        time.time() - last_subscriptions >= SUBSCRIPTIONS_INTERVAL):
+                    last_subscriptions = time.time()
+                    subscriptions.update(client)
                 if last_activity_sec != 0 and (int(time.time()) - last_activity_sec) > 90:
                     last_activity_sec = 0
-                    print("last_activity_sec disconnect exercised")
+                    logger.warning("no activity, disconnecting")
+                    metrics_hahmon.RECONNECTS.inc()
                     client.disconnect()
                     break
 
             # end of included code
-            print("finished loop")  # Shouldn't get here, no?
+            logger.info("finished loop")  # Shouldn't get here, no?
 
         except Exception as Argument:
-            print("Exception", Argument)
+            logger.error("exception=%s", Argument)
+            metrics_hahmon.RECONNECTS.inc()
             time.sleep(5)
 
 
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Record the MQTT stream received by the host monitor and replay it
+through the ingest pipeline without a broker, to reproduce an incident
+or to load test with real traffic.
+
+Usage:
+    paho_hahmon.py|mosquitto_hahmon.py ... --record <path/to/recording>
+    replay_hahmon.py -d <path/to/db> -r <path/to/recording> [-s <speed>]
+
+The replayer feeds the recorded messages to an edit_hahmon.ActivityWriter
+with an overdue scanner, both running on a simulated clock that follows
+the recorded receive times. With a speed of 1 messages arrive with their
+recorded spacing, N replays N times faster and 0 (the default) replays as
+fast as possible. The clock still steps through gaps between messages so
+that hosts going quiet are reported late as they were live.
+
+Recording file format - append only, little endian:
+    header      b'HAHMREC1'
+    records     receive time (double), topic length (uint16),
+                payload length (uint32), topic, payload
+A record cut short by a crash while recording is ignored on replay.
+"""
+
+import edit_hahmon
+import scan_hahmon
+import logging
+import mmap
+import os
+import struct
+import time
+from argparse import ArgumentParser
+from sys import argv
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HAHMREC1'
+RECORD = struct.Struct("<dHI")  # receive time, topic length, payload length
+
+
+class Recorder:
+    """ Append received messages to a recording file. Writes are buffered,
+    call flush() or close() to make sure they reach the file.
+    """
+
+    def __init__(self, path, buffering=64 * 1024):
+        self.file = open(path, "ab", buffering=buffering)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.count = 0
+
+    def record(self, topic, payload, receive_time=None):
+        """ Append one message. topic and payload may be str or bytes. """
+        if receive_time is None:
+            receive_time = time.time()
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.file.write(RECORD.pack(receive_time, len(topic), len(payload)))
+        self.file.write(topic)
+        self.file.write(payload)
+        self.count += 1
+
+    def record_line(self, line, receive_time=None):
+        """ Append a 'topic payload' line, str or bytes, as output by
+        `mosquitto_sub -v`
+        """
+        (topic, _, payload) = line.partition(b' ' if isinstance(line, bytes)
+                                             else ' ')
+        self.record(topic, payload, receive_time)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(path):
+    """ Yield (receive time, topic (str), payload (bytes)) for each message
+    in the recording at 'path', which is memory mapped rather than read.
+    Raises ValueError if the file is not a recording.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            if f.read() not in (b'', MAGIC):
+                raise ValueError("not a recording: {}".format(path))
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a recording: {}".format(path))
+            offset = len(MAGIC)
+            end = len(buf)
+            while offset + RECORD.size <= end:
+                (receive_time, topic_len, payload_len) = RECORD.unpack_from(
+                    buf, offset)
+                offset += RECORD.size
+                if offset + topic_len + payload_len > end:
+                    logger.warning("truncated record offset=%d", offset)
+                    return
+                topic = buf[offset:offset + topic_len].decode('utf-8', 'replace')
+                offset += topic_len
+                payload = buf[offset:offset + payload_len]
+                offset += payload_len
+                yield (receive_time, topic, payload)
+
+
+class SimulatedClock:
+    """ Current time for the replay, set as the recording is played. """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def rewind(scanner, start):
+    """ Treat records in 'scanner' heard from after 'start', e.g. loaded
+    from a copy of the live database, as heard from at 'start' so that
+    their deadlines fall within a replay beginning then.
+    """
+    for ((host, topic), (timestamp, timeout, status)) in scanner.items():
+        if timestamp > start:
+            scanner.add(host, topic, start, timeout, status)
+
+
+def replay(messages, writer, clock, speed=0, step=1):
+    """ Feed (receive time, topic, payload) 'messages' to 'writer'
+    (edit_hahmon.ActivityWriter created with 'clock'), setting the clock
+    to each receive time. Between messages the clock advances 'step'
+    seconds at a time, polling the writer so overdue records are found.
+    'speed' is the playback speed, 0 for as fast as possible.
+    Return a dict of counts and the list of (time, host, topic) that went
+    late.
+    """
+    stats = {"messages": 0, "unknown": 0, "errors": 0, "late": []}
+    wall_start = time.perf_counter()
+    sim_start = None
+    for (receive_time, topic, payload) in messages:
+        if sim_start is None:
+            sim_start = clock.now = receive_time
+        while clock.now + step <= receive_time:
+            clock.now += step
+            pace(clock.now - sim_start, wall_start, speed)
+            for (host, late_topic) in writer.poll():
+                stats["late"].append((clock.now, host, late_topic))
+        pace(receive_time - sim_start, wall_start, speed)
+        clock.now = receive_time
+        try:
+            (host, topic) = edit_hahmon.split_activity(topic)
+        except IndexError:
+            stats["errors"] += 1
+            continue
+        rc = writer.record(host, topic, receive_time)
+        stats["messages"] += 1
+        if rc == 1:
+            stats["unknown"] += 1
+        elif rc == 2:
+            stats["errors"] += 1
+    for (host, late_topic) in writer.poll():
+        stats["late"].append((clock.now, host, late_topic))
+    writer.flush()
+    stats["seconds"] = time.perf_counter() - wall_start
+    return stats
+
+
+def pace(sim_elapsed, wall_start, speed):
+    """ Sleep until 'sim_elapsed' simulated seconds have been played at
+    'speed'. """
+    if speed:
+        delay = sim_elapsed / speed - (time.perf_counter() - wall_start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_args(args):
+
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--db_name",
+                        dest="db_name", required=True,
+                        help="/path/to/database")
+    parser.add_argument("-r", "--recording",
+                        dest="recording", required=True,
+                        help="/path/to/recording")
+    parser.add_argument("-s", "--speed",
+                        dest="speed", type=float, default=0,
+                        help="playback speed, 0 for as fast as possible")
+    parser.add_argument("-f", "--flush_interval",
+                        dest="flush_interval", type=int, default=5,
+                        help="simulated seconds between database writes")
+    parser.add_argument("--flush_size",
+                        dest="flush_size", type=int, default=1000,
+                        help="pending host/topic updates that force a write")
+    parser.add_argument("--adaptive",
+                        dest="adaptive", type=float, default=None,
+                        help="adaptive timeouts as for the monitor")
+
+    return parser.parse_args(args)
+
+
+def replay_hahmon_main():
+    args = parse_args(argv[1:])
+    clock = SimulatedClock()
+    messages = read_recording(args.recording)
+    first = next(messages, None)
+    if first is None:
+        print("no messages in", args.recording)
+        return 1
+    clock.now = first[0]
+    scanner = scan_hahmon.OverdueScanner(adaptive=args.adaptive)
+    writer = edit_hahmon.ActivityWriter(args.db_name, args.flush_interval,
+                                        args.flush_size, scanner, clock)
+    if writer.conn is None:
+        return 2
+    rewind(scanner, clock.now)
+
+    def all_messages():
+        yield first
+        yield from messages
+
+    stats = replay(all_messages(), writer, clock, args.speed)
+    writer.close()
+    for (when, host, topic) in stats["late"]:
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)),
+              "late", host, topic)
+    print("{} messages in {:.2f} s ({:.0f}/s), {} unknown, {} errors, "
+          "{} late".format(stats["messages"], stats["seconds"],
+                           stats["messages"] / max(stats["seconds"], 1e-9),
+                           stats["unknown"], stats["errors"],
+                           len(stats["late"])))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(replay_hahmon_main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Detect overdue hosts for the home automation host monitor.
+
+Rather than periodically scanning the database and comparing
+timestamp + timeout for every record, the monitor keeps the deadline for
+each host/topic in a priority queue (heap) ordered by deadline. Activity
+only records the new timestamp. check() looks at the head of the queue
+and so only touches records whose deadline has passed. Each record has at
+most one live entry in the queue. An entry that comes due for a record
+that has since been heard from is pushed back with the new deadline.
+
+Status for each record follows the status column of host_activity:
+    unknown     Added to the database and not yet heard from.
+    alive       Heard from before the deadline.
+    late        Deadline passed without activity.
+Only transitions are reported so the database is only written when a
+status changes.
+
+Records are kept compactly so that a monitor watching a million topics
+does not need a Python object per field. Each host/topic key is interned
+and given an integer id, and the fields live in parallel arrays indexed
+by id. A heap entry is a single integer, deadline << ID_BITS | id. Ids of
+removed records are reused. get() and items() return the fields as
+(timestamp, timeout, status) tuples made when asked for.
+
+Each activity also updates streaming statistics of the interval between
+messages for the record, in constant time and without keeping the
+messages: an exponentially weighted moving average (EWMA) of the
+interval, its variance and the longest interval seen. The EWMA gives
+each new interval a weight of GAP_ALPHA, as TCP's smoothed round trip
+time does. Messages in the same second as the last are part of the same
+burst and are not counted. The interval that ends with a late record
+coming back is an outage, so it only counts toward the longest interval.
+A record added from the database or a snapshot keeps the statistics
+stored with it, but the interval to its first message in this run is not
+counted at all since it spans time that the monitor was not running.
+
+With 'adaptive' set, the deadline of a record with at least MIN_GAPS
+intervals is
+    timestamp + 2 * mean + adaptive * standard deviation
+which allows one message to be missed plus 'adaptive' standard
+deviations of jitter. The timeout set for the record is still the
+longest allowed.
+"""
+
+import array
+import heapq
+import math
+import sys
+
+STATUSES = ("unknown", "alive", "late")
+STATUS_CODES = {status: code for (code, status) in enumerate(STATUSES)}
+UNKNOWN = STATUS_CODES["unknown"]
+ALIVE = STATUS_CODES["alive"]
+LATE = STATUS_CODES["late"]
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+NOT_QUEUED = -1     # deadline of a record with no live heap entry
+GAP_ALPHA = 0.125   # weight of a new interval in the moving average
+MIN_GAPS = 8        # intervals seen before an adaptive deadline is used
+NOT_HEARD = -1      # gap count of a record with no message seen
+
+
+def intern_key(host, topic):
+    return (sys.intern(host), sys.intern(topic) if topic is not None else None)
+
+
+class OverdueScanner:
+
+    def __init__(self, owns=None, adaptive=None):
+        self.owns = owns        # host -> bool, records load() keeps; all if None
+        self.adaptive = adaptive    # standard deviations allowed, or None
+        self.heap = []          # deadline << ID_BITS | id
+        self.ids = {}           # (host, topic) -> id
+        self.keys = []          # id -> (host, topic), None if free
+        self.free = []          # ids of removed records
+        self.timestamps = array.array('q')
+        self.timeouts = array.array('q')
+        self.statuses = array.array('b')
+        self.queued = array.array('q')  # deadline of the live heap entry
+        self.gap_means = array.array('d')
+        self.gap_variances = array.array('d')
+        self.gap_maxes = array.array('q')
+        self.gap_counts = array.array('q')  # intervals in the mean
+        self.heard = array.array('b')   # 1 once a message is seen this run
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(list(self.ids))
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def get(self, host, topic):
+        """ Return (timestamp, timeout, status) for a record or None. """
+        i = self.ids.get((host, topic))
+        if i is None:
+            return None
+        return (self.timestamps[i], self.timeouts[i],
+                STATUSES[self.statuses[i]])
+
+    def stats(self, host, topic):
+        """ Return (gap_mean, gap_variance, gap_max, gap_count) for a record
+        or None. gap_count is None if no message has been seen and the
+        others are None until an interval has been.
+        """
+        i = self.ids.get((host, topic))
+        if i is None:
+            return None
+        count = self.gap_counts[i]
+        if count == NOT_HEARD:
+            return (None, None, None, None)
+        return (self.gap_means[i] if count else None,
+                self.gap_variances[i] if count else None,
+                self.gap_maxes[i] or None, count)
+
+    def effective_timeout(self, host, topic):
+        """ Return the timeout that sets the deadline of a record, or None.
+        """
+        i = self.ids.get((host, topic))
+        if i is None:
+            return None
+        return self.due(i) - self.timestamps[i]
+
+    def due(self, i):
+        """ Deadline of record 'i' as described above. """
+        timeout = self.timeouts[i]
+        if self.adaptive is not None and self.gap_counts[i] >= MIN_GAPS:
+            timeout = min(timeout, math.ceil(
+                2 * self.gap_means[i] +
+                self.adaptive * math.sqrt(self.gap_variances[i])))
+        return self.timestamps[i] + timeout
+
+    def items(self):
+        """ Yield ((host, topic), (timestamp, timeout, status)). """
+        for (key, i) in list(self.ids.items()):
+            yield (key, (self.timestamps[i], self.timeouts[i],
+                         STATUSES[self.statuses[i]]))
+
+    def push(self, key, deadline):
+        i = self.ids[key]
+        deadline = int(deadline)
+        self.queued[i] = deadline
+        heapq.heappush(self.heap, deadline << ID_BITS | i)
+
+    def add(self, host, topic, timestamp, timeout, status="unknown",
+            stats=None):
+        """ Add or replace a record. 'stats' is as returned by stats(); if
+        None a new record has none and a replaced record keeps its own.
+        """
+        key = (host, topic)
+        code = STATUS_CODES.get(status, UNKNOWN)
+        i = self.ids.get(key)
+        if i is None:
+            key = intern_key(host, topic)
+            if self.free:
+                i = self.free.pop()
+                self.keys[i] = key
+                self.timestamps[i] = int(timestamp)
+                self.timeouts[i] = int(timeout)
+                self.statuses[i] = code
+                self.queued[i] = NOT_QUEUED
+                self.heard[i] = 0
+            else:
+                i = len(self.keys)
+                self.keys.append(key)
+                self.timestamps.append(int(timestamp))
+                self.timeouts.append(int(timeout))
+                self.statuses.append(code)
+                self.queued.append(NOT_QUEUED)
+                self.gap_means.append(0.0)
+                self.gap_variances.append(0.0)
+                self.gap_maxes.append(0)
+                self.gap_counts.append(NOT_HEARD)
+                self.heard.append(0)
+            self.ids[key] = i
+            if stats is None:
+                stats = (None, None, None, None)
+        else:
+            self.timestamps[i] = int(timestamp)
+            self.timeouts[i] = int(timeout)
+            self.statuses[i] = code
+            self.queued[i] = NOT_QUEUED
+            self.heard[i] = 0
+        if stats is not None:
+            (mean, variance, longest, count) = stats
+            self.gap_means[i] = mean or 0.0
+            self.gap_variances[i] = variance or 0.0
+            self.gap_maxes[i] = longest or 0
+            self.gap_counts[i] = NOT_HEARD if count is None else count
+        if code != LATE:
+            self.push(key, self.due(i))
+
+    def remove(self, host, topic):
+        """ Forget a record. Its heap entry is discarded when it comes due. """
+        i = self.ids.pop((host, topic), None)
+        if i is not None:
+            self.keys[i] = None
+            self.queued[i] = NOT_QUEUED
+            self.free.append(i)
+
+    def load(self, cursor):
+        """ Add the records from host_activity for the hosts this
+        scanner owns.
+        """
+        rows = cursor.execute('''select host, topic, timestamp, timeout,
+                status, gap_mean, gap_variance, gap_max, gap_count
+                from host_activity''')
+        for (host, topic, timestamp, timeout, status, *stats) in rows:
+            if self.owns is None or self.owns(host):
+                self.add(host, topic, timestamp, timeout, status, stats)
+
+    def reconcile(self, cursor):
+        """ Bring the records for the hosts this scanner owns into line
+        with host_activity after records have been added, deleted or had
+        their timeout changed: add the new records, remove the deleted
+        ones and apply changed timeouts. The timestamp, status and
+        statistics of a record already held are kept since the scanner's
+        are at least as recent as the database's.
+        Return (added, removed, changed).
+        """
+        rows = cursor.execute('''select host, topic, timestamp, timeout,
+                status, gap_mean, gap_variance, gap_max, gap_count
+                from host_activity''')
+        seen = set()
+        (added, changed) = (0, 0)
+        for (host, topic, timestamp, timeout, status, *stats) in rows:
+            if self.owns is not None and not self.owns(host):
+                continue
+            i = self.ids.get((host, topic))
+            if i is None:
+                self.add(host, topic, timestamp, timeout, status, stats)
+                added += 1
+            elif timeout != self.timeouts[i]:
+                self.set_timeout(host, topic, timeout)
+                changed += 1
+            seen.add((host, topic))
+        removed = [key for key in self.ids if key not in seen]
+        for key in removed:
+            self.remove(*key)
+        return (added, len(removed), changed)
+
+    def set_timeout(self, host, topic, timeout):
+        i = self.ids.get((host, topic))
+        if i is None:
+            return
+        self.timeouts[i] = int(timeout)
+        deadline = self.due(i)
+        if self.queued[i] != NOT_QUEUED and deadline < self.queued[i]:
+            self.push(self.keys[i], deadline)  # earlier entry supersedes
+
+    def activity(self, host, topic, timestamp, timeout=None):
+        """ Note activity for a record, adding it if not yet known.
+        Return True if the record changed status to alive.
+        """
+        i = self.ids.get((host, topic))
+        if i is None:
+            if timeout is None:
+                return False
+            self.add(host, topic, timestamp, timeout, "alive")
+            i = self.ids[(host, topic)]
+            self.gap_counts[i] = 0
+            self.heard[i] = 1
+            return True
+
+        self.gap(i, int(timestamp) - self.timestamps[i])
+        self.timestamps[i] = int(timestamp)
+        if timeout is not None and int(timeout) != self.timeouts[i]:
+            self.set_timeout(host, topic, timeout)
+        deadline = self.due(i)
+        if self.queued[i] == NOT_QUEUED or deadline < self.queued[i]:
+            self.push(self.keys[i], deadline)
+        if self.statuses[i] != ALIVE:
+            self.statuses[i] = ALIVE
+            return True
+        return False
+
+    def gap(self, i, interval):
+        """ Count 'interval' seconds since the last message of record 'i'
+        in its statistics.
+        """
+        count = self.gap_counts[i]
+        if not self.heard[i]:   # first message this run
+            self.heard[i] = 1
+            if count == NOT_HEARD:
+                self.gap_counts[i] = 0
+            return
+        if interval <= 0:
+            return      # same burst
+        if interval > self.gap_maxes[i]:
+            self.gap_maxes[i] = interval
+        if self.statuses[i] == LATE:
+            return      # outage
+        if count == 0:
+            self.gap_means[i] = float(interval)
+            self.gap_variances[i] = 0.0
+        else:
+            diff = interval - self.gap_means[i]
+            increment = GAP_ALPHA * diff
+            self.gap_means[i] += increment
+            self.gap_variances[i] = (1 - GAP_ALPHA) * (
+                self.gap_variances[i] + diff * increment)
+        self.gap_counts[i] = count + 1
+
+    def next_deadline(self):
+        """ Return the earliest queued deadline or None. """
+        if self.heap:
+            return self.heap[0] >> ID_BITS
+        return None
+
+    def check(self, now):
+        """ Return a list of (host, topic) that became late at 'now'. """
+        late = []
+        heap = self.heap
+        limit = (int(now) + 1) << ID_BITS   # every entry with deadline <= now
+        while heap and heap[0] < limit:
+            entry = heapq.heappop(heap)
+            (queued, i) = (entry >> ID_BITS, entry & ID_MASK)
+            if self.queued[i] != queued:
+                continue        # removed or superseded
+            deadline = self.due(i)
+            if deadline > now:
+                self.push(self.keys[i], deadline)    # heard from since queued
+            else:
+                self.queued[i] = NOT_QUEUED
+                if self.statuses[i] != LATE:
+                    self.statuses[i] = LATE
+                    late.append(self.keys[i])
+        return late
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Spread database updates for the home automation host monitor across
+several processes so that ingest is not limited to one core.
+
+Hosts are partitioned by a hash of the host name (the second level of the
+topic) across N shard processes. The receiving process only splits the
+topic and sends (host, topic, receive time) to the shard owning the host,
+in batches to keep the cost of passing messages between processes low.
+Each shard runs its own edit_hahmon.ActivityWriter and an overdue scanner
+(scan_hahmon.OverdueScanner) that only holds the hosts the shard owns,
+so every host is watched by exactly one shard. With alerts enabled each
+shard sends its own (alert_hahmon.) With a snapshot each shard saves its
+own to '<path>.<shard>' (snapshot_hahmon.) Adaptive timeouts are passed
+on to each shard's scanner.
+
+All shards write to the one database. Writes are batched by each writer
+(flush_interval, flush_size) so the shards rarely wait on each other for
+the write lock, and the database remains the merged view of every host:
+edit_hahmon.list_db() and list_overdue() need no changes.
+
+Metrics recorded in a shard (unknown messages, commit latency) are sent
+to the receiving process every poll interval and on exit as the changes
+since the last report (metrics_hahmon.Registry.changes()) and merged into
+its registry, so that --metrics covers every shard.
+
+A ShardPool can be handed to mosquitto_hahmon.ingest() and to
+paho_hahmon in place of a hahmon.IngestWorker.
+"""
+
+import alert_hahmon
+import edit_hahmon
+import hahmon
+import metrics_hahmon
+import scan_hahmon
+import snapshot_hahmon
+import atexit
+import logging
+import multiprocessing
+import queue
+import shlex
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(host, shards):
+    """ Return the shard (0 .. shards-1) that owns 'host'. The hash is
+    stable across processes and restarts, unlike hash().
+    """
+    return zlib.crc32(host.encode()) % shards
+
+
+def run_shard(db_name, shard, shards, messages, flush_interval, flush_size,
+              log_level, alerts=None, snapshot=None, poll_interval=1,
+              adaptive=None, reports=None):
+    """ Body of a shard process. Record batches of (host, topic, receive
+    time) from the 'messages' queue until None is received. 'alerts' is
+    (command, window, host_interval) for an alert_hahmon.AlertDispatcher
+    or None, 'snapshot' (path, interval) for a snapshot_hahmon.Snapshot
+    or None and 'adaptive' as for scan_hahmon.OverdueScanner. Changes to
+    the metrics are put on the 'reports' queue if given.
+    """
+    logging.getLogger().handlers.clear()    # inherited queue has no listener
+    listener = hahmon.setup_logging(log_level)     # atexit does not run here
+    dispatcher = None
+    if alerts is not None:
+        dispatcher = alert_hahmon.AlertDispatcher(shlex.split(alerts[0]),
+                                                  alerts[1], alerts[2])
+        dispatcher.start()
+    if snapshot is not None:
+        snapshot = snapshot_hahmon.Snapshot(
+            "{}.{}".format(snapshot[0], shard), snapshot[1])
+    scanner = scan_hahmon.OverdueScanner(
+        owns=lambda host: shard_of(host, shards) == shard, adaptive=adaptive)
+    writer = edit_hahmon.ActivityWriter(db_name, flush_interval, flush_size,
+                                        scanner, alerts=dispatcher,
+                                        snapshot=snapshot)
+    if writer.conn is None:
+        logger.error("shard=%d cannot open database=%s", shard, db_name)
+        listener.stop()
+        return
+    logger.info("shard=%d of %d hosts=%d", shard, shards, len(scanner))
+    state = metrics_hahmon.registry.state()     # as inherited
+    last_report = time.monotonic()
+    running = True
+    while running:
+        try:
+            batch = messages.get(timeout=poll_interval)
+        except queue.Empty:
+            batch = []
+        if batch is None:
+            running = False
+            batch = []
+        for (host, topic, received) in batch:
+            writer.record(host, topic, received)
+        for (host, topic) in writer.poll():
+            logger.warning("late host=%s topic=%s shard=%d", host, topic,
+                           shard)
+        if reports is not None and (
+                time.monotonic() - last_report >= poll_interval):
+            state = report_metrics(reports, state)
+            last_report = time.monotonic()
+    writer.close()
+    if reports is not None:
+        report_metrics(reports, state)
+    if dispatcher is not None:
+        dispatcher.stop()
+    listener.stop()
+
+
+def report_metrics(reports, state):
+    """ Put the changes to the metrics since 'state' on 'reports'. Return
+    the new state.
+    """
+    (changes, state) = metrics_hahmon.registry.changes(state)
+    if changes:
+        reports.put(changes)
+    return state
+
+
+class ShardPool:
+    """ Start 'shards' processes writing 'db_name' and route messages to
+    them by host. Messages for each shard are sent when batch_size are
+    waiting or send_interval seconds after the last send, checked by
+    put() and flush(). If a shard's queue already holds queue_size batches
+    the messages are kept and sent with the next batch rather than
+    blocking the receiving thread. Once max_waiting (default queue_size
+    batches) are kept for a shard they are coalesced to the newest
+    message per host/topic (counted in 'coalesced') as hahmon's
+    CoalescingQueue does, and only if that is not enough are the oldest
+    dropped (counted in 'shed'). put() and flush() may be called from
+    different threads. The shards' metrics are merged into the registry
+    of this process by a thread.
+    """
+
+    def __init__(self, db_name, shards, flush_interval=5, flush_size=1000,
+                 log_level=logging.INFO, alerts=None, snapshot=None,
+                 queue_size=100, batch_size=500, send_interval=0.5,
+                 adaptive=None, max_waiting=None):
+        self.shards = shards
+        self.batch_size = batch_size
+        self.send_interval = send_interval
+        if max_waiting is None:
+            max_waiting = queue_size * batch_size
+        self.max_waiting = max_waiting
+        self.buffers = [[] for _ in range(shards)]
+        self.last_send = time.time()
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.coalesced = 0
+        self.shed = 0
+        self.queues = []
+        self.processes = []
+        self.reports = multiprocessing.Queue()
+        self.collector = threading.Thread(target=self.collect,
+                                          name="shard-metrics", daemon=True)
+        self.collector.start()
+        for shard in range(shards):
+            messages = multiprocessing.Queue(queue_size)
+            process = multiprocessing.Process(
+                target=run_shard, name="shard{}".format(shard),
+                args=(db_name, shard, shards, messages, flush_interval,
+                      flush_size, log_level, alerts, snapshot),
+                kwargs={"adaptive": adaptive, "reports": self.reports})
+            process.start()
+            self.queues.append(messages)
+            self.processes.append(process)
+
+    def put(self, host, topic):
+        now = time.time()
+        shard = shard_of(host, self.shards)
+        with self.lock:
+            buffer = self.buffers[shard]
+            buffer.append((host, topic, now))
+            if len(buffer) >= self.batch_size:
+                self.send(shard)
+        if now - self.last_send >= self.send_interval:
+            self.flush()
+
+    def send(self, shard):
+        batch = self.buffers[shard]
+        try:
+            self.queues[shard].put_nowait(batch)
+        except queue.Full:      # kept for the next send
+            if len(batch) >= self.max_waiting:
+                self.coalesce(shard)
+            return
+        self.buffers[shard] = []
+        self.processed += len(batch)
+
+    def coalesce(self, shard):
+        """ Keep the newest waiting message for each host/topic of 'shard'
+        and, if still max_waiting or more, drop the oldest half.
+        """
+        batch = self.buffers[shard]
+        newest = {}
+        for message in batch:
+            newest[message[:2]] = message
+        waiting = sorted(newest.values(), key=lambda message: message[2])
+        self.coalesced += len(batch) - len(waiting)
+        if len(waiting) >= self.max_waiting:
+            keep = self.max_waiting // 2
+            self.shed += len(waiting) - keep
+            waiting = waiting[len(waiting) - keep:]
+        self.buffers[shard] = waiting
+
+    def collect(self):
+        """ Merge the metrics reported by the shards until None. """
+        while True:
+            changes = self.reports.get()
+            if changes is None:
+                return
+            metrics_hahmon.registry.merge(changes)
+
+    def flush(self):
+        """ Send all waiting messages. """
+        with self.lock:
+            self.last_send = time.time()
+            for shard in range(self.shards):
+                if self.buffers[shard]:
+                    self.send(shard)
+
+    def stop(self):
+        """ Send what is waiting, then have each shard write and exit. """
+        with self.lock:
+            for (shard, messages) in enumerate(self.queues):
+                if self.buffers[shard]:
+                    messages.put(self.buffers[shard])   # waits for room
+                    self.processed += len(self.buffers[shard])
+                    self.buffers[shard] = []
+                messages.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.queues = []
+        if self.collector.is_alive():
+            self.reports.put(None)  # after the shards' last reports
+            self.collector.join()
+
+    def stats(self):
+        """ Same keys as hahmon.IngestWorker.stats(). Lag is not tracked
+        across processes.
+        """
+        return {"depth": sum(messages.qsize() for messages in self.queues),
+                "coalesced": self.coalesced, "shed": self.shed,
+                "processed": self.processed, "lag": 0.0}
+
+
+def start_shard_pool(db_name, shards, flush_interval=5, flush_size=1000,
+                     log_level=logging.INFO, alerts=None, snapshot=None,
+                     adaptive=None):
+    """ Start a ShardPool and stop it at exit. """
+    pool = ShardPool(db_name, shards, flush_interval, flush_size, log_level,
+                     alerts, snapshot, adaptive=adaptive)
+    atexit.register(pool.stop)
+    return pool
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Snapshots of the in-memory state of the home automation host monitor, for
+a warm restart.
+
+The overdue scanner (scan_hahmon.OverdueScanner) holds the last time each
+host/topic was heard from, its timeout and status. Timestamps are written
+to the database behind (edit_hahmon.ActivityWriter) so after a restart the
+database may be up to flush_interval seconds behind, and any record whose
+deadline passed while the monitor was not running is reported late at
+once although nobody was listening.
+
+A Snapshot handed to the ActivityWriter is written every 'interval'
+seconds and when the writer is closed. On start the writer restores the
+scanner from the snapshot and the database together (restore()):
+    - host_activity decides which records exist and their timeouts, so
+      records added, removed or changed while stopped are respected. The
+      statistics of the interval between messages come from the database.
+    - the newer of the snapshot and database timestamps is kept, and the
+      snapshot's timestamp and status are written back to the database.
+    - a record that was not late when the snapshot was saved has its
+      deadline put off by the time the monitor was stopped, so that it is
+      not reported late for time nobody was listening.
+
+File format - little endian, replaced atomically when saved:
+    header      b'HAHMSNP1', time saved (double), record count (uint32)
+    records     timestamp (int64), timeout (uint32), status (uint8),
+                host length (uint16), topic length (uint16, 0xFFFF for no
+                topic), host, topic
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HAHMSNP1'
+HEADER = struct.Struct("<8sdI")     # magic, time saved, record count
+RECORD = struct.Struct("<qIBHH")    # timestamp, timeout, status, lengths
+NO_TOPIC = 0xFFFF
+STATUSES = ("unknown", "alive", "late")
+STATUS_CODES = {status: code for (code, status) in enumerate(STATUSES)}
+
+
+def save(path, scanner, now):
+    """ Write the records in 'scanner' to 'path'. A record that does not
+    fit the format (a timeout outside uint32, a host or topic name of
+    NO_TOPIC bytes or more) is left out with a warning; it is restored
+    from the database alone. Return the number of records left out.
+    """
+    parts = [None]     # header, once the records are counted
+    skipped = 0
+    for ((host, topic), (timestamp, timeout, status)) in scanner.items():
+        host = host.encode()
+        if topic is None:
+            (topic, topic_len) = (b'', NO_TOPIC)
+        else:
+            topic = topic.encode()
+            topic_len = len(topic)
+        try:
+            if len(host) >= NO_TOPIC or len(topic) >= NO_TOPIC:
+                raise struct.error("name too long")
+            record = RECORD.pack(timestamp, timeout,
+                                 STATUS_CODES.get(status, 0),
+                                 len(host), topic_len)
+        except struct.error as msg:
+            logger.warning("not in snapshot host=%.64s topic=%.64s error=%s",
+                           host.decode(), topic.decode(), msg)
+            skipped += 1
+            continue
+        parts.append(record)
+        parts.append(host)
+        parts.append(topic)
+    parts[0] = HEADER.pack(MAGIC, now, len(scanner) - skipped)
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp, "wb") as f:
+        f.write(b''.join(parts))
+    os.replace(temp, path)
+    return skipped
+
+
+def load(path):
+    """ Read the snapshot at 'path', which is memory mapped rather than
+    read. Return (time saved, {(host, topic): (timestamp, timeout,
+    status)}). Raises OSError if it cannot be read and ValueError if it is
+    not a complete snapshot.
+    """
+    records = {}
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError("not a snapshot: {}".format(path))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            (magic, saved, count) = HEADER.unpack_from(buf, 0)
+            if magic != MAGIC:
+                raise ValueError("not a snapshot: {}".format(path))
+            offset = HEADER.size
+            try:
+                for _ in range(count):
+                    (timestamp, timeout, status, host_len,
+                     topic_len) = RECORD.unpack_from(buf, offset)
+                    offset += RECORD.size
+                    host = buf[offset:offset + host_len].decode()
+                    offset += host_len
+                    topic = None
+                    if topic_len != NO_TOPIC:
+                        topic = buf[offset:offset + topic_len].decode()
+                        offset += topic_len
+                    records[(host, topic)] = (timestamp, timeout,
+                                              STATUSES[status])
+            except (struct.error, IndexError, UnicodeDecodeError):
+                raise ValueError("truncated snapshot: {}".format(path))
+            if offset != len(buf):
+                raise ValueError("truncated snapshot: {}".format(path))
+    return (saved, records)
+
+
+class Snapshot:
+    """ Snapshot of an ActivityWriter's scanner saved to 'path' every
+    'interval' seconds by poll().
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.last_save = None
+        self.saves = 0
+
+    def restore(self, scanner, cursor, now):
+        """ Load 'scanner' from host_activity and the snapshot, as
+        described above. Return {(host, topic): (timestamp, status)} for
+        the records the snapshot has newer state for, to be written to
+        the database.
+        """
+        self.last_save = now
+        try:
+            (saved, records) = load(self.path)
+        except FileNotFoundError:
+            (saved, records) = (None, {})
+        except (OSError, ValueError) as msg:
+            logger.warning("snapshot not used path=%s error=%s", self.path, msg)
+            (saved, records) = (None, {})
+        gap = max(now - saved, 0) if saved is not None else 0
+        newer = {}
+        rows = cursor.execute('''select host, topic, timestamp, timeout,
+                status, gap_mean, gap_variance, gap_max, gap_count
+                from host_activity''')
+        for (host, topic, timestamp, timeout, status, *stats) in rows:
+            if scanner.owns is not None and not scanner.owns(host):
+                continue
+            key = (host, topic)
+            record = records.get(key)
+            if record is not None and record[0] >= timestamp:
+                if (record[0], record[2]) != (timestamp, status):
+                    newer[key] = (record[0], record[2])
+                (timestamp, status) = (record[0], record[2])
+            scanner.add(host, topic, timestamp, timeout, status, stats)
+            (timestamp, timeout, status) = scanner.get(host, topic)
+            deadline = timestamp + scanner.effective_timeout(host, topic)
+            if record is not None and status != "late" and deadline > saved:
+                scanner.push(key, deadline + gap)   # not heard while stopped
+        logger.info("restored records=%d from snapshot=%d newer=%d gap=%.0f",
+                    len(scanner), len(records), len(newer), gap)
+        return newer
+
+    def save(self, scanner, now):
+        self.last_save = now
+        try:
+            save(self.path, scanner, now)
+            self.saves += 1
+        except (OSError, struct.error) as msg:
+            logger.error("cannot save snapshot path=%s error=%s", self.path,
+                         msg)
+
+    def poll(self, scanner, now):
+        """ Save if 'interval' seconds have passed since the last save. """
+        if self.last_save is None or now - self.last_save >= self.interval:
+            self.save(scanner, now)
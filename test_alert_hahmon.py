@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Test program for alert_hahmon (Home Automation Host Monitor)
+"""
+
+import alert_hahmon
+import unittest
+import os
+import tempfile
+
+
+class AlertHAmonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.sent = []
+        self.send_ok = True
+
+    def clock(self):
+        return self.now
+
+    def send(self, subject, body):
+        self.sent.append((subject, body))
+        return self.send_ok
+
+    def test_digest(self):
+        alerts = alert_hahmon.AlertDispatcher(window=30, host_interval=3600,
+                                              send=self.send, clock=self.clock)
+        for host in ("oak", "maple", "elm"):
+            alerts.late(host, None)
+        alerts.late("oak", "home_automation/oak/a/b")
+        for _ in range(100):
+            alerts.unknown("birch", "home_automation/birch/a/b")
+        self.assertEqual(len(alerts.events), 5, "repeated events kept once")
+
+        (subject, body) = alerts.take_digest(self.now + 30)
+        self.assertEqual(subject, "hahmon: 4 late, 1 unknown", "subject")
+        self.assertEqual([line.split(None, 2)[2] for line in body.splitlines()],
+                         ["late oak ", "late maple ", "late elm ",
+                          "late oak home_automation/oak/a/b",
+                          "unknown birch home_automation/birch/a/b"], "body")
+
+        # hosts just alerted are suppressed
+        self.now += 60
+        alerts.late("oak", None)
+        alerts.late("ash", None)
+        self.assertEqual(alerts.suppressed, 1, "oak suppressed")
+        (subject, body) = alerts.take_digest(self.now)
+        self.assertEqual(subject, "hahmon: 1 late", "only ash")
+
+        # until host_interval has passed
+        self.now += 3600
+        self.assertIsNone(alerts.take_digest(self.now), "nothing waiting")
+        self.assertEqual(alerts.alerted, {}, "old alerts forgotten")
+        alerts.late("oak", None)
+        self.assertEqual(len(alerts.events), 1, "oak alerted again")
+
+    def test_bounded(self):
+        alerts = alert_hahmon.AlertDispatcher(max_events=3, max_retries=2,
+                                              retry_delay=10, send=self.send,
+                                              clock=self.clock)
+        for i in range(5):
+            alerts.late("host{}".format(i), None)
+        self.assertEqual((len(alerts.events), alerts.dropped), (3, 2),
+                         "events beyond max_events dropped")
+
+        self.send_ok = False
+        for subject in ("a", "b", "c"):
+            alerts.dispatch(subject, "")
+        self.assertEqual([entry[2] for entry in alerts.retries], ["b", "c"],
+                         "oldest failed digest dropped")
+
+        alerts.retry(self.now + 9)
+        self.assertEqual(len(self.sent), 3, "not yet due")
+        alerts.retry(self.now + 10)
+        self.assertEqual([entry[:2] for entry in alerts.retries],
+                         [[1030, 20], [1030, 20]], "retried, delay doubled")
+        self.send_ok = True
+        alerts.retry(self.now + 30)
+        self.assertEqual((len(alerts.retries), alerts.sent), (0, 2), "sent")
+
+    def test_thread(self):
+        alerts = alert_hahmon.AlertDispatcher(window=0, send=self.send)
+        alerts.start()
+        alerts.late("oak", None)
+        alerts.stop()
+        self.assertFalse(alerts.is_alive(), "stopped")
+        self.assertEqual([subject for (subject, body) in self.sent],
+                         ["hahmon: 1 late"], "sent from the thread")
+
+        alerts = alert_hahmon.AlertDispatcher(window=60, send=self.send)
+        alerts.start()
+        alerts.unknown("elm", None)
+        alerts.stop()
+        self.assertEqual(len(self.sent), 2, "waiting events sent on stop")
+
+    def test_run_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "mail")
+            command = ["sh", "-c", 'cat > "$0"; echo "$1" >> "$0"']
+            self.assertTrue(alert_hahmon.run_command(
+                command + [path], "subject", "body\n"), "sent")
+            with open(path) as f:
+                self.assertEqual(f.read(), "body\nsubject\n", "stdin, subject")
+        self.assertFalse(alert_hahmon.run_command(["false"], "s", ""),
+                         "failed")
+        self.assertFalse(alert_hahmon.run_command(["/no/such/sa.sh"], "s", ""),
+                         "missing command")
+
+
+if __name__ == "__main__":
+    unittest.main()
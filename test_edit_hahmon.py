@@ -5,7 +5,11 @@ Test program for edit_hahmon (Home Automation Host Monitor)
 """
 
 import edit_hahmon
+import metrics_hahmon
 import unittest
+import io
+import json
+import contextlib
 import inspect
 import pathlib
 import os
@@ -52,10 +56,10 @@ class UpdateHAmonTest(unittest.TestCase):
     def validate_record(self, name, timestamp, timeout, topic=None):
         """ Read record from DB matching key and topic and validate contents' """
         if topic == None:
-            select = '"select * from host_activity ' + \
+            select = '"select host, topic, timestamp, timeout, status from host_activity ' + \
                 'where host=\'' + name + '\' and topic is NULL"'
         else:
-            select = '"select * from host_activity ' + \
+            select = '"select host, topic, timestamp, timeout, status from host_activity ' + \
                 'where host=\'' + name + '\' and topic=\'' + topic + '\'"'
         with os.popen('sqlite3 ha_test.db ' + select) as db_read:
             db_content = db_read.read()
@@ -68,6 +72,13 @@ class UpdateHAmonTest(unittest.TestCase):
                         (db_content == name + '|' + topic + '|' + str(timestamp + 1) + '|'
                          + str(timeout) + '|unknown\n'))
 
+        # deadline is maintained along with timestamp and timeout
+        with contextlib.closing(sqlite3.connect(test_DB_name)) as conn:
+            self.assertEqual(conn.execute('''select deadline - timestamp - timeout
+                    from host_activity where host=? and topic is ?''',
+                                          (name, topic or None)).fetchone()[0],
+                             0, "deadline")
+
     def populate_test_DB(self, dbname, contents):
         self.assertEqual(edit_hahmon.create_database(test_DB_name), 0,
                          "call create_database()")
@@ -99,6 +110,54 @@ class UpdateHAmonTest(unittest.TestCase):
 
         pathlib.Path.rmdir(db_path)
 
+    def test_upgrade_database(self):
+        # database as created before schema versions were introduced
+        conn = sqlite3.connect(test_DB_name)
+        conn.execute('''CREATE TABLE host_activity
+                (host TEXT, topic TEXT, timestamp INTEGER, timeout INTEGER,
+                status TEXT)''')
+        conn.executemany(
+            "insert into host_activity(host, topic, timestamp, timeout, status) \
+                values (?,?,?,?,?)", hosts + [
+                ("oak", None,           1553542690, 300, 'unknown'),
+                ("oak", "/some/topic",  1553542690, 300, 'unknown')])
+        edit_hahmon.close_connection(conn)
+
+        try:
+            self.assertEqual(edit_hahmon.create_database(test_DB_name), 1,
+                             "call create_database(), exists")
+
+            conn = sqlite3.connect(test_DB_name)
+            self.assertEqual(conn.execute('pragma user_version').fetchone()[0],
+                             edit_hahmon.SCHEMA_VERSION, "schema version")
+            self.assertEqual(conn.execute('''select timestamp from host_activity
+                    where host='oak' and topic is NULL''').fetchall(),
+                             [(1553542690,)], "duplicate removed")
+            self.assertEqual(conn.execute('''select count(*) from host_activity
+                    ''').fetchone()[0], len(hosts), "other records kept")
+
+            # names are stored once and records keyed by their ids
+            self.assertEqual(conn.execute('''select type from sqlite_master
+                    where name='host_activity' ''').fetchone()[0], "view",
+                             "host_activity replaced by a view")
+            self.assertEqual(conn.execute('''select count(*) from hosts
+                    ''').fetchone()[0], len({host for (host, *_) in hosts}),
+                             "one row per host")
+            self.assertEqual(conn.execute('''select count(*) from activity
+                    ''').fetchone()[0], len(hosts), "one row per record")
+
+            # lookups are index searches rather than table scans
+            plan = conn.execute('''explain query plan select topics.name
+                    from activity join topics on topics.id=activity.topic_id
+                    where ''' + edit_hahmon.MATCHING_RECORD,
+                                ("oak", "/some/topic", None,
+                                 "/some/topic")).fetchall()
+            self.assertTrue(all("SCAN" not in row[3] for row in plan),
+                            "index used: {}".format(plan))
+            conn.close()
+        finally:
+            pathlib.Path.unlink(db_path)
+
     def test_host_match(self):
         self.assertEqual(edit_hahmon.create_database(test_DB_name), 0,
                          "call create_database()")
@@ -107,8 +166,6 @@ class UpdateHAmonTest(unittest.TestCase):
             ("oak", None),
             ("oak", "/some/topic"),
             ("oak", "/another/topic"),
-            ("oak", "/duplicate/topic"),
-            ("oak", "/duplicate/topic"),
             ("maple", None),
             ("maple", "/some/topic"),
             ("maple", "/another/topic"),
@@ -130,8 +187,14 @@ class UpdateHAmonTest(unittest.TestCase):
                          "match host w/unmatched topic")
         self.assertEqual(edit_hahmon.host_match(c, "oak", "/some/topic"),
                          1, "match host w/ topic")
-        self.assertEqual(edit_hahmon.host_match(c, "oak", "/duplicate/topic"),
-                         2, "match host w/duplicate topic")  # pathological
+
+        # duplicates are rejected by the unique indexes
+        with self.assertRaises(sqlite3.IntegrityError, msg="duplicate topic"):
+            conn.execute("insert into host_activity(host, topic) values (?,?)",
+                         ("oak", "/some/topic"))
+        with self.assertRaises(sqlite3.IntegrityError, msg="duplicate host"):
+            conn.execute("insert into host_activity(host, topic) values (?,?)",
+                         ("oak", None))
 
         # comment next line to allow manual examination of database
         edit_hahmon.close_connection(conn)
@@ -148,7 +211,7 @@ class UpdateHAmonTest(unittest.TestCase):
             edit_hahmon.insert_host(test_DB_name, "oak", 60 * 60), 0,
             "call insert_host()")
         timestamp_after = str(int(time.time()))
-        with os.popen('sqlite3 ha_test.db "select * from host_activity"') as db_read:
+        with os.popen('sqlite3 ha_test.db "select host, topic, timestamp, timeout, status from host_activity"') as db_read:
             db_content = db_read.read()
 
         self.assertTrue((db_content == "oak||" + timestamp_before + "|3600|unknown\n") or
@@ -161,7 +224,7 @@ class UpdateHAmonTest(unittest.TestCase):
             edit_hahmon.insert_host(test_DB_name, "oak", 60 * 60), 1,
             "call insert_host()")
 
-        with os.popen('sqlite3 ha_test.db "select * from host_activity"') as db_read:
+        with os.popen('sqlite3 ha_test.db "select host, topic, timestamp, timeout, status from host_activity"') as db_read:
             db_content = db_read.read()
 
         self.assertTrue((db_content == "oak||" + timestamp_before + "|3600|unknown\n") or
@@ -176,7 +239,7 @@ class UpdateHAmonTest(unittest.TestCase):
             "call insert_host()")
         timestamp_after = str(int(time.time()))
 
-        with os.popen('''sqlite3 ha_test.db "select * from host_activity
+        with os.popen('''sqlite3 ha_test.db "select host, topic, timestamp, timeout, status from host_activity
                         where host=\'olive\'"''') as db_read:
             db_content = db_read.read()
 
@@ -191,7 +254,7 @@ class UpdateHAmonTest(unittest.TestCase):
             edit_hahmon.insert_host(test_DB_name, "oak", 60 * 60, "x"), 0,
             "call insert_host()")
         timestamp_after = str(int(time.time()))
-        with os.popen('''sqlite3 ha_test.db "select * from host_activity
+        with os.popen('''sqlite3 ha_test.db "select host, topic, timestamp, timeout, status from host_activity
                         where host=\'oak\' and topic=\'x\'"''') as db_read:
             db_content = db_read.read()
 
@@ -204,7 +267,7 @@ class UpdateHAmonTest(unittest.TestCase):
         self.assertEqual(
             edit_hahmon.insert_host(test_DB_name, "oak", 60 * 60, "x"), 1,
             "call insert_host()")
-        with os.popen('''sqlite3 ha_test.db "select * from host_activity
+        with os.popen('''sqlite3 ha_test.db "select host, topic, timestamp, timeout, status from host_activity
                         where host=\'oak\' and topic=\'x\'"''') as db_read:
             db_content = db_read.read()
 
@@ -218,7 +281,7 @@ class UpdateHAmonTest(unittest.TestCase):
             edit_hahmon.insert_host(test_DB_name, "oak", 60 * 60, "y"), 0,
             "call insert_host()")
         timestamp_after = str(int(time.time()))
-        with os.popen('''sqlite3 ha_test.db "select * from host_activity
+        with os.popen('''sqlite3 ha_test.db "select host, topic, timestamp, timeout, status from host_activity
                         where host=\'oak\' and topic=\'y\'"''') as db_read:
             db_content = db_read.read()
 
@@ -230,6 +293,25 @@ class UpdateHAmonTest(unittest.TestCase):
         # comment next line to allow manual examination of database
         rc = pathlib.Path.unlink(pathlib.Path(test_DB_name))
 
+    def test_insert_host_failed(self):
+        self.assertEqual(edit_hahmon.create_database(test_DB_name), 0,
+                         "call create_database()")
+        try:
+            self.assertEqual(
+                edit_hahmon.insert_host(test_DB_name, "maple", "abc"), 2,
+                "non-numeric timeout")
+            self.assertEqual(
+                edit_hahmon.insert_host(test_DB_name, "maple", 1 << 70, "x"),
+                2, "timeout too large to store")
+            with contextlib.closing(sqlite3.connect(test_DB_name)) as conn:
+                self.assertEqual(conn.execute('''select
+                        (select count(*) from hosts),
+                        (select count(*) from topics where id != 0),
+                        (select count(*) from activity)''').fetchone(),
+                                 (0, 0, 0), "no names left behind")
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
     def test_delete_host(self):
         # create/populate test database
         try:
@@ -269,6 +351,16 @@ class UpdateHAmonTest(unittest.TestCase):
                 edit_hahmon.delete_host(test_DB_name, 'oak'), 1,
                 "edit_hahmon.delete_host(test_DB_name, 'oak') failed")
 
+            # names are dropped with the last record using them
+            conn = sqlite3.connect(test_DB_name)
+            conn.execute('''delete from host_activity where host='oak' ''')
+            self.assertEqual(conn.execute('''select name from hosts
+                    ''').fetchall(), [("maple",)], "host name dropped")
+            self.assertEqual(conn.execute('''select name from topics
+                    where name is not NULL''').fetchall(), [("/some/topic",)],
+                             "topic name still used by maple kept")
+            edit_hahmon.close_connection(conn)
+
         # comment out try:, except: and pathlib.Path.unlink()
         # to allow manual examination of database
         # e.g. `sqlite3 ha_test.db 'select * from host_activity;'`
@@ -315,6 +407,500 @@ class UpdateHAmonTest(unittest.TestCase):
         # comment next line to allow manual examination of database
         pathlib.Path.unlink(pathlib.Path(test_DB_name))
 
+    def test_split_activity(self):
+        line = 'home_automation/sodus/master_bedroom/temp 1553831160, 72.50'
+        expected = ("sodus", "home_automation/sodus/master_bedroom/temp")
+        self.assertEqual(edit_hahmon.split_activity(line), expected, "str")
+        self.assertEqual(edit_hahmon.split_activity(line.encode()), expected,
+                         "bytes")
+        self.assertEqual(edit_hahmon.split_activity("ha/oak"), ("oak", "ha/oak"),
+                         "topic only")
+        for bad in ("", "no_slash 1, 2", b"no_slash"):
+            with self.assertRaises(IndexError, msg=repr(bad)):
+                edit_hahmon.split_activity(bad)
+
+        counts = (metrics_hahmon.MESSAGES.value,
+                  metrics_hahmon.PARSE_FAILURES.value)
+        buffer = (line + "\nbad line\n\nha/\xe9t\xe9/b 1\n").encode()
+        self.assertEqual(edit_hahmon.split_many(buffer),
+                         [expected, ("\xe9t\xe9", "ha/\xe9t\xe9/b")],
+                         "split_many()")
+        self.assertEqual(edit_hahmon.split_many(buffer)[:1],
+                         [edit_hahmon.split_activity(line)],
+                         "split_many() matches split_activity()")
+        self.assertEqual((metrics_hahmon.MESSAGES.value,
+                          metrics_hahmon.PARSE_FAILURES.value),
+                         (counts[0] + 7, counts[1] + 2),
+                         "messages and parse failures counted")
+
+        # the line and buffer parsers agree on malformed and edge cases
+        for line in (b"ha/oak", b"ha/oak/a/b 1, 2", b"ha/oak/a/b\t1",
+                     b"ha/oak/a/b  1", b"ha/oak \r", b"ha// 1", b"/oak/a 1",
+                     b"ha/ 1", b"/ 1", b"ha 1/2", b" ha/oak 1", b"no_slash",
+                     b"ha/\xff\xfe/a 1", b"ha/oak/\xe9 1", b"\r"):
+            try:
+                expected = [edit_hahmon.split_activity(line)]
+            except IndexError:
+                expected = []
+            self.assertEqual(edit_hahmon.split_many(line + b"\n"), expected,
+                             repr(line))
+            self.assertEqual(expected[:1] and
+                             [edit_hahmon.split_activity(line.decode(
+                                 'utf-8', 'replace'))],
+                             expected, "str " + repr(line))
+
+    def test_update_host_activity(self):
+        # muck about with time.time() as described in
+        # https://stackoverflow.com/questions/2658026/how-to-change-the-date-time-in-python-for-all-modules/
+        # "(monkey-patching)"
+        current_time = int(time.time())
+        time_time = time.time
+        bias = 0              # apply a bias of 0 seconds
+
+        def mytime(): return current_time + bias
+        time.time = mytime
+
+        try:
+            edit_hahmon.create_database(test_DB_name)
+            edit_hahmon.insert_host(test_DB_name, "oak", 300)
+            edit_hahmon.insert_host(test_DB_name, "oak", 500,
+                                    "home_automation/oak/some/topic")
+
+            bias = 1000              # apply a bias of 1000 seconds
+
+            self.assertEqual(edit_hahmon.update_host_activity(test_DB_name,
+                    "home_automation/oak/roamer/outside_temp_humidity \
+                    1536080280, 92.36, 58.06"), 0, "update timestamp")
+            self.validate_record("oak", current_time + bias, 300)
+            self.validate_record("oak", current_time, 500,
+                                 "home_automation/oak/some/topic")
+
+            bias = 2000              # apply a bias of 2000 seconds
+
+            self.assertEqual(edit_hahmon.update_host_activity(test_DB_name,
+                    "home_automation/oak/some/topic \
+                    1536080280, 92.36, 58.06"), 0, "update timestamp")
+            self.validate_record("oak", current_time + 1000, 300)
+            self.validate_record("oak", current_time + bias, 500,
+                                 "home_automation/oak/some/topic")
+
+            counts = (metrics_hahmon.MESSAGES.value,
+                      metrics_hahmon.UNKNOWN.value,
+                      metrics_hahmon.PARSE_FAILURES.value)
+            self.assertEqual(edit_hahmon.update_host_activity(test_DB_name,
+                    "home_automation/maple/some/topic 1536080280, 92.36"), 1,
+                    "unknown host")
+            self.assertEqual(edit_hahmon.update_host_activity(test_DB_name,
+                    "garbage"), 2, "unparsable line")
+            self.assertEqual((metrics_hahmon.MESSAGES.value,
+                              metrics_hahmon.UNKNOWN.value,
+                              metrics_hahmon.PARSE_FAILURES.value),
+                             (counts[0] + 2, counts[1] + 1, counts[2] + 1),
+                             "messages, unknown and parse failures counted")
+        finally:
+            time.time = time_time     # un-muck time.time()
+            # comment next line to allow manual examination of database
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_topic_filters(self):
+        current_time = int(time.time())
+        time_time = time.time
+        bias = 0
+
+        def mytime(): return current_time + bias
+        time.time = mytime
+
+        try:
+            edit_hahmon.create_database(test_DB_name)
+            edit_hahmon.insert_host(test_DB_name, "oak", 300)
+            edit_hahmon.insert_host(test_DB_name, "oak", 400,
+                                    "home_automation/oak/+/temp")
+            edit_hahmon.insert_host(test_DB_name, "oak", 500,
+                                    "home_automation/oak/#")
+            self.assertEqual(edit_hahmon.insert_host(test_DB_name, "oak", 500,
+                                                     "home_automation/#/temp"),
+                             2, "invalid filter")
+
+            bias = 1000
+            self.assertEqual(edit_hahmon.update_host_activity(test_DB_name,
+                    "home_automation/oak/porch/temp 1536080280, 92.36"), 0,
+                    "update '+' filter")
+            self.validate_record("oak", current_time + bias, 400,
+                                 "home_automation/oak/+/temp")
+            self.validate_record("oak", current_time, 500,
+                                 "home_automation/oak/#")
+            self.validate_record("oak", current_time, 300)
+
+            writer = edit_hahmon.ActivityWriter(test_DB_name)
+            bias = 2000
+            self.assertEqual(writer.update(
+                "home_automation/oak/porch/humidity 1536080280, 58.06"), 0,
+                "update '#' filter")
+            self.validate_record("oak", current_time + bias, 500,
+                                 "home_automation/oak/#")
+            self.assertEqual(writer.update(
+                "home_automation/ash/porch/temp 1536080280, 58.06"), 1,
+                "unknown host")
+
+            edit_hahmon.insert_host(test_DB_name, "ash", 600,
+                                    "home_automation/ash/+/temp")
+            writer.poll()       # sees the filter added by another connection
+            bias = 3000
+            self.assertEqual(writer.update(
+                "home_automation/ash/porch/temp 1536080280, 58.06"), 0,
+                "new filter")
+            writer.close()
+            self.validate_record("ash", current_time + bias, 600,
+                                 "home_automation/ash/+/temp")
+        finally:
+            time.time = time_time
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_registration_version(self):
+        self.assertEqual(edit_hahmon.create_database(test_DB_name), 0,
+                         "create database")
+        try:
+            conn = sqlite3.connect(test_DB_name)    # as version 4
+            for name in ("registration_insert", "registration_delete",
+                         "registration_timeout"):
+                conn.execute("drop trigger " + name)
+            conn.execute("drop table registration")
+            conn.execute("drop index activity_status")
+            conn.execute("pragma user_version = 4")
+            edit_hahmon.close_connection(conn)
+
+            conn = edit_hahmon.open_database(test_DB_name)  # upgraded
+            cursor = conn.cursor()
+            version = edit_hahmon.registration_version(cursor)
+            edit_hahmon.insert_host(test_DB_name, "oak", 300)
+            edit_hahmon.insert_host(test_DB_name, "oak", 300, "a")
+            self.assertEqual(edit_hahmon.registration_version(cursor),
+                             version + 2, "records added")
+            version += 2
+
+            edit_hahmon.update_host_activity(test_DB_name,
+                                             "home_automation/oak/a 1")
+            conn.execute('''update host_activity set status='late'
+                    where host='oak' and topic is NULL''')
+            conn.commit()
+            self.assertEqual(edit_hahmon.registration_version(cursor),
+                             version, "unchanged by activity and status")
+
+            edit_hahmon.update_host_timeout(test_DB_name, "oak", 600)
+            self.assertEqual(edit_hahmon.registration_version(cursor),
+                             version + 1, "timeout changed")
+            edit_hahmon.delete_host(test_DB_name, "oak", "a")
+            self.assertEqual(edit_hahmon.registration_version(cursor),
+                             version + 2, "record deleted")
+            conn.close()
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_unknown_cache(self):
+        monotonic = time.monotonic
+        now = 1000.0
+        time.monotonic = lambda: now
+        try:
+            cache = edit_hahmon.UnknownCache(maxsize=2, ttl=60)
+            cache.add(("oak", "a"))
+            cache.add(("maple", "a"))
+            self.assertIn(("oak", "a"), cache, "cached")
+            cache.add(("elm", "a"))     # maple least recently used
+            self.assertNotIn(("maple", "a"), cache, "LRU dropped")
+            self.assertEqual(len(cache), 2, "bounded")
+            now += 60
+            self.assertNotIn(("oak", "a"), cache, "expired")
+            self.assertEqual(len(cache), 1, "expired entry dropped")
+            edit_hahmon.invalidate_unknown("elm")
+            self.assertEqual(len(cache), 0, "invalidated by host")
+        finally:
+            time.monotonic = monotonic
+
+        self.assertEqual(edit_hahmon.create_database(test_DB_name), 0,
+                         "create database")
+        edit_hahmon.insert_host(test_DB_name, "oak", 300)
+        line = "home_automation/maple/a/b 1536080280, 92.36"
+        try:
+            writer = edit_hahmon.ActivityWriter(test_DB_name)
+            self.assertEqual(writer.update(line), 1, "unknown")
+            self.assertEqual(writer.update(line), 1, "unknown, cached")
+            self.assertEqual(writer.unknown.hits, 1, "answered from the cache")
+            writer.poll()
+            self.assertEqual(len(writer.unknown), 1, "kept, no other writer")
+            edit_hahmon.update_host_activity(test_DB_name,
+                                             "home_automation/oak/a 1")
+            writer.poll()
+            self.assertEqual(len(writer.unknown), 1,
+                             "kept, only activity recorded by another writer")
+
+            edit_hahmon.insert_host(test_DB_name, "maple", 300)
+            self.assertEqual(writer.update(line), 0, "registered in process")
+
+            self.assertEqual(writer.update(line.replace("maple", "elm")), 1,
+                             "elm unknown")
+            conn = sqlite3.connect(test_DB_name)    # another process
+            conn.execute('''insert into host_activity (host, timestamp, timeout)
+                    values ('elm', 0, 300)''')
+            conn.commit()
+            conn.close()
+            writer.poll()
+            self.assertEqual(writer.update(line.replace("maple", "elm")), 0,
+                             "registered by another connection")
+            writer.close()
+
+            line = line.replace("maple", "birch")
+            self.assertEqual(edit_hahmon.update_host_activity(test_DB_name,
+                                                              line), 1,
+                             "update_host_activity() unknown")
+            cache = edit_hahmon.unknown_activity[test_DB_name]
+            self.assertEqual(edit_hahmon.update_host_activity(test_DB_name,
+                                                              line), 1,
+                             "update_host_activity() unknown, cached")
+            self.assertEqual(cache.hits, 1, "answered from the cache")
+            edit_hahmon.insert_host(test_DB_name, "birch", 300)
+            self.assertEqual(edit_hahmon.update_host_activity(test_DB_name,
+                                                              line), 0,
+                             "update_host_activity() registered")
+        finally:
+            edit_hahmon.unknown_activity.clear()
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_activity_writer(self):
+        current_time = int(time.time())
+        time_time = time.time
+        bias = 0
+
+        def mytime(): return current_time + bias
+        time.time = mytime
+
+        try:
+            edit_hahmon.create_database(test_DB_name)
+            edit_hahmon.insert_host(test_DB_name, "oak", 300)
+            edit_hahmon.insert_host(test_DB_name, "oak", 500,
+                                    "home_automation/oak/some/topic")
+
+            writer = edit_hahmon.ActivityWriter(test_DB_name)
+            bias = 1000
+            self.assertEqual(writer.update(
+                "home_automation/oak/roamer/temp 1536080280, 92.36"), 0,
+                "update host w/out topic")
+            bias = 2000
+            self.assertEqual(writer.update(
+                "home_automation/oak/some/topic 1536080280, 92.36"), 0,
+                "update host w/ topic")
+            self.assertEqual(writer.update(
+                "home_automation/maple/some/topic 1536080280, 92.36"), 1,
+                "unknown host")
+            self.assertEqual(writer.update("garbage"), 2, "unparsable line")
+
+            # writer is still open and records are visible to other readers
+            self.validate_record("oak", current_time + 1000, 300)
+            self.validate_record("oak", current_time + 2000, 500,
+                                 "home_automation/oak/some/topic")
+
+            # receive time supplied by the caller
+            self.assertEqual(writer.record("oak", "home_automation/oak/some/topic",
+                                           current_time + 1500), 0,
+                             "record with timestamp")
+            self.validate_record("oak", current_time + 1500, 500,
+                                 "home_automation/oak/some/topic")
+
+            writer.close()
+            self.assertEqual(writer.update(
+                "home_automation/oak/some/topic 1536080280, 92.36"), 2,
+                "update after close")
+        finally:
+            time.time = time_time
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_activity_writer_batching(self):
+        current_time = int(time.time())
+        time_time = time.time
+        bias = 0
+
+        def mytime(): return current_time + bias
+        time.time = mytime
+
+        try:
+            edit_hahmon.create_database(test_DB_name)
+            edit_hahmon.insert_host(test_DB_name, "oak", 300)
+            edit_hahmon.insert_host(test_DB_name, "maple", 300)
+            edit_hahmon.insert_host(test_DB_name, "olive", 300)
+
+            writer = edit_hahmon.ActivityWriter(test_DB_name,
+                                                flush_interval=60, flush_size=3)
+            # repeated messages for a host coalesce and are not yet written
+            for bias in range(1, 10):
+                self.assertEqual(writer.update(
+                    "home_automation/oak/roamer/temp 1536080280, 92.36"), 0,
+                    "update oak")
+                self.assertEqual(writer.update(
+                    "home_automation/maple/roamer/temp 1536080280, 92.36"), 0,
+                    "update maple")
+            self.assertEqual(writer.commits, 0, "no commit before threshold")
+            self.validate_record("oak", current_time, 300)
+
+            # third distinct host reaches flush_size
+            self.assertEqual(writer.update(
+                "home_automation/olive/roamer/temp 1536080280, 92.36"), 0,
+                "update olive")
+            self.assertEqual(writer.commits, 1, "one commit at threshold")
+            self.validate_record("oak", current_time + 9, 300)
+            self.validate_record("maple", current_time + 9, 300)
+            self.validate_record("olive", current_time + 9, 300)
+
+            # interval elapses with no further messages
+            bias = 20
+            writer.update("home_automation/oak/roamer/temp 1536080280, 92.36")
+            writer.poll()
+            self.assertEqual(writer.commits, 1, "no commit before interval")
+            bias = 100
+            writer.poll()
+            self.assertEqual(writer.commits, 2, "commit after interval")
+            self.validate_record("oak", current_time + 20, 300)
+
+            # pending updates are written on close
+            bias = 110
+            writer.update("home_automation/maple/roamer/temp 1536080280, 92.36")
+            writer.close()
+            self.assertEqual(writer.commits, 3, "commit on close")
+            self.validate_record("maple", current_time + 110, 300)
+        finally:
+            time.time = time_time
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_activity_writer_scanner(self):
+        import scan_hahmon
+
+        current_time = int(time.time())
+        time_time = time.time
+        bias = 0
+
+        def mytime(): return current_time + bias
+        time.time = mytime
+
+        def status(name):
+            with contextlib.closing(sqlite3.connect(test_DB_name)) as conn:
+                return conn.execute('''select status from host_activity
+                        where host=?''', (name,)).fetchone()[0]
+
+        try:
+            edit_hahmon.create_database(test_DB_name)
+            edit_hahmon.insert_host(test_DB_name, "oak", 300)
+            edit_hahmon.insert_host(test_DB_name, "maple", 100)
+
+            class Alerts:
+
+                def __init__(self):
+                    self.events = []
+
+                def late(self, host, topic):
+                    self.events.append(("late", host, topic))
+
+                def unknown(self, host, topic):
+                    self.events.append(("unknown", host, topic))
+
+            alerts = Alerts()
+            scanner = scan_hahmon.OverdueScanner()
+            writer = edit_hahmon.ActivityWriter(test_DB_name, 60, 100, scanner,
+                                                alerts=alerts)
+            self.assertEqual(len(scanner), 2, "scanner loaded")
+
+            bias = 10
+            writer.update("home_automation/oak/roamer/temp 1536080280, 92.36")
+            self.assertEqual(writer.poll(), [], "nothing late")
+            self.assertEqual(status("oak"), "unknown", "not yet written")
+
+            bias = 100
+            self.assertEqual(writer.poll(), [("maple", None)], "maple late")
+            self.assertEqual(writer.commits, 1, "late status written")
+            self.assertEqual(status("maple"), "late", "maple late")
+            self.assertEqual(status("oak"), "alive", "oak alive")
+
+            # added after the writer was opened
+            edit_hahmon.insert_host(test_DB_name, "olive", 100)
+            bias = 150
+            writer.update("home_automation/olive/roamer/temp 1536080280")
+            bias = 250
+            self.assertEqual(writer.poll(), [("olive", None)], "olive late")
+
+            # deleted after the writer was opened
+            edit_hahmon.delete_host(test_DB_name, "oak")
+            bias = 310
+            self.assertEqual(writer.poll(), [], "deleted record not reported")
+            self.assertEqual(len(scanner), 2, "deleted record dropped")
+
+            # added and never heard from, then given a longer timeout
+            edit_hahmon.insert_host(test_DB_name, "birch", 100)
+            writer.poll()
+            self.assertIn(("birch", None), scanner, "new record watched")
+            edit_hahmon.update_host_timeout(test_DB_name, "birch", 200)
+            bias = 420
+            self.assertEqual(writer.poll(), [], "longer timeout applied")
+            bias = 520
+            self.assertEqual(writer.poll(), [("birch", None)], "birch late")
+
+            # deleted after poll() checked the registrations
+            edit_hahmon.insert_host(test_DB_name, "aspen", 100)
+            writer.poll()
+            edit_hahmon.delete_host(test_DB_name, "aspen")
+            writer.registration = edit_hahmon.registration_version(
+                writer.cursor)
+            bias = 700
+            self.assertEqual(writer.poll(), [],
+                             "not reported once the status write misses")
+            self.assertNotIn(("aspen", None), scanner, "deleted record dropped")
+
+            writer.update("home_automation/elm/roamer/temp 1536080280")
+            self.assertEqual(alerts.events, [
+                ("late", "maple", None), ("late", "olive", None),
+                ("late", "birch", None),
+                ("unknown", "elm", "home_automation/elm/roamer/temp")],
+                "alerts for late and unknown hosts")
+            writer.close()
+        finally:
+            time.time = time_time
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_activity_writer_adaptive(self):
+        import scan_hahmon
+        now = [1000]
+        self.assertEqual(edit_hahmon.create_database(test_DB_name), 0,
+                         "create database")
+        edit_hahmon.insert_host(test_DB_name, "oak", 3600)
+        try:
+            scanner = scan_hahmon.OverdueScanner(adaptive=4)
+            writer = edit_hahmon.ActivityWriter(test_DB_name, 60, 100, scanner,
+                                                clock=lambda: now[0])
+            for _ in range(scan_hahmon.MIN_GAPS + 1):
+                now[0] += 60
+                writer.update("home_automation/oak/roamer/temp 1536080280")
+            writer.flush()
+
+            records = list(edit_hahmon.iter_hosts(test_DB_name, host="oak"))
+            self.assertEqual(records[0][2:], (now[0], 3600, "alive",
+                                              now[0] + 120, 60.0, 0.0, 60,
+                                              scan_hahmon.MIN_GAPS),
+                             "adaptive deadline and statistics written")
+            self.assertEqual(list(edit_hahmon.format_hosts(records)),
+                             ["oak None {} 3600 alive interval 60.0 sd 0.0 "
+                              "max 60".format(now[0])], "statistics listed")
+
+            now[0] += 120
+            self.assertEqual(writer.poll(), [("oak", None)],
+                             "late after two missed messages")
+            writer.close()
+
+            # statistics are loaded on restart
+            scanner = scan_hahmon.OverdueScanner(adaptive=4)
+            writer = edit_hahmon.ActivityWriter(test_DB_name, scanner=scanner)
+            self.assertEqual(scanner.stats("oak", None),
+                             (60.0, 0.0, 60, scan_hahmon.MIN_GAPS),
+                             "statistics loaded")
+            writer.close()
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
     def test_list(self):
         # create/populate database
 
@@ -438,6 +1024,277 @@ class UpdateHAmonTest(unittest.TestCase):
         # comment next line to allow manual examination of database
         pathlib.Path.unlink(pathlib.Path(test_DB_name))
 
+    def test_list_overdue(self):
+        # version 1 database, before the deadline column
+        conn = sqlite3.connect(test_DB_name)
+        conn.execute('''CREATE TABLE host_activity
+                (host TEXT, topic TEXT, timestamp INTEGER, timeout INTEGER,
+                status TEXT)''')
+        conn.executemany(
+            "insert into host_activity(host, topic, timestamp, timeout, status) \
+                values (?,?,?,?,?)", [
+                ("oak", None,           1000, 300, 'alive'),
+                ("oak", "/some/topic",  1000, 100, 'alive'),
+                ("maple", None,         2000, 300, 'alive'),
+            ])
+        conn.execute('pragma user_version = 1')
+        edit_hahmon.close_connection(conn)
+
+        try:
+            (status, results) = edit_hahmon.list_overdue(test_DB_name, 1200)
+            self.assertEqual(status, 0, "non-zero status list_overdue()")
+            self.assertEqual(results, ['oak /some/topic 1000 100 alive'],
+                             "list_overdue() after upgrade")
+            (status, results) = edit_hahmon.list_overdue(test_DB_name, 2250)
+            self.assertEqual(results, ['oak /some/topic 1000 100 alive',
+                                       'oak None 1000 300 alive'],
+                             "list_overdue() most overdue first")
+
+            conn = sqlite3.connect(test_DB_name)
+            plan = conn.execute('''explain query plan select * from host_activity
+                    where deadline < ? order by deadline''', (1200,)).fetchall()
+            self.assertTrue(any("activity_deadline" in row[3] for row in plan),
+                            "deadline index used")
+            conn.close()
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_iter_hosts(self):
+        self.populate_test_DB(test_DB_name, [
+            ("oak", None,           1000, 300, 'alive'),
+            ("oak", "/some/topic",  1000, 100, 'late'),
+            ("oak_pi", None,        1000, 300, 'alive'),
+            ("maple", None,         2000, 300, 'unknown'),
+            ("maple", "/a",         2000, 300, 'alive'),
+        ])
+        conn = sqlite3.connect(test_DB_name)
+        conn.execute("update host_activity set deadline=timestamp + timeout")
+        edit_hahmon.close_connection(conn)
+
+        def keys(**filters):
+            return [(record[0], record[1]) for record in
+                    edit_hahmon.iter_hosts(test_DB_name, **filters)]
+
+        try:
+            self.assertEqual(keys(), [("maple", None), ("maple", "/a"),
+                                      ("oak", None), ("oak", "/some/topic"),
+                                      ("oak_pi", None)], "host, topic order")
+            self.assertEqual(keys(host="oak"), [("oak", None),
+                                                ("oak", "/some/topic")],
+                             "exact host match, '_' is not a wildcard")
+            self.assertEqual(keys(topic="/a"), [("maple", "/a")], "topic")
+            self.assertEqual(keys(status="alive"), [("maple", "/a"),
+                                                    ("oak", None),
+                                                    ("oak_pi", None)], "status")
+            self.assertEqual(keys(overdue=100, now=1400),
+                             [("oak", "/some/topic")],
+                             "more than 100 s overdue")
+
+            # keyset pagination
+            pages = []
+            after = None
+            while True:
+                page = keys(after=after, limit=2)
+                if not page:
+                    break
+                pages.append(page)
+                after = page[-1]
+            self.assertEqual(pages, [[("maple", None), ("maple", "/a")],
+                                     [("oak", None), ("oak", "/some/topic")],
+                                     [("oak_pi", None)]], "pages")
+            self.assertEqual(keys(after=("oak", None)),
+                             [("oak", "/some/topic"), ("oak_pi", None)],
+                             "after a record without topic")
+
+            records = list(edit_hahmon.iter_hosts(test_DB_name, host="maple"))
+            self.assertEqual(list(edit_hahmon.format_hosts(records)),
+                             ["maple None 2000 300 unknown",
+                              "maple /a 2000 300 alive"], "text")
+            self.assertEqual(list(edit_hahmon.format_hosts(records, "tsv")),
+                             ["host\ttopic\ttimestamp\ttimeout\tstatus\tdeadline"
+                              "\tgap_mean\tgap_variance\tgap_max\tgap_count",
+                              "maple\t\t2000\t300\tunknown\t2300\t\t\t\t",
+                              "maple\t/a\t2000\t300\talive\t2300\t\t\t\t"],
+                             "TSV")
+            self.assertEqual(
+                [json.loads(line) for line in
+                 edit_hahmon.format_hosts(records[:1], "jsonl")],
+                [{"host": "maple", "topic": None, "timestamp": 2000,
+                  "timeout": 300, "status": "unknown", "deadline": 2300,
+                  "gap_mean": None, "gap_variance": None, "gap_max": None,
+                  "gap_count": None}],
+                "JSON Lines")
+            self.assertEqual(list(edit_hahmon.format_hosts(
+                [("oak", None, 1000, 300, "alive", 1300, 60.0, 4.0, 75, 9)])),
+                ["oak None 1000 300 alive interval 60.0 sd 2.0 max 75"],
+                "text with interval statistics")
+
+            conn = sqlite3.connect(test_DB_name)
+            for (filters, index) in (({"host": "oak"}, "host_name"),
+                                     ({"after": ("oak", None), "limit": 10},
+                                      "host_name"),
+                                     ({"overdue": 60, "now": 2500},
+                                      "activity_deadline (deadline<?)"),
+                                     ({"overdue": 60, "after": ("oak", None),
+                                       "limit": 10},
+                                      "activity_deadline (deadline<?)"),
+                                     ({"status": "late"},
+                                      "activity_status (status=?)"),
+                                     ({"status": "late", "overdue": 60},
+                                      "activity_status (status=? AND "
+                                      "deadline<?)")):
+                plan = conn.execute("explain query plan " +
+                                    edit_hahmon.hosts_query(**filters)[0],
+                                    edit_hahmon.hosts_query(**filters)[1]).fetchall()
+                self.assertTrue(any(index in row[3] for row in plan),
+                                "{} uses {}: {}".format(filters, index, plan))
+            conn.close()
+
+            with self.assertRaises(sqlite3.Error):
+                list(edit_hahmon.iter_hosts("no_such.db"))
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_list_cli(self):
+        self.populate_test_DB(test_DB_name, [
+            ("oak", None,           1000, 300, 'alive'),
+            ("maple", "/a",         2000, 300, 'late'),
+        ])
+        env = dict(os.environ, DB_NAME_ENV=test_DB_name)
+        try:
+            result = subprocess.run(
+                ["python3", "edit_hahmon.py", "-l", "--output", "jsonl"],
+                env=env, stdout=subprocess.PIPE, check=True)
+            self.assertEqual([(record["host"], record["topic"]) for record in
+                              map(json.loads, result.stdout.splitlines())],
+                             [("maple", "/a"), ("oak", None)],
+                             "only JSON Lines on stdout")
+
+            result = subprocess.run(
+                ["python3", "edit_hahmon.py", "-l", "oak", "--output", "tsv"],
+                env=env, stdout=subprocess.PIPE, check=True)
+            self.assertEqual([line.split(b"\t")[:2] for line in
+                              result.stdout.splitlines()],
+                             [[b"host", b"topic"], [b"oak", b""]],
+                             "only TSV on stdout")
+
+            result = subprocess.run(
+                ["python3", "edit_hahmon.py", "-l", "oak", "--output", "jsonl",
+                 "--log_level", "DEBUG"], env=env, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, check=True)
+            self.assertEqual(len(result.stdout.splitlines()), 1,
+                             "still only the record on stdout")
+            self.assertIn("DB is " + test_DB_name, result.stderr.decode(),
+                          "diagnostics logged to stderr")
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_database_pragmas(self):
+        self.assertEqual(edit_hahmon.database_pragmas({}),
+                         edit_hahmon.DB_PRAGMAS, "defaults")
+        pragmas = edit_hahmon.database_pragmas(
+            {"HAHMON_PRAGMAS": "synchronous=FULL, cache_size=-32000,"})
+        self.assertEqual((pragmas["synchronous"], pragmas["cache_size"],
+                          pragmas["journal_mode"]), ("FULL", "-32000", "wal"),
+                         "settings from the environment")
+        for bad in ("foreign_keys=on", "synchronous=full;drop",
+                    "cache_size"):
+            with self.assertRaises(ValueError):
+                edit_hahmon.database_pragmas({"HAHMON_PRAGMAS": bad})
+
+    def test_connect(self):
+        self.assertEqual(edit_hahmon.create_database(test_DB_name), 0,
+                         "create database")
+        edit_hahmon.insert_host(test_DB_name, "oak", 300)
+        try:
+            writer = edit_hahmon.connect(test_DB_name)
+            self.assertEqual(writer.execute('pragma journal_mode').fetchone()[0],
+                             "wal", "WAL mode")
+            self.assertEqual(writer.execute('pragma busy_timeout').fetchone()[0],
+                             5000, "busy timeout")
+
+            reader = edit_hahmon.connect(test_DB_name, read_only=True)
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.execute("delete from host_activity")
+            reader.close()
+
+            # listing while the monitor holds the write lock
+            writer.execute("update host_activity set status='alive'")
+            (status, results) = edit_hahmon.list_db(test_DB_name)
+            self.assertEqual(status, 0, "list while writing")
+            self.assertEqual(len(results), 1, "one record")
+            self.assertTrue(results[0].endswith("unknown"),
+                            "last committed status listed")
+            (status, results) = edit_hahmon.list_overdue(test_DB_name)
+            self.assertEqual(status, 0, "list overdue while writing")
+            writer.commit()
+            writer.close()
+
+            self.assertIsNone(edit_hahmon.open_database("no_such.db",
+                                                        read_only=True),
+                              "read only does not create a database")
+            self.assertFalse(os.path.exists("no_such.db"), "not created")
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_import_export(self):
+        registrations = edit_hahmon.read_registrations(io.StringIO(
+            "host,topic,timeout\n"
+            "oak,,300\n"
+            "oak,home_automation/oak/a/b,600\n"
+            "\n"
+            "maple\n"), "csv")
+        self.assertEqual(registrations, [("oak", None, 300),
+                                         ("oak", "home_automation/oak/a/b", 600),
+                                         ("maple", None, 300)], "CSV")
+        self.assertEqual(edit_hahmon.read_registrations(io.StringIO(
+            '{"host": "oak", "topic": null, "timeout": 300}\n\n'
+            '{"host": "elm", "timeout": 60}\n'), "jsonl"),
+            [("oak", None, 300), ("elm", None, 60)], "JSON Lines")
+        for (bad, format) in ((",,300\n", "csv"), ("oak,,soon\n", "csv"),
+                              ('{"host": "oak"\n', "jsonl"), ('[1]\n', "jsonl")):
+            with self.assertRaises(ValueError, msg=bad):
+                edit_hahmon.read_registrations(io.StringIO(bad), format)
+        self.assertEqual(edit_hahmon.registration_format("hosts.jsonl"), "jsonl")
+        self.assertEqual(edit_hahmon.registration_format("hosts.txt"), "csv")
+        self.assertEqual(edit_hahmon.registration_format("hosts.txt", "jsonl"),
+                         "jsonl")
+
+        self.assertEqual(edit_hahmon.create_database(test_DB_name), 0,
+                         "create database")
+        now = int(time.time())
+        time_time = time.time
+        time.time = lambda: now     # records compared to the time added
+        edit_hahmon.insert_host(test_DB_name, "oak", 300)
+        edit_hahmon.insert_host(test_DB_name, "elm", 300)
+        try:
+            (status, counts) = edit_hahmon.import_hosts(
+                test_DB_name, registrations + [("elm", None, 60),
+                                               ("maple", None, 900)])
+            self.assertEqual(status, 0, "import status")
+            self.assertEqual(counts, {"inserted": 2, "updated": 1, "skipped": 2},
+                             "import counts")
+            self.validate_record("elm", now, 60)
+            self.validate_record("maple", now, 300)
+
+            for format in ("csv", "jsonl"):
+                f = io.StringIO()
+                self.assertEqual(edit_hahmon.export_hosts(test_DB_name, f,
+                                                          format), (0, 4),
+                                 "export " + format)
+                f.seek(0)
+                self.assertEqual(edit_hahmon.read_registrations(f, format), [
+                    ("elm", None, 60), ("maple", None, 300), ("oak", None, 300),
+                    ("oak", "home_automation/oak/a/b", 600)],
+                    "read back " + format)
+            (status, counts) = edit_hahmon.import_hosts(test_DB_name,
+                                                        registrations)
+            self.assertEqual(counts, {"inserted": 0, "updated": 0, "skipped": 3},
+                             "import again")
+        finally:
+            time.time = time_time
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
     def test_parse_args(self):
         import sys
 
@@ -537,6 +1394,29 @@ class UpdateHAmonTest(unittest.TestCase):
         args = edit_hahmon.parse_args(['-l', 'somehost'])
         self.assertEqual(args.listhost, "somehost",
                          "['-l', 'somehost'] didn't return 'somehost'")
+
+        # test --import and --export
+        args = edit_hahmon.parse_args(['-i', 'hosts.csv'])
+        self.assertTrue(args.importfile == 'hosts.csv' and args.format is None,
+                        "['-i', 'hosts.csv']")
+        args = edit_hahmon.parse_args(['--export', 'hosts', '--format', 'jsonl'])
+        self.assertTrue(args.exportfile == 'hosts' and args.format == 'jsonl',
+                        "['--export', 'hosts', '--format', 'jsonl']")
+        with self.assertRaises(SystemExit, msg="exit on [-i -e]"):
+            edit_hahmon.parse_args(['-i', 'a.csv', '-e', 'b.csv'])
+
+        # test --list filters, paging and output
+        args = edit_hahmon.parse_args(['-l', '--status', 'late', '--overdue',
+                                       '60', '--after', 'oak', '/a/b',
+                                       '--limit', '100', '--output', 'jsonl'])
+        self.assertTrue(args.listhost is None and args.status == 'late' and
+                        args.overdue == 60 and args.after == ['oak', '/a/b'] and
+                        args.limit == 100 and args.output == 'jsonl',
+                        "list options")
+        self.assertEqual(edit_hahmon.parse_args(['-l']).output, 'text',
+                         "text output by default")
+        with self.assertRaises(SystemExit, msg="exit on [--after a b c]"):
+            edit_hahmon.parse_args(['-l', '--after', 'a', 'b', 'c'])
         '''
         self.assertEqual(args.addhost[1], "sometopic", "didn't return 'sometopic'")
         self.assertEqual(args.addhost[2], "superfluous", "didn't return 'superfluous'")
@@ -5,8 +5,10 @@ Test program for edit_hahmon (Home Automation Host Monitor)
 """
 
 import hahmon
-# import edit_hahmon
+import edit_hahmon
 import unittest
+import atexit
+import logging
 import sys
 import os
 
@@ -29,6 +31,182 @@ class HAmonTest(unittest.TestCase):
         self.assertEqual(
             rc, ('brandywine', '/roamer/outside_temp_humidity', 1553831160),
                         "parse_MQTT_msg()")
+        rc = hahmon.parse_MQTT_msg(
+            b'ha/brandywine/roamer/outside_temp_humidity 1553831160, 47.54, 76.44')
+        self.assertEqual(
+            rc, ('brandywine', '/roamer/outside_temp_humidity', 1553831160),
+                        "parse_MQTT_msg(bytes)")
+        self.assertEqual(hahmon.parse_MQTT_msg('ha/brandywine/roamer 1553831160, 1'),
+                         None, "parse_MQTT_msg() short topic")
+        self.assertEqual(hahmon.parse_MQTT_msg('ha/brandywine/roamer/temp ON'),
+                         None, "parse_MQTT_msg() no timestamp")
+
+    def test_setup_logging(self):
+
+        class Handler(logging.Handler):
+
+            def __init__(self):
+                super().__init__()
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(self.format(record))
+
+        class Expensive:
+            formatted = 0
+
+            def __repr__(self):
+                Expensive.formatted += 1
+                return "expensive"
+
+        root = logging.getLogger()
+        (saved_handlers, saved_level) = (root.handlers[:], root.level)
+        handler = Handler()
+        handler.setFormatter(logging.Formatter(hahmon.LOG_FORMAT))
+        listener = hahmon.setup_logging(logging.INFO, handler)
+        try:
+            logger = logging.getLogger("hahmon.test")
+            logger.debug("message payload=%r", Expensive())
+            logger.warning("late host=%s topic=%s", "oak", None)
+        finally:
+            listener.stop()     # waits for queued records
+            atexit.unregister(listener.stop)
+            root.handlers = saved_handlers
+            root.setLevel(saved_level)
+
+        self.assertEqual(Expensive.formatted, 0, "debug not formatted")
+        self.assertEqual(len(handler.records), 1, "one record")
+        self.assertTrue(handler.records[0].endswith(
+            "level=WARNING logger=hahmon.test late host=oak topic=None"),
+            "key=value record")
+
+    def test_ingest_worker(self):
+
+        class Writer:
+
+            def __init__(self):
+                self.records = []
+                self.polls = 0
+
+            def record(self, host, topic, timestamp=None):
+                self.records.append((host, topic))
+                return 0
+
+            def poll(self):
+                self.polls += 1
+                return []
+
+        writer = Writer()
+        worker = hahmon.IngestWorker(writer, queue_size=3, batch_size=2,
+                                     poll_interval=0.01)
+        for i in range(5):      # not started, queue fills
+            worker.put("oak", "home_automation/oak/a/" + str(i))
+        self.assertEqual(worker.stats()["depth"], 3, "queue depth")
+        self.assertEqual(worker.stats()["shed"], 2, "shed when full")
+
+        worker.start()
+        worker.stop()       # drains the queue before stopping
+        self.assertFalse(worker.is_alive(), "stopped")
+        self.assertEqual(writer.records,
+                         [("oak", "home_automation/oak/a/" + str(i))
+                          for i in range(3)], "queued messages written")
+        stats = worker.stats()
+        self.assertEqual((stats["depth"], stats["processed"]), (0, 3),
+                         "queue drained")
+        self.assertTrue(stats["lag"] > 0, "lag measured")
+        self.assertTrue(writer.polls >= 2, "writer polled per batch")
+
+    def test_subscriptions(self):
+
+        class Client:
+
+            def __init__(self):
+                self.sent = []
+
+            def subscribe(self, topics):
+                self.sent.append(("subscribe", [topic for (topic, qos) in topics]))
+
+            def unsubscribe(self, topics):
+                self.sent.append(("unsubscribe", topics))
+
+        db_name = "ha_subscriptions_test.db"
+        edit_hahmon.create_database(db_name)
+        edit_hahmon.insert_host(db_name, "oak", 300)
+        edit_hahmon.insert_host(db_name, "oak", 300, "home_automation/oak/a")
+        edit_hahmon.insert_host(db_name, "maple", 300, "home_automation/maple/a")
+        client = Client()
+        subscriptions = hahmon.Subscriptions(db_name)
+        try:
+            self.assertEqual(subscriptions.update(client),
+                             (["+/oak/#", "home_automation/maple/a"], []),
+                             "covered topic left out")
+            self.assertEqual(subscriptions.update(client), ([], []),
+                             "database unchanged")
+            edit_hahmon.update_host_activity(db_name, "home_automation/oak/a 1")
+            self.assertIsNone(subscriptions.wanted(),
+                              "not read again for recorded activity")
+
+            edit_hahmon.insert_host(db_name, "maple", 300,
+                                    "home_automation/maple/#")
+            edit_hahmon.delete_host(db_name, "oak")
+            self.assertEqual(subscriptions.update(client),
+                             (["home_automation/maple/#",
+                               "home_automation/oak/a"],
+                              ["+/oak/#", "home_automation/maple/a"]),
+                             "differences sent")
+
+            subscriptions.reset()   # reconnected
+            self.assertEqual(subscriptions.update(client),
+                             (["home_automation/maple/#",
+                               "home_automation/oak/a"], []),
+                             "subscribed again")
+            self.assertEqual([kind for (kind, topics) in client.sent],
+                             ["subscribe", "subscribe", "unsubscribe",
+                              "subscribe"], "sent to the client")
+        finally:
+            subscriptions.close()   # read only, leaves the WAL files behind
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_name + suffix):
+                    os.unlink(db_name + suffix)
+
+        subscriptions = hahmon.Subscriptions("/no/such/directory/db")
+        self.assertEqual(subscriptions.update(Client()), (["#"], []),
+                         "everything if the database cannot be read")
+
+    def test_coalescing_queue(self):
+        q = hahmon.CoalescingQueue(4)
+        for t in range(3):
+            q.put("oak", "a", 100 + t)
+        self.assertEqual(q.qsize(), 3, "in order until full")
+        q.put("maple", "a", 200)
+        self.assertEqual(q.qsize(), 4, "full")
+
+        # full: coalesce by host/topic keeping the newest timestamp
+        q.put("oak", "a", 103)
+        self.assertEqual(q.qsize(), 2, "coalesced")
+        self.assertEqual(q.coalesced, 3, "coalesced count")
+        q.put("olive", "a", 300)
+        q.put("olive", "b", 301)
+        self.assertEqual(q.qsize(), 4, "distinct pairs up to maxsize")
+        q.put("olive", "c", 302)
+        self.assertEqual(q.shed, 1, "new pair shed when full")
+        q.put("maple", "a", 201)
+        self.assertEqual((q.qsize(), q.coalesced, q.shed), (4, 4, 1),
+                         "known pair still coalesced")
+
+        self.assertEqual(q.get_batch(3, 0), [("oak", "a", 103),
+                                             ("maple", "a", 201),
+                                             ("olive", "a", 300)],
+                         "newest per pair in arrival order")
+        q.put("olive", "b", 305)
+        self.assertEqual(q.get_batch(10, 0), [("olive", "b", 305)],
+                         "drained")
+        q.put("oak", "a", 400)
+        q.put("oak", "a", 401)
+        self.assertEqual(q.get_batch(10, 0), [("oak", "a", 400),
+                                              ("oak", "a", 401)],
+                         "every message kept once drained")
+        self.assertEqual(q.get_batch(10, 0.01), [], "empty")
 
     def test_parse_args(self):
 
@@ -69,6 +247,25 @@ class HAmonTest(unittest.TestCase):
 
         self.assertTrue(
             args.broker == ['broker_host'] and args.db_name == ['test.db'])
+        self.assertTrue(args.flush_interval == 5 and args.flush_size == 1000,
+                        "flush defaults")
+        self.assertEqual(args.log_level, "INFO", "log level default")
+        self.assertTrue(args.threaded == False and args.queue_size == 10000,
+                        "threading defaults")
+        self.assertIsNone(args.metrics, "metrics default")
+        self.assertFalse(args.subscribe_all, "subscriptions narrowed")
+        self.assertTrue(args.snapshot is None and args.snapshot_interval == 60,
+                        "snapshot defaults")
+
+        args = hahmon.parse_args(
+            ['--db_name', 'test.db', '--broker', 'broker_host',
+             '-f', '30', '--flush_size', '10', '-m', 'unix:/tmp/hahmon.sock'])
+        self.assertTrue(args.flush_interval == 30 and args.flush_size == 10,
+                        "flush settings")
+        self.assertEqual(args.metrics, "unix:/tmp/hahmon.sock", "metrics")
+        self.assertTrue(hahmon.parse_args(
+            ['--db_name', 'test.db', '--broker', 'broker_host',
+             '--subscribe_all']).subscribe_all, "subscribe to '#'")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Test program for metrics_hahmon (Home Automation Host Monitor)
+"""
+
+import metrics_hahmon
+import unittest
+import os
+import socket
+import tempfile
+
+
+class MetricsHAmonTest(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics_hahmon.Registry()
+        messages = registry.counter("test_messages_total", "Messages.")
+        latency = registry.histogram("test_seconds", "Latency.", (0.1, 1))
+        self.assertIs(registry.counter("test_messages_total", "Messages."),
+                      messages, "existing metric returned")
+
+        messages.inc()
+        messages.inc(2)
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value)
+
+        self.assertEqual(registry.render(), "\n".join([
+            "# HELP test_messages_total Messages.",
+            "# TYPE test_messages_total counter",
+            "test_messages_total 3",
+            "# HELP test_seconds Latency.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            "test_seconds_sum 3.65",
+            "test_seconds_count 4",
+        ]) + "\n", "Prometheus text format")
+
+    def test_changes_merge(self):
+        shard = metrics_hahmon.Registry()     # recording in another process
+        unknown = shard.counter("test_unknown_total", "Unknown.")
+        latency = shard.histogram("test_seconds", "Latency.", (0.1, 1))
+        unknown.inc(5)
+        state = shard.state()
+        self.assertEqual(shard.changes(state), ({}, state), "no changes")
+
+        unknown.inc(2)
+        latency.observe(0.5)
+        (changes, state) = shard.changes(state)
+        self.assertEqual(changes, {"test_unknown_total": 2,
+                                   "test_seconds": ([0, 1, 0], 0.5)},
+                         "changes since the state")
+        self.assertEqual(shard.changes(state)[0], {}, "reported once")
+
+        registry = metrics_hahmon.Registry()
+        registry.counter("test_unknown_total", "Unknown.").inc()
+        registry.histogram("test_seconds", "Latency.", (0.1, 1))
+        registry.merge(changes)
+        registry.merge(changes)
+        self.assertIn("test_unknown_total 5\n", registry.render(),
+                      "counter merged")
+        self.assertIn("test_seconds_count 2\n", registry.render(),
+                      "histogram merged")
+
+    def test_exporters(self):
+        registry = metrics_hahmon.Registry()
+        registry.counter("test_total", "Test.").inc()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "hahmon.prom")
+            metrics_hahmon.write_file(path, registry)
+            with open(path) as f:
+                self.assertEqual(f.read(), registry.render(), "file")
+            self.assertEqual(os.listdir(tmp), ["hahmon.prom"],
+                             "no temporary file left")
+
+            path = os.path.join(tmp, "hahmon.sock")
+            exporter = metrics_hahmon.SocketExporter(path, registry)
+            exporter.start()
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(path)
+                received = b''
+                while True:
+                    block = client.recv(4096)
+                    if not block:
+                        break
+                    received += block
+            exporter.stop()
+            exporter.join(1)
+            self.assertEqual(received.decode(), registry.render(), "socket")
+            self.assertFalse(exporter.is_alive(), "stopped")
+            self.assertFalse(os.path.exists(path), "socket removed")
+
+
+if __name__ == "__main__":
+    unittest.main()
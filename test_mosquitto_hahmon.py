@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Test program for mosquitto_hahmon (Home Automation Host Monitor)
+"""
+
+import mosquitto_hahmon
+import edit_hahmon
+import replay_hahmon
+import unittest
+import contextlib
+import os
+import pathlib
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+test_DB_name = "ha_mosquitto_test.db"
+
+
+class MosquittoHAmonTest(unittest.TestCase):
+
+    def test_read_batches(self):
+        (rd, wr) = os.pipe()
+        batches = mosquitto_hahmon.read_batches(rd, timeout=0.01)
+
+        self.assertEqual(next(batches), b'', "timeout")
+        os.write(wr, b'home_automation/oak/a/b 1, 2\nhome_automation/ma')
+        self.assertEqual(next(batches), b'home_automation/oak/a/b 1, 2',
+                         "complete line")
+        os.write(wr, b'ple/a/b 1, 2\nhome_automation/oak/\xc3')
+        self.assertEqual(next(batches), b'home_automation/maple/a/b 1, 2',
+                         "partial line joined")
+        os.write(wr, b'\xa9/b 1, 2\nhome_automation/elm/a 1\n')
+        self.assertEqual(edit_hahmon.split_many(next(batches)),
+                         [("oak", "home_automation/oak/\u00e9/b"),
+                          ("elm", "home_automation/elm/a")],
+                         "character split across reads")
+        os.write(wr, b'home_automation/oak/a/b 3, 4')
+        self.assertEqual(next(batches), b'', "no complete line")
+        os.close(wr)
+        self.assertEqual(list(batches), [b'home_automation/oak/a/b 3, 4'],
+                         "line without newline at end of file")
+        os.close(rd)
+
+    def test_read_batches_long_line(self):
+        (rd, wr) = os.pipe()
+        batches = mosquitto_hahmon.read_batches(rd, timeout=0.01, size=16,
+                                                max_line=32)
+        os.write(wr, b'ha/oak/a 1\n' + b'x' * 40)
+        with self.assertLogs("mosquitto_hahmon", "WARNING"):
+            self.assertEqual(next(batches), b'ha/oak/a 1', "short line")
+            for _ in range(3):      # rest of the long line is read
+                self.assertEqual(next(batches), b'', "long line discarded")
+        os.write(wr, b'yy\nha/maple/a 2\n')
+        self.assertEqual(next(batches), b'ha/maple/a 2',
+                         "reading resumes after the long line")
+        os.close(wr)
+        self.assertEqual(list(batches), [], "end of file")
+        os.close(rd)
+
+    def test_ingest(self):
+        if os.path.isfile(test_DB_name):
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+        edit_hahmon.create_database(test_DB_name)
+        edit_hahmon.insert_host(test_DB_name, "oak", 300)
+        edit_hahmon.insert_host(test_DB_name, "maple", 300,
+                                "home_automation/maple/a/b")
+        lines = "".join("home_automation/{}/a/b {}, 72.50\n".format(host, i)
+                        for i in range(1000) for host in ("oak", "maple"))
+        try:
+            writer = edit_hahmon.ActivityWriter(test_DB_name, 60, 100)
+            proc = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            proc.stdin.write(lines.encode())
+            proc.stdin.close()
+            start = int(time.time())
+            mosquitto_hahmon.ingest(proc.stdout.fileno(), writer)
+            proc.wait()
+            writer.close()
+
+            self.assertEqual(writer.commits, 1, "one commit for all lines")
+            with contextlib.closing(sqlite3.connect(test_DB_name)) as conn:
+                self.assertEqual(conn.execute('''select count(*) from host_activity
+                        where timestamp >= ?''', (start,)).fetchone()[0], 2,
+                                 "both hosts updated")
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_ingest_worker(self):
+
+        class Worker:
+
+            def __init__(self):
+                self.queued = []
+
+            def put(self, host, topic):
+                self.queued.append((host, topic))
+
+            def flush(self):
+                pass
+
+        worker = Worker()
+        (rd, wr) = os.pipe()
+        os.write(wr, b'home_automation/oak/a/b 1, 2\nbad\n\n'
+                 b'home_automation/maple/a/b 1, 2\n')
+        os.close(wr)
+        with tempfile.TemporaryDirectory() as tmp:
+            recording = os.path.join(tmp, "recording")
+            recorder = replay_hahmon.Recorder(recording)
+            mosquitto_hahmon.ingest(rd, None, worker, recorder)
+            recorder.close()
+            self.assertEqual([(topic, payload) for (_, topic, payload) in
+                              replay_hahmon.read_recording(recording)],
+                             [("home_automation/oak/a/b", b'1, 2'),
+                              ("bad", b''),
+                              ("home_automation/maple/a/b", b'1, 2')],
+                             "lines recorded")
+        os.close(rd)
+        self.assertEqual(worker.queued, [("oak", "home_automation/oak/a/b"),
+                                         ("maple", "home_automation/maple/a/b")],
+                         "lines queued for the worker")
+
+
+if __name__ == "__main__":
+    unittest.main()
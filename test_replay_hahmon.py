@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Test program for replay_hahmon (Home Automation Host Monitor)
+"""
+
+import replay_hahmon
+import edit_hahmon
+import scan_hahmon
+import unittest
+import contextlib
+import os
+import pathlib
+import sqlite3
+import tempfile
+import time
+
+test_DB_name = "ha_replay_test.db"
+
+
+class ReplayHAmonTest(unittest.TestCase):
+
+    def test_record_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "recording")
+            self.assertEqual(list(replay_hahmon.read_recording(
+                os.devnull)), [], "empty file")
+
+            recorder = replay_hahmon.Recorder(path)
+            recorder.record("home_automation/oak/a/b", b'1, 72.50', 1000.5)
+            recorder.record_line("home_automation/maple/a/b 2, 30.98", 1001)
+            recorder.close()
+            recorder = replay_hahmon.Recorder(path)     # append
+            recorder.record("home_automation/oak/é/b", "3", 1002)
+            recorder.close()
+            with open(path, "ab") as f:
+                f.write(replay_hahmon.RECORD.pack(1003, 100, 0) + b'cut')
+
+            self.assertEqual(list(replay_hahmon.read_recording(path)), [
+                (1000.5, "home_automation/oak/a/b", b'1, 72.50'),
+                (1001, "home_automation/maple/a/b", b'2, 30.98'),
+                (1002, "home_automation/oak/é/b", b'3'),
+            ], "messages read back, truncated record ignored")
+
+            with open(path, "wb") as f:
+                f.write(b'home_automation/oak/a/b 1, 2\n')
+            with self.assertRaises(ValueError):
+                list(replay_hahmon.read_recording(path))
+
+    def test_replay(self):
+        if os.path.isfile(test_DB_name):
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+        edit_hahmon.create_database(test_DB_name)
+        edit_hahmon.insert_host(test_DB_name, "oak", 300)
+        edit_hahmon.insert_host(test_DB_name, "maple", 300)
+        start = int(time.time())
+        # oak every minute for an hour, maple stops after 10 minutes
+        messages = [(start + t, "home_automation/{}/a/b".format(host), b'')
+                    for t in range(0, 3600, 60)
+                    for host in ("oak", "maple") if host == "oak" or t < 600]
+        messages.append((start + 3600, "home_automation/elm/a/b", b''))
+        messages.append((start + 3600, "garbage", b''))
+        try:
+            clock = replay_hahmon.SimulatedClock(start)
+            writer = edit_hahmon.ActivityWriter(test_DB_name, 60, 1000,
+                                                scan_hahmon.OverdueScanner(),
+                                                clock)
+            stats = replay_hahmon.replay(messages, writer, clock)
+            writer.close()
+
+            self.assertEqual(stats["messages"], 71, "messages replayed")
+            self.assertEqual((stats["unknown"], stats["errors"]), (1, 1),
+                             "unknown host and unparsable topic")
+            self.assertEqual(stats["late"],
+                             [(start + 540 + 300, "maple", None)],
+                             "maple late 300 s after its last message")
+            with contextlib.closing(sqlite3.connect(test_DB_name)) as conn:
+                self.assertEqual(conn.execute('''select host, timestamp, status
+                        from host_activity order by host''').fetchall(),
+                                 [("maple", start + 540, "late"),
+                                  ("oak", start + 3540, "alive")],
+                                 "database written at simulated times")
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+    def test_rewind(self):
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.add("oak", None, 5000, 300, "alive")
+        scanner.add("maple", None, 500, 300, "late")
+        replay_hahmon.rewind(scanner, 1000)
+        self.assertEqual(scanner.get("oak", None),
+                         (1000, 300, "alive"), "newer record rewound")
+        self.assertEqual(scanner.get("maple", None),
+                         (500, 300, "late"), "older record kept")
+        self.assertEqual(scanner.check(1300), [("oak", None)],
+                         "rewound deadline")
+
+    def test_pace(self):
+        messages = [(1000 + t, "home_automation/oak/a/b", b'') for t in (0, 1, 2)]
+
+        class Writer:
+
+            def record(self, host, topic, timestamp):
+                return 0
+
+            def poll(self):
+                return []
+
+            def flush(self):
+                pass
+
+        clock = replay_hahmon.SimulatedClock()
+        stats = replay_hahmon.replay(messages, Writer(), clock, speed=20)
+        self.assertGreaterEqual(stats["seconds"], 0.1, "2 s played at 20x")
+        self.assertEqual(clock.now, 1002, "clock at last message")
+
+
+if __name__ == "__main__":
+    unittest.main()
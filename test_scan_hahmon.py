@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Test program for scan_hahmon (Home Automation Host Monitor)
+"""
+
+import scan_hahmon
+import unittest
+import sqlite3
+
+
+class ScanHAmonTest(unittest.TestCase):
+
+    def test_check(self):
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.add("oak", None, 1000, 300)
+        scanner.add("oak", "/some/topic", 1000, 500)
+        scanner.add("maple", None, 1000, 100)
+
+        self.assertEqual(scanner.next_deadline(), 1100, "earliest deadline")
+        self.assertEqual(scanner.check(1099), [], "nothing due")
+        self.assertEqual(scanner.check(1100), [("maple", None)],
+                         "maple late")
+        self.assertEqual(scanner.check(1200), [], "late reported once")
+        self.assertEqual(scanner.check(1500),
+                         [("oak", None), ("oak", "/some/topic")],
+                         "oak late in deadline order")
+        self.assertEqual(scanner.heap, [], "late records leave the queue")
+
+    def test_activity(self):
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.add("oak", None, 1000, 300)
+
+        self.assertTrue(scanner.activity("oak", None, 1100),
+                        "unknown -> alive")
+        self.assertFalse(scanner.activity("oak", None, 1200),
+                         "alive -> alive")
+        for t in range(1200, 1300):    # activity does not grow the queue
+            scanner.activity("oak", None, t)
+        self.assertEqual(len(scanner.heap), 1, "one entry per record")
+
+        # original deadline of 1300 comes due, entry is pushed back
+        self.assertEqual(scanner.check(1300), [], "heard from since queued")
+        self.assertEqual(scanner.next_deadline(), 1299 + 300, "new deadline")
+        self.assertEqual(scanner.check(1599), [("oak", None)], "late")
+
+        self.assertTrue(scanner.activity("oak", None, 1700), "late -> alive")
+        self.assertEqual(scanner.next_deadline(), 2000, "requeued")
+
+        # activity for a record added to the database since loading
+        self.assertFalse(scanner.activity("maple", None, 1700),
+                         "unknown record without timeout")
+        self.assertTrue(scanner.activity("maple", None, 1700, 60),
+                        "new record")
+        self.assertEqual(scanner.next_deadline(), 1760, "new record queued")
+
+    def test_set_timeout_remove(self):
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.add("oak", None, 1000, 300)
+        scanner.add("maple", None, 1000, 300)
+
+        scanner.set_timeout("oak", None, 100)
+        self.assertEqual(scanner.check(1100), [("oak", None)],
+                         "shorter timeout")
+        scanner.set_timeout("oak", None, 1000)  # late, not queued
+        scanner.remove("maple", None)
+        self.assertEqual(scanner.check(5000), [], "removed record")
+        self.assertEqual(len(scanner), 1, "one record left")
+
+    def test_reconcile(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute('''CREATE TABLE host_activity
+                (host TEXT, topic TEXT, timestamp INTEGER, timeout INTEGER,
+                status TEXT, gap_mean REAL, gap_variance REAL,
+                gap_max INTEGER, gap_count INTEGER)''')
+        conn.executemany('''insert into host_activity (host, topic,
+                timestamp, timeout, status) values (?,?,?,?,?)''', [
+            ("oak", None, 1000, 300, 'unknown'),
+            ("maple", None, 1000, 300, 'unknown'),
+        ])
+        cursor = conn.cursor()
+        scanner = scan_hahmon.OverdueScanner(owns=lambda host: host != "elm")
+        scanner.load(cursor)
+        scanner.activity("oak", None, 1100)
+
+        conn.execute("delete from host_activity where host='maple'")
+        conn.execute("update host_activity set timeout=100 where host='oak'")
+        conn.executemany('''insert into host_activity (host, topic,
+                timestamp, timeout, status) values (?,?,?,?,?)''', [
+            ("olive", None, 1050, 100, 'unknown'),
+            ("elm", None, 1050, 100, 'unknown'),
+        ])
+        self.assertEqual(scanner.reconcile(cursor), (1, 1, 1),
+                         "added, removed, changed")
+        self.assertEqual(sorted(scanner, key=str),
+                         [("oak", None), ("olive", None)], "records watched")
+        self.assertEqual(scanner.get("oak", None), (1100, 100, "alive"),
+                         "activity kept, timeout changed")
+        self.assertEqual(scanner.check(1200),
+                         [("olive", None), ("oak", None)],
+                         "new record and new timeout checked")
+        self.assertEqual(scanner.reconcile(cursor), (0, 0, 0), "in line")
+        conn.close()
+
+    def test_stats(self):
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.add("oak", None, 1000, 300)
+        self.assertEqual(scanner.stats("oak", None), (None, None, None, None),
+                         "not heard from")
+
+        scanner.activity("oak", None, 1100)     # first message, no interval
+        self.assertEqual(scanner.stats("oak", None), (None, None, None, 0),
+                         "heard once")
+        for t in (1160, 1160, 1220, 1280):      # second 1160 is a burst
+            scanner.activity("oak", None, t)
+        self.assertEqual(scanner.stats("oak", None), (60.0, 0.0, 60, 3),
+                         "steady interval")
+        scanner.activity("oak", None, 1380)
+        (mean, variance, longest, count) = scanner.stats("oak", None)
+        self.assertAlmostEqual(mean, 60 + 40 * scan_hahmon.GAP_ALPHA)
+        self.assertAlmostEqual(variance, (1 - scan_hahmon.GAP_ALPHA) *
+                               40 * 40 * scan_hahmon.GAP_ALPHA)
+        self.assertEqual((longest, count), (100, 4), "longest interval")
+
+        # an outage only counts toward the longest interval
+        self.assertEqual(scanner.check(1680), [("oak", None)], "late")
+        scanner.activity("oak", None, 2000)
+        self.assertEqual(scanner.stats("oak", None)[2:], (620, 4), "outage")
+        self.assertAlmostEqual(scanner.stats("oak", None)[0], mean)
+
+        scanner.add("oak", None, 2000, 300, "alive")
+        self.assertEqual(scanner.stats("oak", None)[3], 4,
+                         "kept when replaced")
+        self.assertIsNone(scanner.stats("maple", None), "no record")
+
+    def test_adaptive(self):
+        scanner = scan_hahmon.OverdueScanner(adaptive=4)
+        scanner.add("oak", None, 0, 3600)
+        scanner.add("maple", None, 0, 100)
+        for t in range(0, 60 * (scan_hahmon.MIN_GAPS + 1), 60):
+            scanner.activity("oak", None, t)
+            scanner.activity("maple", None, t)
+        last = 60 * scan_hahmon.MIN_GAPS
+        self.assertEqual(scanner.effective_timeout("oak", None), 120,
+                         "twice the interval, no deviation")
+        self.assertEqual(scanner.effective_timeout("maple", None), 100,
+                         "no longer than the timeout")
+        self.assertEqual(scanner.check(last + 100), [("maple", None)],
+                         "maple late at its timeout")
+        self.assertEqual(scanner.check(last + 119), [], "oak not yet late")
+        self.assertEqual(scanner.check(last + 120), [("oak", None)],
+                         "oak late long before its timeout")
+
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.add("oak", None, 0, 3600)
+        for t in range(0, 60 * (scan_hahmon.MIN_GAPS + 1), 60):
+            scanner.activity("oak", None, t)
+        self.assertEqual(scanner.effective_timeout("oak", None), 3600,
+                         "timeout used unless adaptive")
+
+    def test_load(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute('''CREATE TABLE host_activity
+                (host TEXT, topic TEXT, timestamp INTEGER, timeout INTEGER,
+                status TEXT, gap_mean REAL, gap_variance REAL,
+                gap_max INTEGER, gap_count INTEGER)''')
+        conn.executemany('''insert into host_activity
+                values (?,?,?,?,?,?,?,?,?)''', [
+            ("oak", None, 1000, 300, 'alive', 60.0, 4.0, 75, 9),
+            ("oak", "/some/topic", 1000, 500, 'unknown', None, None, None,
+             None),
+            ("maple", None, 1000, 100, 'late', None, None, None, None),
+        ])
+        cursor = conn.cursor()
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.load(cursor)
+
+        self.assertEqual(len(scanner), 3, "records loaded")
+        self.assertEqual(scanner.stats("oak", None), (60.0, 4.0, 75, 9),
+                         "statistics loaded")
+        scanner.activity("oak", None, 1000 + 3600)   # restarted an hour on
+        self.assertEqual(scanner.stats("oak", None), (60.0, 4.0, 75, 9),
+                         "time not running is not an interval")
+        scanner.activity("oak", None, 1000 + 3660)
+        self.assertEqual(scanner.stats("oak", None)[2:], (75, 10),
+                         "then intervals are counted")
+        scanner.add("oak", None, 4660, 300, "alive")    # reloaded
+        scanner.activity("oak", None, 9000)
+        self.assertEqual(scanner.stats("oak", None)[2:], (75, 10),
+                         "not counted after a reload")
+        self.assertEqual(scanner.check(2000),
+                         [("oak", "/some/topic")],
+                         "already late records not reported")
+
+        scanner = scan_hahmon.OverdueScanner(owns=lambda host: host == "oak")
+        scanner.load(cursor)
+        self.assertEqual(sorted(scanner, key=str),
+                         [("oak", "/some/topic"), ("oak", None)],
+                         "only owned hosts loaded")
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Test program for shard_hahmon (Home Automation Host Monitor)
+"""
+
+import shard_hahmon
+import edit_hahmon
+import metrics_hahmon
+import unittest
+import contextlib
+import os
+import pathlib
+import sqlite3
+import time
+
+test_DB_name = "ha_shard_test.db"
+
+
+class ShardHAmonTest(unittest.TestCase):
+
+    def test_shard_of(self):
+        self.assertEqual(shard_hahmon.shard_of("oak", 4), 441235257 % 4,
+                         "crc32 of the host")
+        hosts = ["host{}".format(i) for i in range(1000)]
+        counts = [0] * 4
+        for host in hosts:
+            counts[shard_hahmon.shard_of(host, 4)] += 1
+        self.assertTrue(all(200 < count < 300 for count in counts),
+                        "hosts spread across shards {}".format(counts))
+        self.assertTrue(all(shard_hahmon.shard_of(host, 1) == 0
+                            for host in hosts), "one shard")
+
+    def test_shard_pool(self):
+        if os.path.isfile(test_DB_name):
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+        edit_hahmon.create_database(test_DB_name)
+        hosts = ["host{}".format(i) for i in range(20)]
+        for host in hosts:
+            edit_hahmon.insert_host(test_DB_name, host, 300)
+        unknown = metrics_hahmon.UNKNOWN.value
+        commits = sum(metrics_hahmon.COMMIT_SECONDS.counts)
+        try:
+            pool = shard_hahmon.ShardPool(test_DB_name, 3, flush_interval=60,
+                                          flush_size=1000, batch_size=10)
+            start = int(time.time())
+            for i in range(5):
+                for host in hosts + ["unknown"]:
+                    pool.put(host, "home_automation/{}/a/b".format(host))
+            pool.stop()
+
+            self.assertEqual(pool.processed, 105, "all messages sent")
+            self.assertEqual(pool.shed, 0, "none dropped")
+            self.assertEqual(pool.stats()["depth"], 0, "queues drained")
+            self.assertEqual(metrics_hahmon.UNKNOWN.value - unknown, 5,
+                             "unknown counted in a shard is exported")
+            self.assertGreaterEqual(
+                sum(metrics_hahmon.COMMIT_SECONDS.counts) - commits, 3,
+                "commit latency of every shard")
+            with contextlib.closing(sqlite3.connect(test_DB_name)) as conn:
+                self.assertEqual(conn.execute('''select count(*)
+                        from host_activity where timestamp >= ? and
+                        status = 'alive' ''', (start,)).fetchone()[0], 20,
+                                 "every host written by its shard")
+
+            # a shard's queue is full: waiting messages are coalesced
+            pool.max_waiting = 4
+            pool.buffers = [[("oak", "a", 1), ("oak", "a", 2), ("elm", "a", 3),
+                             ("oak", "a", 4)]]
+            pool.coalesce(0)
+            self.assertEqual(pool.buffers[0], [("elm", "a", 3), ("oak", "a", 4)],
+                             "newest per host/topic kept")
+            self.assertEqual((pool.coalesced, pool.shed), (2, 0), "coalesced")
+            pool.buffers = [[(host, "a", t) for (t, host) in enumerate(hosts)]]
+            pool.coalesce(0)
+            self.assertEqual(pool.buffers[0], [("host18", "a", 18),
+                                               ("host19", "a", 19)],
+                             "oldest dropped")
+            self.assertEqual(pool.shed, 18, "shed")
+        finally:
+            pathlib.Path.unlink(pathlib.Path(test_DB_name))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+Test program for snapshot_hahmon (Home Automation Host Monitor)
+"""
+
+import snapshot_hahmon
+import scan_hahmon
+import edit_hahmon
+import unittest
+import contextlib
+import os
+import sqlite3
+import tempfile
+
+
+class SnapshotHAmonTest(unittest.TestCase):
+
+    def test_save_load(self):
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.add("oak", None, 1000, 300, "alive")
+        scanner.add("maple", "home_automation/maple/é", 1100, 60, "late")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot")
+            snapshot_hahmon.save(path, scanner, 1234.5)
+            self.assertEqual(snapshot_hahmon.load(path),
+                             (1234.5, {("oak", None): (1000, 300, "alive"),
+                                       ("maple", "home_automation/maple/é"):
+                                       (1100, 60, "late")}), "round trip")
+            self.assertEqual(os.listdir(tmp), ["snapshot"], "no temp file")
+
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 1)
+            with self.assertRaises(ValueError):
+                snapshot_hahmon.load(path)
+            with open(path, "wb") as f:
+                f.write(b'HAHMREC1' + bytes(20))
+            with self.assertRaises(ValueError):
+                snapshot_hahmon.load(path)
+
+    def test_save_out_of_range(self):
+        scanner = scan_hahmon.OverdueScanner()
+        scanner.add("oak", None, 1000, 300, "alive")
+        scanner.add("maple", None, 1000, 1 << 32)
+        scanner.add("elm", "x" * snapshot_hahmon.NO_TOPIC, 1000, 300)
+        scanner.add("x" * 70000, None, 1000, 300)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot")
+            with self.assertLogs("snapshot_hahmon", "WARNING"):
+                self.assertEqual(snapshot_hahmon.save(path, scanner, 1234.5),
+                                 3, "records that do not fit left out")
+            self.assertEqual(snapshot_hahmon.load(path),
+                             (1234.5, {("oak", None): (1000, 300, "alive")}),
+                             "the others saved")
+
+            snapshot = snapshot_hahmon.Snapshot(path)
+            with self.assertLogs("snapshot_hahmon", "WARNING"):
+                snapshot.save(scanner, 1300)
+            self.assertEqual(snapshot.saves, 1, "Snapshot saved")
+
+    def test_restore(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, "ha_snapshot_test.db")
+            path = os.path.join(tmp, "snapshot")
+            edit_hahmon.create_database(db_name)
+            with contextlib.closing(sqlite3.connect(db_name)) as conn:
+                conn.executemany('''insert into host_activity
+                        (host, topic, timestamp, timeout, status, deadline)
+                        values (?,?,?,?,?,?)''',
+                                 [("oak", None, 1000, 300, "alive", 1300),
+                                  ("maple", "m/a", 1000, 300, "unknown", 1300),
+                                  ("elm", None, 900, 100, "late", 1000)])
+                conn.commit()
+
+            running = scan_hahmon.OverdueScanner()     # before the restart
+            running.add("oak", None, 1150, 300, "alive")    # not yet written
+            running.add("maple", "m/a", 1000, 300, "alive")
+            running.add("elm", None, 900, 100, "late")
+            running.add("ash", None, 1000, 300, "alive")    # since deleted
+            snapshot_hahmon.save(path, running, 1200)
+
+            now = 1400      # stopped for 200 seconds
+            scanner = scan_hahmon.OverdueScanner()
+            writer = edit_hahmon.ActivityWriter(
+                db_name, 60, 1000, scanner, clock=lambda: now,
+                snapshot=snapshot_hahmon.Snapshot(path, 60))
+            self.assertEqual(sorted(scanner), [("elm", None),
+                                                       ("maple", "m/a"),
+                                                       ("oak", None)],
+                             "records from the database")
+            self.assertEqual(scanner.get("oak", None),
+                             (1150, 300, "alive"), "newer timestamp kept")
+            self.assertEqual(writer.pending, {("oak", None): 1150,
+                                              ("maple", "m/a"): 1000},
+                             "newer state to be written")
+            self.assertEqual(writer.poll(), [],
+                             "maple not late for time nobody was listening")
+            now = 1500
+            self.assertEqual(writer.poll(), [("maple", "m/a")],
+                             "maple late once the stop is allowed for")
+            now = 1650
+            self.assertEqual(writer.poll(), [("oak", None)], "oak late")
+            writer.close()
+
+            with contextlib.closing(sqlite3.connect(db_name)) as conn:
+                self.assertEqual(conn.execute('''select timestamp, status
+                        from host_activity where host='oak' ''').fetchone(),
+                                 (1150, "late"), "written back")
+            (saved, records) = snapshot_hahmon.load(path)
+            self.assertEqual((saved, records[("maple", "m/a")][2]),
+                             (1650, "late"), "saved on close")
+
+            os.unlink(path)
+            scanner = scan_hahmon.OverdueScanner()
+            snapshot = snapshot_hahmon.Snapshot(path)
+            with contextlib.closing(sqlite3.connect(db_name)) as conn:
+                self.assertEqual(snapshot.restore(scanner, conn.cursor(), now),
+                                 {}, "no snapshot")
+            self.assertEqual(len(scanner), 3, "loaded from the database")
+
+
+if __name__ == "__main__":
+    unittest.main()
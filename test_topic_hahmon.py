@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Test program for topic_hahmon (Home Automation Host Monitor)
+"""
+
+import topic_hahmon
+import unittest
+import sqlite3
+
+
+class TopicHAmonTest(unittest.TestCase):
+
+    def test_valid_filter(self):
+        for topic in ("home_automation/oak/a/b", "home_automation/oak/#",
+                      "home_automation/+/a/+", "#", "+"):
+            self.assertTrue(topic_hahmon.valid_filter(topic), topic)
+        for topic in ("", "home_automation/#/a", "home_automation/oak+",
+                      "home_automation/oak/a#"):
+            self.assertFalse(topic_hahmon.valid_filter(topic), topic)
+
+    def test_match(self):
+        trie = topic_hahmon.TopicTrie()
+        for topic_filter in ("a/b/c", "a/+/c", "a/b/#", "a/#", "+/+/+/d"):
+            trie.add(topic_filter)
+        trie.add("a/#")
+        self.assertEqual(len(trie), 5, "duplicate counted once")
+
+        self.assertEqual(trie.match("a/b/c"), "a/b/c", "exact")
+        self.assertEqual(trie.match("a/x/c"), "a/+/c", "'+' beats '#'")
+        self.assertEqual(trie.match("a/b/x"), "a/b/#", "literal beats '+'")
+        self.assertEqual(trie.match("a/b"), "a/b/#", "'#' matches no levels")
+        self.assertEqual(trie.match("a/x/c/d"), "a/#",
+                         "'a/#' more specific than '+/+/+/d'")
+        self.assertEqual(trie.match("x/y/z/d"), "+/+/+/d", "all '+'")
+        self.assertIsNone(trie.match("x/y/z"), "no match")
+        self.assertIsNone(trie.match("x"), "too short")
+
+    def test_filters(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute('''create table host_activity (host TEXT, topic TEXT)''')
+        conn.executemany('''insert into host_activity values (?,?)''',
+                         [("oak", None), ("oak", "ha/oak/a"),
+                          ("oak", "ha/oak/+"), ("maple", "ha/maple/#")])
+        filters = topic_hahmon.TopicFilters()
+        filters.load(conn.cursor())
+        self.assertEqual(len(filters), 2, "only wildcard topics loaded")
+        self.assertEqual(filters.match("oak", "ha/oak/b"), "ha/oak/+", "oak")
+        self.assertIsNone(filters.match("oak", "ha/maple/b"),
+                          "filters of another host")
+        self.assertIsNone(filters.match("ash", "ha/ash/b"), "no filters")
+
+        filters.load(conn.cursor(), "maple")
+        self.assertEqual(len(filters), 1, "loaded for one host")
+        self.assertEqual(filters.match("maple", "ha/maple/b/c"), "ha/maple/#",
+                         "maple")
+        conn.close()
+
+    def test_covers(self):
+        for (general, specific) in (("a/#", "a"), ("a/#", "a/+/c"),
+                                    ("+/b/#", "a/b/c"), ("a/+", "a/b"),
+                                    ("#", "+/b/#"), ("a/b", "a/b")):
+            self.assertTrue(topic_hahmon.covers(general, specific),
+                            general + " covers " + specific)
+        for (general, specific) in (("a/+", "a"), ("a/+", "a/#"),
+                                    ("a/b", "a/b/c"), ("+/b/#", "a/c/d"),
+                                    ("a/b/#", "a/#")):
+            self.assertFalse(topic_hahmon.covers(general, specific),
+                             general + " does not cover " + specific)
+
+    def test_subscriptions(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute('''create table host_activity (host TEXT, topic TEXT)''')
+        conn.executemany('''insert into host_activity values (?,?)''',
+                         [("oak", None), ("oak", "ha/oak/a"),
+                          ("maple", "ha/maple/+/temp"), ("maple", "ha/maple/a/temp"),
+                          ("ash", "ha/ash/a"), ("ash", "ha/ash/b"),
+                          ("elm", "ha/elm/a+")])
+        self.assertEqual(topic_hahmon.subscriptions(conn.cursor()),
+                         {"+/oak/#", "ha/maple/+/temp", "ha/ash/a", "ha/ash/b"},
+                         "minimal set")
+        conn.execute('''insert into host_activity values ('ash', '+/+/a')''')
+        self.assertEqual(topic_hahmon.subscriptions(conn.cursor()),
+                         {"+/oak/#", "ha/maple/+/temp", "+/+/a", "ha/ash/b"},
+                         "covered by a filter for every host")
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+MQTT topic filters for the home automation host monitor.
+
+A host may be registered with a topic filter using the MQTT wildcards
+rather than a single topic, e.g.
+    home_automation/oak/+/temperature   any one level in place of '+'
+    home_automation/oak/#               any number of levels, including none
+Wildcards must occupy a whole level and '#' must be the last level.
+
+Incoming topics are matched against the filters in a trie with one node
+per topic level, so a lookup follows the levels of the topic rather than
+comparing every registration. When several filters match, the most
+specific one wins: the filters are compared level by level and a literal
+level beats '+', which beats '#'. An exact topic registration and the host
+registered without a topic are found in the database as before (see
+edit_hahmon.resolve_activity()); a matching filter sits between the two.
+
+subscriptions() derives the MQTT subscriptions a client needs to receive
+every message for a registration: '+/<host>/#' for a host registered
+without a topic (the host is the second level of the topic) and the
+topic or filter itself otherwise, leaving out any covered by another.
+"""
+
+SINGLE = '+'
+MULTI = '#'
+
+
+def valid_filter(topic):
+    """ True if 'topic' is a valid topic or topic filter. """
+    if not topic:
+        return False
+    levels = topic.split('/')
+    for (i, level) in enumerate(levels):
+        if level == MULTI:
+            if i != len(levels) - 1:
+                return False
+        elif level != SINGLE and (SINGLE in level or MULTI in level):
+            return False
+    return True
+
+
+class Node:
+    __slots__ = ("children", "filter")
+
+    def __init__(self):
+        self.children = {}      # level -> Node
+        self.filter = None      # the filter ending here, if any
+
+
+class TopicTrie:
+    """ Topic filters keyed by level. """
+
+    def __init__(self):
+        self.root = Node()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, topic_filter):
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.children.setdefault(level, Node())
+        if node.filter is None:
+            self.count += 1
+        node.filter = topic_filter
+
+    def match(self, topic):
+        """ Return the most specific filter matching 'topic', or None. """
+        return self.search(self.root, topic.split('/'), 0)
+
+    def search(self, node, levels, depth):
+        if depth == len(levels):
+            if node.filter is not None:
+                return node.filter
+            multi = node.children.get(MULTI)    # 'a/#' also matches 'a'
+            return multi.filter if multi is not None else None
+        for key in (levels[depth], SINGLE):
+            child = node.children.get(key)
+            if child is not None:
+                found = self.search(child, levels, depth + 1)
+                if found is not None:
+                    return found
+        multi = node.children.get(MULTI)
+        return multi.filter if multi is not None else None
+
+
+class TopicFilters:
+    """ The topic filters registered in host_activity, a trie per host. """
+
+    def __init__(self):
+        self.hosts = {}     # host -> TopicTrie
+
+    def __len__(self):
+        return sum(len(trie) for trie in self.hosts.values())
+
+    def add(self, host, topic_filter):
+        trie = self.hosts.get(host)
+        if trie is None:
+            trie = self.hosts[host] = TopicTrie()
+        trie.add(topic_filter)
+
+    def load(self, cursor, host=None):
+        """ Replace the filters with those in the database, for 'host' only
+        if given.
+        """
+        self.hosts = {}
+        if host is None:
+            rows = cursor.execute('''select host, topic from host_activity
+                    where topic glob '*[+#]*' ''')
+        else:
+            rows = cursor.execute('''select host, topic from host_activity
+                    where host=? and topic glob '*[+#]*' ''', (host,))
+        for (host, topic) in rows:
+            self.add(host, topic)
+
+    def match(self, host, topic):
+        """ Return the most specific filter registered for 'host' that
+        matches 'topic', or None.
+        """
+        trie = self.hosts.get(host)
+        if trie is None:
+            return None
+        return trie.match(topic)
+
+
+def covers(general, specific):
+    """ True if every topic matched by filter 'specific' is also matched by
+    filter 'general'.
+    """
+    general = general.split('/')
+    specific = specific.split('/')
+    for (i, level) in enumerate(general):
+        if level == MULTI:
+            return True
+        if i == len(specific):
+            return False
+        if level == SINGLE:
+            if specific[i] == MULTI:
+                return False
+        elif level != specific[i]:
+            return False
+    return len(general) == len(specific)
+
+
+def host_filter(host):
+    """ The subscription for every topic of 'host'. """
+    return "{}/{}/{}".format(SINGLE, host, MULTI)
+
+
+def subscriptions(cursor):
+    """ Return the set of topic filters to subscribe to for the
+    registrations in host_activity. Filters covered by another are left
+    out so that a message is not delivered twice. Filters are grouped by
+    their second level (normally the host) and only compared within their
+    group and with the few that have a wildcard there.
+    """
+    wanted = set()
+    for (host, topic) in cursor.execute('''select host, topic
+            from host_activity'''):
+        topic_filter = host_filter(host) if topic is None else topic
+        if valid_filter(topic_filter):  # else the broker would disconnect us
+            wanted.add(topic_filter)
+    groups = {}     # second level -> filters
+    wide = []       # filters that may match any second level
+    for topic_filter in wanted:
+        levels = topic_filter.split('/')
+        if len(levels) < 2 or MULTI in levels[:2] or levels[1] == SINGLE:
+            wide.append(topic_filter)
+        else:
+            groups.setdefault(levels[1], []).append(topic_filter)
+    narrowed = set()
+    for topic_filter in wanted:
+        levels = topic_filter.split('/')
+        others = wide + groups.get(levels[1], []) if len(levels) > 1 else wide
+        if not any(other != topic_filter and covers(other, topic_filter)
+                   for other in others):
+            narrowed.add(topic_filter)
+    return narrowed